@@ -14,6 +14,7 @@ from rest_framework.views import APIView, Response
 
 from balafon.Crm.models import Action, ActionType, ActionStatus, Contact, TeamMember, Entity
 from balafon.Crm import serializers
+from balafon.utils import get_phone_digits, is_phone_number
 
 
 class ContactViewSet(viewsets.ReadOnlyModelViewSet):
@@ -41,7 +42,17 @@ class ContactsOrEntitiesView(APIView):
         """return list of contacts"""
         contacts_and_entities = []
         if name:
-            contacts = Contact.objects.filter(lastname__istartswith=name)[:10]
+            if is_phone_number(name):
+                # search the numbers starting with the same digits whatever their format
+                digits = get_phone_digits(name)
+                contacts = Contact.objects.filter(
+                    Q(phone_digits__startswith=digits) | Q(mobile_digits__startswith=digits)
+                )
+                entities = Entity.objects.filter(phone_digits__startswith=digits)
+            else:
+                contacts = Contact.objects.filter(lastname__istartswith=name)
+                entities = Entity.objects.filter(name__istartswith=name)
+            contacts = contacts.select_related('entity', 'city', 'entity__city')[:10]
             contact_type = ContentType.objects.get_for_model(Contact)
             entity_type = ContentType.objects.get_for_model(Entity)
             for contact in contacts:
@@ -53,7 +64,7 @@ class ContactsOrEntitiesView(APIView):
                     'city': city.get_friendly_name() if city else '',
                 })
 
-            entities = Entity.objects.filter(name__istartswith=name, is_single_contact=False)[:10]
+            entities = entities.filter(is_single_contact=False).select_related('city')[:10]
             for entity in entities:
                 city = entity.city
                 contacts_and_entities.append({
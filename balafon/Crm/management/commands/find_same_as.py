@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from django.core.management.base import BaseCommand
+from django.db.models import Q
 
 from balafon.Crm import models
 
@@ -10,6 +11,10 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('group_name', type=str, default="", nargs='?')
+        parser.add_argument(
+            '--phone', action='store_true', dest='phone', default=False,
+            help="find the contacts with the same phone or mobile number (whatever its format)"
+        )
 
     def handle(self, group_name, *args, **options):
         verbose = options.get('verbosity', 0)
@@ -22,10 +27,18 @@ class Command(BaseCommand):
         
         total_count = 0
         for index, contact in enumerate(models.Contact.objects.all()):
-            if contact.lastname and contact.firstname:
+            same_as = None
+            if options.get('phone'):
+                digits = [value for value in (contact.phone_digits, contact.mobile_digits) if value]
+                if digits:
+                    same_as = models.Contact.objects.filter(
+                        Q(phone_digits__in=digits) | Q(mobile_digits__in=digits)
+                    ).exclude(id=contact.id)
+            elif contact.lastname and contact.firstname:
                 same_as = models.Contact.objects.filter(
                     lastname=contact.lastname, firstname=contact.firstname
                 ).exclude(id=contact.id)
+            if same_as is not None:
                 same_as_count = same_as.count()
                 if same_as_count > 0:
                     print(index, contact, same_as_count, "SameAs")
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+
+from balafon.Crm.utils import update_phone_digits
+
+
+class Command(BaseCommand):
+    help = "fill the digits of the phone numbers used by the searches"
+
+    def handle(self, *args, **options):
+        verbose = options.get('verbosity', 0)
+
+        updated_count = update_phone_digits()
+
+        if verbose > 0:
+            print(updated_count, "contacts and entities have been updated")
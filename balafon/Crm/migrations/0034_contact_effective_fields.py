@@ -0,0 +1,58 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:35
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+import django.db.models.deletion
+
+
+def forwards(apps, schema_editor):
+    """Fill the effective fields of all contacts"""
+    contact_model = apps.get_model("Crm", "Contact")
+    entity_model = apps.get_model("Crm", "Entity")
+    entities = entity_model.all_objects.filter(id=OuterRef('entity_id'))
+    contacts = contact_model.all_objects.all()
+
+    contacts.exclude(email='').update(effective_email=F('email'))
+    contacts.filter(email='').update(effective_email=Subquery(entities.values('email')[:1]))
+    contacts.exclude(phone='').update(effective_phone=F('phone'))
+    contacts.filter(phone='').update(effective_phone=Subquery(entities.values('phone')[:1]))
+
+    without_address = models.Q(
+        address='', address2='', address3='', zip_code='', cedex='', city__isnull=True
+    )
+    contacts.exclude(without_address).update(effective_zip_code=F('zip_code'), effective_city=F('city'))
+    contacts.filter(without_address).update(
+        effective_zip_code=Subquery(entities.values('zip_code')[:1]),
+        effective_city=Subquery(entities.values('city')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Crm', '0033_auto_20210513_1710'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contact',
+            name='effective_city',
+            field=models.ForeignKey(blank=True, default=None, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='Crm.City', verbose_name='effective city'),
+        ),
+        migrations.AddField(
+            model_name='contact',
+            name='effective_email',
+            field=models.EmailField(blank=True, db_index=True, default='', editable=False, max_length=254, verbose_name='effective email'),
+        ),
+        migrations.AddField(
+            model_name='contact',
+            name='effective_phone',
+            field=models.CharField(blank=True, default='', editable=False, max_length=200, verbose_name='effective phone'),
+        ),
+        migrations.AddField(
+            model_name='contact',
+            name='effective_zip_code',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=20, verbose_name='effective zip code'),
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+from django.db import DatabaseError, migrations, transaction
+
+
+# The columns searched by the quick search. Postgres uses a trigram index for the UPPER(...) LIKE '%text%'
+# generated by the icontains lookups
+TRIGRAM_INDEXES = (
+    ('Crm_entity', 'name'),
+    ('Crm_entity', 'phone'),
+    ('Crm_contact', 'lastname'),
+    ('Crm_contact', 'effective_email'),
+    ('Crm_contact', 'phone'),
+    ('Crm_contact', 'mobile'),
+    ('Crm_group', 'name'),
+    ('Crm_city', 'name'),
+)
+
+
+def _get_index_name(table, column):
+    return '{0}_{1}_trgm'.format(table, column).lower()
+
+
+def create_trigram_indexes(apps, schema_editor):
+    """create the indexes if pg_trgm is available: nothing to do for other databases"""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    except DatabaseError:
+        # The extension can only be created by a superuser: the quick search works without the indexes
+        return
+    for table, column in TRIGRAM_INDEXES:
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS "{0}" ON "{1}" USING gin (UPPER("{2}"::text) gin_trgm_ops)'.format(
+                _get_index_name(table, column), table, column
+            )
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for table, column in TRIGRAM_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS "{0}"'.format(_get_index_name(table, column)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Crm', '0034_contact_effective_fields'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:36
+
+from django.db import migrations, models
+
+
+# The phones are searched on their digits: the trigram indexes of 0035_quick_search_indexes are not used
+PHONE_TRIGRAM_INDEXES = ('crm_entity_phone_trgm', 'crm_contact_phone_trgm', 'crm_contact_mobile_trgm')
+
+
+def drop_phone_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for index_name in PHONE_TRIGRAM_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS "{0}"'.format(index_name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Crm', '0035_quick_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contact',
+            name='mobile_digits',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='contact',
+            name='phone_digits',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='entity',
+            name='phone_digits',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=200),
+        ),
+        migrations.RunPython(drop_phone_trigram_indexes, migrations.RunPython.noop),
+    ]
@@ -7,8 +7,9 @@ import unicodedata
 from urllib.parse import urlparse
 from datetime import datetime
 
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.db.models.query import ModelIterable
 from django.db.models.signals import pre_delete
 from django.conf import settings as project_settings
 from django.contrib.auth.models import User
@@ -26,11 +27,42 @@ from django_extensions.db.models import TimeStampedModel
 from sorl.thumbnail import default as sorl_thumbnail
 
 from balafon.Crm import settings
-from balafon.utils import now_rounded, logger, validate_rgb
+from balafon.utils import get_phone_digits, now_rounded, logger, validate_rgb
 from balafon.Users.models import Favorite
 
 
-class ConfirmedManager(models.Manager):
+class CustomFieldsQuerySet(models.QuerySet):
+    """queryset of contacts or entities which can preload the values of their custom fields"""
+
+    def __init__(self, *args, **kwargs):
+        super(CustomFieldsQuerySet, self).__init__(*args, **kwargs)
+        self._with_custom_fields = False
+        self._custom_field_names = None
+
+    def _clone(self):
+        clone = super(CustomFieldsQuerySet, self)._clone()
+        clone._with_custom_fields = self._with_custom_fields
+        clone._custom_field_names = self._custom_field_names
+        return clone
+
+    def with_custom_fields(self, names=None):
+        """
+        preload the values of the custom fields (all if names is None) when the queryset is evaluated.
+        Not applied by iterator(): call load_custom_fields on each chunk in this case
+        """
+        clone = self._clone()
+        clone._with_custom_fields = True
+        clone._custom_field_names = list(names) if names is not None else None
+        return clone
+
+    def _fetch_all(self):
+        is_fetched = self._result_cache is not None
+        super(CustomFieldsQuerySet, self)._fetch_all()
+        if self._with_custom_fields and not is_fetched and self._iterable_class is ModelIterable:
+            load_custom_fields(self._result_cache, self._custom_field_names)
+
+
+class ConfirmedManager(models.Manager.from_queryset(CustomFieldsQuerySet)):
     def get_queryset(self):
         return super().get_queryset().filter(confirmed=True)
 
@@ -46,6 +78,18 @@ class NamedElement(models.Model):
         abstract = True
 
 
+def get_current_user():
+    """the authenticated user of the current request if any"""
+    try:
+        request = RequestManager().get_request()
+        if request.user.is_authenticated:
+            # object can be modified by anonymous user : subscription page for example, view magic-link ...
+            return request.user
+    except (RequestNotFound, AttributeError):
+        pass
+    return None
+
+
 class LastModifiedModel(TimeStampedModel):
     """track the user who last modified an object"""
 
@@ -64,15 +108,7 @@ class LastModifiedModel(TimeStampedModel):
 
     def save(self, *args, **kwargs):
         """save object : update the last_modified_by from request"""
-        current_user = None
-        try:
-            request = RequestManager().get_request()
-            if request.user.is_authenticated:
-                # object can be modified by anonymous user : subscription page for example, view magic-link ...
-                current_user = request.user
-        except (RequestNotFound, AttributeError):
-            pass
-
+        current_user = get_current_user()
         if current_user:
             if not self.id:
                 self.created_by = current_user
@@ -321,6 +357,8 @@ class Entity(AddressModel):
     logo = models.ImageField(_("logo"), blank=True, default="", upload_to=get_entity_logo_dir)
     
     phone = models.CharField(_('phone'), max_length=200, blank=True, default='')
+    # digits of phone: indexed for searching a number whatever its format
+    phone_digits = models.CharField(max_length=200, blank=True, default='', db_index=True, editable=False)
     fax = models.CharField(_('fax'), max_length=200, blank=True, default='')
     email = models.EmailField(_('email'), blank=True, default='')
     website = models.CharField(_('web site'), max_length=200, blank=True, default='')
@@ -349,7 +387,8 @@ class Entity(AddressModel):
             parsing = urlparse(self.website)
             if not parsing.scheme:
                 self.website = "http://"+self.website
-            
+
+        self.phone_digits = get_phone_digits(self.phone)
         super(Entity, self).save(*args, **kwargs)
         if self.contact_set.filter(has_left=False).count() == 0:
             Contact.objects.create(entity=self, main_contact=True, has_left=False)
@@ -363,6 +402,16 @@ class Entity(AddressModel):
             self.name = "{0} {1}".format(contact.lastname, contact.firstname).lower()
             # don't put *args, *kwargs -> it may cause integrity error
             super(Entity, self).save()
+        self.update_contacts_effective_fields()
+
+    def update_contacts_effective_fields(self):
+        """update the effective fields of the contacts which are using the values of the entity"""
+        contacts = Contact.all_objects.filter(entity=self)
+        contacts.filter(email='').update(effective_email=self.email)
+        contacts.filter(phone='').update(effective_phone=self.phone)
+        contacts.filter(
+            address='', address2='', address3='', zip_code='', cedex='', city__isnull=True
+        ).update(effective_zip_code=self.zip_code, effective_city=self.city)
     
     def __str__(self):
         return self.name
@@ -495,6 +544,8 @@ class Entity(AddressModel):
         field_value = EntityCustomFieldValue.objects.get_or_create(custom_field=field, entity=self)[0]
         field_value.value = value
         field_value.save()
+        if '_custom_field_values' in self.__dict__:
+            self._custom_field_values[field_name] = value
 
     def add_to_group(self, group_name):
         """add to group"""
@@ -515,6 +566,9 @@ class Entity(AddressModel):
         prefix_length = len(prefix)
         if attr[:prefix_length] == prefix:
             field_name = attr[prefix_length:]
+            custom_field_values = object.__getattribute__(self, '__dict__').get('_custom_field_values')
+            if custom_field_values is not None and field_name in custom_field_values:
+                return custom_field_values[field_name]
             try:
                 custom_field = CustomField.objects.get(model=CustomField.MODEL_ENTITY, name=field_name)
                 custom_field_value = self.entitycustomfieldvalue_set.get(entity=self, custom_field=custom_field)
@@ -654,6 +708,10 @@ class Contact(AddressModel):
     phone = models.CharField(_('phone'), max_length=200, blank=True, default='')
     mobile = models.CharField(_('mobile'), max_length=200, blank=True, default='')
     email = models.EmailField(_('email'), blank=True, default='')
+
+    # digits of phone and mobile: indexed for searching a number whatever its format
+    phone_digits = models.CharField(max_length=200, blank=True, default='', db_index=True, editable=False)
+    mobile_digits = models.CharField(max_length=200, blank=True, default='', db_index=True, editable=False)
     
     uuid = models.CharField(max_length=100, blank=True, default='', db_index=True)
     
@@ -679,6 +737,20 @@ class Contact(AddressModel):
         help_text=_('For contact created from subscription form, we need to wait for confirmation by email link')
     )
 
+    # Values of get_email, get_phone, get_zip_code and get_city: the entity values if not defined for the contact
+    # They are updated when the contact or the entity is saved and make possible to filter or sort in the database
+    effective_email = models.EmailField(_('effective email'), blank=True, default='', db_index=True, editable=False)
+    effective_phone = models.CharField(
+        _('effective phone'), max_length=200, blank=True, default='', editable=False
+    )
+    effective_zip_code = models.CharField(
+        _('effective zip code'), max_length=20, blank=True, default='', db_index=True, editable=False
+    )
+    effective_city = models.ForeignKey(
+        City, verbose_name=_('effective city'), blank=True, default=None, null=True, related_name='+',
+        on_delete=models.SET_NULL, editable=False
+    )
+
     all_objects = models.Manager()  # The default manager.
     objects = ConfirmedManager()
 
@@ -831,6 +903,9 @@ class Contact(AddressModel):
             prefix_length = len(prefix)
             if attr[:prefix_length] == prefix:
                 field_name = attr[prefix_length:]
+                custom_field_values = object.__getattribute__(self, '__dict__').get('_custom_field_values')
+                if custom_field_values is not None and field_name in custom_field_values:
+                    return custom_field_values[field_name]
                 try:
                     custom_field = CustomField.objects.get(model=CustomField.MODEL_CONTACT, name=field_name)
                     custom_field_value = self.contactcustomfieldvalue_set.get(contact=self, custom_field=custom_field)
@@ -1020,6 +1095,8 @@ class Contact(AddressModel):
         field_value = ContactCustomFieldValue.objects.get_or_create(custom_field=field, contact=self)[0]
         field_value.value = value
         field_value.save()
+        if '_custom_field_values' in self.__dict__:
+            self._custom_field_values[field_name] = value
 
     def get_custom_field(self, field_name):
         """get the value of a custom field"""
@@ -1036,6 +1113,13 @@ class Contact(AddressModel):
     def headline_groups(self):
         return self.group_set.filter(on_contacts_list=True)
 
+    def update_effective_fields(self):
+        """copy the values of get_email, get_phone, get_zip_code and get_city. Doesn't save"""
+        self.effective_email = self.get_email
+        self.effective_phone = self.get_phone
+        self.effective_zip_code = self.get_zip_code
+        self.effective_city = self.get_city
+
     def save(self, *args, **kwargs):
         """save"""
         try:
@@ -1043,6 +1127,9 @@ class Contact(AddressModel):
         except ValueError:
             self.gender = 0
 
+        self.update_effective_fields()
+        self.phone_digits = get_phone_digits(self.phone)
+        self.mobile_digits = get_phone_digits(self.mobile)
         super(Contact, self).save(*args, **kwargs)
         if not self.uuid:
             name = '{0}-contact-{1}-{2}-{3}'.format(project_settings.SECRET_KEY, self.id, self.fullname, self.email)
@@ -1305,6 +1392,14 @@ class ActionNumberGenerator(models.Model):
         self.save()
         return self.number
 
+    def reserve(self, count):
+        """reserve a block of count numbers at once: returns the first one"""
+        with transaction.atomic():
+            generator = ActionNumberGenerator.objects.select_for_update().get(id=self.id)
+            ActionNumberGenerator.objects.filter(id=self.id).update(number=F('number') + count)
+        self.number = generator.number + count
+        return generator.number + 1
+
 
 class ActionType(NamedElement):
     """type of an action"""
@@ -1394,6 +1489,17 @@ class ActionType(NamedElement):
         return ""
     action_number.short_description = _('Last number')
 
+    def reserve_numbers(self, count):
+        """reserve a block of count action numbers at once: returns the first one"""
+        if self.number_generator:
+            return self.number_generator.reserve(count)
+        with transaction.atomic():
+            action_type = ActionType.objects.select_for_update().get(id=self.id)
+            # update rather than save: ActionType.save updates all the actions of the type
+            ActionType.objects.filter(id=self.id).update(last_number=F('last_number') + count)
+        self.last_number = action_type.last_number + count
+        return action_type.last_number + 1
+
     def save(self, *args, **kwargs):
         """save: create the corresponding men"""
         ret = super(ActionType, self).save(*args, **kwargs)
@@ -1657,11 +1763,7 @@ class Action(LastModifiedModel):
 
         if self.type:
             if self.type.generate_uuid and not self.uuid:
-                name = '{0}-action-{1}-{2}'.format(
-                    project_settings.SECRET_KEY, self.id, self.type.id if self.type else 0
-                )
-                ascii_name = unicodedata.normalize('NFKD', name).encode("ascii", 'ignore')
-                self.uuid = uuid.uuid5(uuid.NAMESPACE_URL, '{0}'.format(ascii_name))
+                self.uuid = self.build_uuid()
                 super(Action, self).save()
 
             if not self.type.generate_uuid and self.uuid:
@@ -1674,6 +1776,14 @@ class Action(LastModifiedModel):
 
         return ret
 
+    def build_uuid(self):
+        """the uuid of a saved action when generated by its type"""
+        name = '{0}-action-{1}-{2}'.format(
+            project_settings.SECRET_KEY, self.id, self.type.id if self.type else 0
+        )
+        ascii_name = unicodedata.normalize('NFKD', name).encode("ascii", 'ignore')
+        return uuid.uuid5(uuid.NAMESPACE_URL, '{0}'.format(ascii_name))
+
     def clone(self, new_type, planned_date=None):
         """Create a new action with same values but different types"""
         new_action = Action(parent=self)
@@ -1839,6 +1949,58 @@ class ContactCustomFieldValue(CustomFieldValue):
         return '{0} {1}'.format(self.contact, self.custom_field)
 
 
+# Max number of objects in the query loading the custom fields values: avoid too many sql variables
+CUSTOM_FIELDS_CHUNK_SIZE = 500
+
+
+def _load_custom_field_values(objects, model, value_class, lookup, names):
+    """set the _custom_field_values map of the objects: 1 query for the fields and 1 for the values"""
+    custom_fields = CustomField.objects.filter(model=model)
+    if names is not None:
+        custom_fields = custom_fields.filter(name__in=names)
+    field_names = dict(custom_fields.values_list('id', 'name'))
+
+    objects_by_id = {}
+    for obj in objects:
+        obj._custom_field_values = dict((name, '') for name in field_names.values())
+        objects_by_id.setdefault(obj.id, []).append(obj)
+
+    if field_names and objects_by_id:
+        ids = list(objects_by_id.keys())
+        for index in range(0, len(ids), CUSTOM_FIELDS_CHUNK_SIZE):
+            values = value_class.objects.filter(
+                custom_field__in=list(field_names.keys()),
+                **{lookup + '__in': ids[index:index + CUSTOM_FIELDS_CHUNK_SIZE]}
+            ).values_list(lookup, 'custom_field', 'value')
+            for (object_id, custom_field_id, value) in values:
+                for obj in objects_by_id[object_id]:
+                    obj._custom_field_values[field_names[custom_field_id]] = value
+
+
+def load_custom_fields(objects, names=None):
+    """
+    preload the values of the custom fields of a list of contacts or entities (and of the entities of the contacts)
+    custom_field_<name> is then returned without query. Load all custom fields if names is None
+    """
+    objects = list(objects)
+    if not objects:
+        return objects
+
+    if isinstance(objects[0], Contact):
+        missing_entity_ids = [contact.entity_id for contact in objects if not Contact.entity.is_cached(contact)]
+        if missing_entity_ids:
+            entities = Entity.all_objects.in_bulk(missing_entity_ids)
+            for contact in objects:
+                if not Contact.entity.is_cached(contact):
+                    contact.entity = entities[contact.entity_id]
+        _load_custom_field_values(objects, CustomField.MODEL_CONTACT, ContactCustomFieldValue, 'contact', names)
+        entities = [contact.entity for contact in objects]
+    else:
+        entities = objects
+    _load_custom_field_values(entities, CustomField.MODEL_ENTITY, EntityCustomFieldValue, 'entity', names)
+    return objects
+
+
 def _get_import_dir(contact_import, filename):
     """directory fro storing the files to import"""
     return '{0}/{1}'.format(settings.CONTACTS_IMPORT_DIR, filename)
@@ -1918,4 +2080,4 @@ class ActionStatusTrack(models.Model):
     class Meta:
         verbose_name = _('Action state track')
         verbose_name_plural = _('Action state tracks')
-        ordering = ('-datetime', )
\ No newline at end of file
+        ordering = ('-datetime', )
\ No newline at end of file
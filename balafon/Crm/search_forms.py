@@ -3,7 +3,7 @@
 
 from datetime import date, timedelta
 
-from django.db.models import Q, Count
+from django.db.models import Count, Exists, F, OuterRef, Q
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext as _
 
@@ -12,9 +12,13 @@ import floppyforms.__future__ as forms
 from balafon.Crm import models
 from balafon.Crm.settings import get_language_choices
 from balafon.Crm.utils import (
-    get_default_country, sort_by_name_callback, sort_by_entity_callback, sort_by_contact_callback
+    contact_fullname_expression, get_default_country, sort_by_name_callback, sort_by_entity_callback,
+    sort_by_contact_callback, sort_by_name_ordering, sort_by_entity_ordering, sort_by_contact_ordering
 )
 from balafon.Crm.widgets import CityNoCountryAutoComplete, GroupAutoComplete
+from balafon.Search.choices_cache import (
+    get_cached, get_queryset_choices, CachedModelChoiceField, CachedModelMultipleChoiceField
+)
 from balafon.Search.forms import SearchFieldForm, TwoDatesForm, YesNoSearchFieldForm
 
 
@@ -215,10 +219,8 @@ class ZoneSearchForm(SearchFieldForm):
         widget = self._get_widget()
         if widget:
             kwargs['widget'] = widget
-        field = forms.MultipleChoiceField(
-            choices=[(x.id, '{0}'.format(x)) for x in queryset.all()],
-            label=self.label,
-            **kwargs
+        field = CachedModelMultipleChoiceField(
+            queryset, empty_label=None, dependencies=(models.ZoneType, ), label=self.label, **kwargs
         )
         self._add_field(field)
         
@@ -523,8 +525,9 @@ class ActionByUser(SearchFieldForm):
     
     def __init__(self, *args, **kwargs):
         super(ActionByUser, self).__init__(*args, **kwargs)
-        choices = [(team_member.id, team_member.name) for team_member in models.TeamMember.objects.all()]
-        field = forms.ChoiceField(choices=choices, label=self.label)
+        field = CachedModelChoiceField(
+            models.TeamMember.objects.all(), label_field='name', empty_label=None, label=self.label
+        )
         self._add_field(field)
         
     def get_lookup(self):
@@ -573,7 +576,7 @@ class ActionStatus(SearchFieldForm):
     def __init__(self, *args, **kwargs):
         super(ActionStatus, self).__init__(*args, **kwargs)
         queryset = models.ActionStatus.objects.all()
-        field = forms.ModelChoiceField(queryset, label=self.label)
+        field = CachedModelChoiceField(queryset, label=self.label)
         self._add_field(field)
         
     def get_lookup(self):
@@ -590,7 +593,7 @@ class ActionWithoutStatus(SearchFieldForm):
     def __init__(self, *args, **kwargs):
         super(ActionWithoutStatus, self).__init__(*args, **kwargs)
         queryset = models.ActionStatus.objects.all()
-        field = forms.ModelChoiceField(queryset, label=self.label)
+        field = CachedModelChoiceField(queryset, label=self.label)
         self._add_field(field)
 
     def get_lookup(self):
@@ -606,7 +609,7 @@ class TypeSearchForm(SearchFieldForm):
     def __init__(self, *args, **kwargs):
         super(TypeSearchForm, self).__init__(*args, **kwargs)
         queryset = models.EntityType.objects.all()
-        field = forms.ModelChoiceField(queryset, label=self.label)
+        field = CachedModelChoiceField(queryset, label=self.label)
         self._add_field(field)
         
     def get_lookup(self):
@@ -674,8 +677,7 @@ class MultiGroupSearchForm(SearchFieldForm):
         widget = self._get_widget()
         if widget:
             kwargs['widget'] = widget
-        field = forms.MultipleChoiceField(
-            choices=[(x.id, '{0}'.format(x)) for x in queryset.all()], label=self.label, **kwargs)
+        field = CachedModelMultipleChoiceField(queryset, empty_label=None, label=self.label, **kwargs)
         self._add_field(field)
         
     def get_values(self):
@@ -789,7 +791,7 @@ class ContactAcceptSubscriptionSearchForm(SearchFieldForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         queryset = models.SubscriptionType.objects.all()
-        field = forms.ModelChoiceField(queryset, label=self.label)
+        field = CachedModelChoiceField(queryset, label=self.label)
         self._add_field(field)
 
     def get_queryset(self, queryset):
@@ -812,7 +814,7 @@ class ContactRefuseSubscriptionSearchForm(SearchFieldForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         queryset = models.SubscriptionType.objects.all()
-        field = forms.ModelChoiceField(queryset, label=self.label)
+        field = CachedModelChoiceField(queryset, label=self.label)
         self._add_field(field)
 
     def get_queryset(self, queryset):
@@ -831,7 +833,7 @@ class ContactNoSubscriptionSearchForm(SearchFieldForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         queryset = models.SubscriptionType.objects.all()
-        field = forms.ModelChoiceField(queryset, label=self.label)
+        field = CachedModelChoiceField(queryset, label=self.label)
         self._add_field(field)
 
     def get_queryset(self, queryset):
@@ -890,7 +892,7 @@ class ContactRoleSearchForm(SearchFieldForm):
     def __init__(self, *args, **kwargs):
         super(ContactRoleSearchForm, self).__init__(*args, **kwargs)
         queryset = models.EntityRole.objects.all().order_by('name')
-        field = forms.ModelChoiceField(queryset, label=self.label)
+        field = CachedModelChoiceField(queryset, label=self.label)
         self._add_field(field)
         
     def get_lookup(self):
@@ -923,7 +925,7 @@ class ContactHasEmail(YesNoSearchFieldForm):
             
     def get_lookup(self):
         """lookup"""
-        has_no_email = (Q(email='') & Q(entity__email=''))
+        has_no_email = Q(effective_email='')
         if self.is_yes():
             return ~has_no_email
         else:
@@ -981,7 +983,7 @@ class ActionTypeSearchForm(SearchFieldForm):
     def __init__(self, *args, **kwargs):
         super(ActionTypeSearchForm, self).__init__(*args, **kwargs)
         queryset = models.ActionType.objects.all().order_by('name')
-        field = forms.ModelChoiceField(queryset, label=self.label)
+        field = CachedModelChoiceField(queryset, label=self.label)
         self._add_field(field)
         
     def get_lookup(self):
@@ -1112,7 +1114,7 @@ class OpportunitySearchForm(SearchFieldForm):
     def __init__(self, *args, **kwargs):
         super(OpportunitySearchForm, self).__init__(*args, **kwargs)
         queryset = models.Opportunity.objects.all()
-        field = forms.ModelChoiceField(queryset, label=self.label)
+        field = CachedModelChoiceField(queryset, label=self.label)
         self._add_field(field)
     
     def get_lookup(self):
@@ -1160,25 +1162,31 @@ class NoSameAsForm(YesNoSearchFieldForm):
             same_as = {}
             filtered_contacts = []
             for contact in contacts:
-                if contact.same_as:
-                    if contact.same_as.id not in same_as:
-                        same_as[contact.same_as.id] = contact
-                        # filtered_contacts.append(contact.same_as.main_contact if contact.same_as else contact)
+                if contact.same_as_id:
+                    if contact.same_as_id not in same_as:
+                        same_as[contact.same_as_id] = len(filtered_contacts)
                         filtered_contacts.append(contact)
                     else:
                         # If the current contact has better priority (lower is better). Take this one
-                        other_contact = same_as[contact.same_as.id]
-                        if other_contact.same_as_priority > contact.same_as_priority:
-                            try:
-                                contact_index = filtered_contacts.index(other_contact)
-                                filtered_contacts[contact_index] = contact
-                            except ValueError:
-                                pass
-
+                        contact_index = same_as[contact.same_as_id]
+                        if filtered_contacts[contact_index].same_as_priority > contact.same_as_priority:
+                            filtered_contacts[contact_index] = contact
                 else:
                     filtered_contacts.append(contact)
             return filtered_contacts
 
+    def get_global_queryset(self, queryset):
+        """keep only the contact with the best priority of each same-as in the database"""
+        if self.is_yes():
+            return queryset
+        better_same_as = queryset.filter(same_as=OuterRef('same_as')).filter(
+            Q(same_as_priority__lt=OuterRef('same_as_priority')) |
+            Q(same_as_priority=OuterRef('same_as_priority'), id__lt=OuterRef('id'))
+        )
+        return queryset.annotate(
+            has_better_same_as=Exists(better_same_as.values('id'))
+        ).filter(Q(same_as__isnull=True) | Q(has_better_same_as=False))
+
 
 class HasSameAsForm(SearchFieldForm):
     """all contacts with same as"""
@@ -1242,6 +1250,20 @@ class NoSameEmailForm(SearchFieldForm):
                         filtered_contacts.append(contact)
         return filtered_contacts
 
+    def get_global_queryset(self, queryset):
+        """keep the first contact of each email (exclude) or the other ones (only) in the database"""
+        try:
+            value = int(self.value)
+        except ValueError:
+            value = -1
+        if value not in (0, 1):
+            return queryset.none()
+        queryset = queryset.exclude(effective_email='')
+        same_email_before = queryset.filter(effective_email=OuterRef('effective_email'), id__lt=OuterRef('id'))
+        return queryset.annotate(
+            has_same_email_before=Exists(same_email_before.values('id'))
+        ).filter(has_same_email_before=(value == 1))
+
 
 class DuplicatedContactsForm(SearchFieldForm):
     """Allow same as contact in results"""
@@ -1281,6 +1303,20 @@ class DuplicatedContactsForm(SearchFieldForm):
                         keys[key] = contact
         return filtered_contacts
 
+    def get_global_queryset(self, queryset):
+        """keep the contacts having the same name than another contact of the results in the database"""
+        try:
+            value = int(self.value)
+        except ValueError:
+            value = 1
+        queryset = queryset.exclude(lastname='')
+        if value == 2:
+            queryset = queryset.annotate(duplicated_key=F('lastname'))
+        else:
+            queryset = queryset.annotate(duplicated_key=contact_fullname_expression())
+        same_key = queryset.filter(duplicated_key=OuterRef('duplicated_key')).exclude(id=OuterRef('id'))
+        return queryset.annotate(is_duplicated=Exists(same_key.values('id'))).filter(is_duplicated=True)
+
 
 class ContactsImportSearchForm(SearchFieldForm):
     """by import"""
@@ -1290,7 +1326,7 @@ class ContactsImportSearchForm(SearchFieldForm):
     def __init__(self, *args, **kwargs):
         super(ContactsImportSearchForm, self).__init__(*args, **kwargs)
         queryset = models.ContactsImport.objects.order_by('name')
-        field = forms.ModelChoiceField(queryset, label=self.label)
+        field = CachedModelChoiceField(queryset, label=self.label)
         self._add_field(field)
         
     def get_lookup(self):
@@ -1304,7 +1340,7 @@ class ByUserBaseFormSearchForm(SearchFieldForm):
     def __init__(self, *args, **kwargs):
         super(ByUserBaseFormSearchForm, self).__init__(*args, **kwargs)
         queryset = User.objects.filter(is_staff=True).order_by('username')
-        field = forms.ModelChoiceField(queryset, label=self.label)
+        field = CachedModelChoiceField(queryset, label=self.label)
         self._add_field(field)
 
 
@@ -1407,31 +1443,31 @@ class ContactsRelationshipByType(SearchFieldForm):
     
     def __init__(self, *args, **kwargs):
         super(ContactsRelationshipByType, self).__init__(*args, **kwargs)
+        relationship_types = get_cached(
+            'relationship_types', (models.RelationshipType, ), self._get_relationship_types
+        )
+        field = forms.CharField(label=self.label, widget=forms.Select(choices=relationship_types))
+        self._add_field(field)
+
+    def _get_relationship_types(self):
+        """choices: the reverse relationships have a negative id"""
         relationship_types = []
         for relationship_type in models.RelationshipType.objects.all():
             relationship_types.append((relationship_type.id, relationship_type.name))
             if relationship_type.reverse:
                 relationship_types.append((-relationship_type.id, relationship_type.reverse))
-        field = forms.CharField(label=self.label, widget=forms.Select(choices=relationship_types))
-        self._add_field(field)
+        return relationship_types
         
     def get_lookup(self):
-        """lookup"""
-        relationship_ids = []
+        """lookup: the contacts are selected by a subquery on the relationships"""
         value, is_reverse = int(self.value), False
         if value < 0:
             value, is_reverse = -value, True
         relationship_type = models.RelationshipType.objects.get(id=value)
-        for relationship in models.Relationship.objects.filter(relationship_type__id=relationship_type.id):
-            if relationship_type.reverse:
-                if is_reverse:
-                    relationship_ids.append(relationship.contact2.id)
-                else:
-                    relationship_ids.append(relationship.contact1.id)
-            else:
-                relationship_ids += [relationship.contact1.id, relationship.contact2.id]
-        relationship_ids = list(set(relationship_ids))  
-        return Q(id__in=relationship_ids)
+        relationships = models.Relationship.objects.filter(relationship_type=relationship_type)
+        if relationship_type.reverse:
+            return Q(id__in=relationships.values('contact2_id' if is_reverse else 'contact1_id'))
+        return Q(id__in=relationships.values('contact1_id')) | Q(id__in=relationships.values('contact2_id'))
     
 
 class ContactsRelationshipByDate(TwoDatesForm):
@@ -1440,15 +1476,11 @@ class ContactsRelationshipByDate(TwoDatesForm):
     label = _('Relationship dates')
         
     def get_lookup(self):
-        """lookup"""
-        relationship_ids = []
+        """lookup: both contacts of the relationships created between the dates"""
         start_datetime, end_datetime = self._get_datetimes()
         end_datetime = end_datetime + timedelta(1)
-        queryset = models.Relationship.objects.filter(created__gte=start_datetime, created__lt=end_datetime)
-        for relationship_type in queryset:
-            relationship_ids = [relationship_type.contact1.id, relationship_type.contact2.id]
-        relationship_ids = list(set(relationship_ids))  
-        return Q(id__in=relationship_ids)
+        relationships = models.Relationship.objects.filter(created__gte=start_datetime, created__lt=end_datetime)
+        return Q(id__in=relationships.values('contact1_id')) | Q(id__in=relationships.values('contact2_id'))
     
 
 class ContactWithCustomField(SearchFieldForm):
@@ -1458,9 +1490,8 @@ class ContactWithCustomField(SearchFieldForm):
     
     def __init__(self, *args, **kwargs):
         super(ContactWithCustomField, self).__init__(*args, **kwargs)
-        custom_fields = []
-        for custom_field in models.CustomField.objects.filter(model=models.CustomField.MODEL_CONTACT):
-            custom_fields.append((custom_field.id, custom_field.label))
+        queryset = models.CustomField.objects.filter(model=models.CustomField.MODEL_CONTACT)
+        custom_fields = get_queryset_choices(queryset, label_field='label', empty_label=None)
         field = forms.CharField(label=self.label, widget=forms.Select(choices=custom_fields))
         self._add_field(field)
         
@@ -1478,9 +1509,8 @@ class EntityWithCustomField(SearchFieldForm):
     
     def __init__(self, *args, **kwargs):
         super(EntityWithCustomField, self).__init__(*args, **kwargs)
-        custom_fields = []
-        for custom_field in models.CustomField.objects.filter(model=models.CustomField.MODEL_ENTITY):
-            custom_fields.append((custom_field.id, custom_field.label))
+        queryset = models.CustomField.objects.filter(model=models.CustomField.MODEL_ENTITY)
+        custom_fields = get_queryset_choices(queryset, label_field='label', empty_label=None)
         field = forms.CharField(label=self.label, widget=forms.Select(choices=custom_fields))
         self._add_field(field)
         
@@ -1500,9 +1530,11 @@ class CustomFieldBaseSearchForm(SearchFieldForm):
     def __init__(self, *args, **kwargs):
         super(CustomFieldBaseSearchForm, self).__init__(*args, **kwargs)
 
-        self.custom_field = models.CustomField.objects.get_or_create(
-            name=self.custom_field_name, model=self.model
-        )[0]
+        self.custom_field = get_cached(
+            'custom_field-{0}-{1}'.format(self.model, self.custom_field_name),
+            (models.CustomField, ),
+            lambda: models.CustomField.objects.get_or_create(name=self.custom_field_name, model=self.model)[0]
+        )
 
         label = self.custom_field.label or self.custom_field.name
 
@@ -1519,12 +1551,10 @@ class CustomFieldBaseSearchForm(SearchFieldForm):
 
         if custom_field.model == models.CustomField.MODEL_ENTITY:
             queryset = models.EntityCustomFieldValue.objects.filter(custom_field=self.custom_field, value=value)
-            entity_ids = [custom_field_value.entity.id for custom_field_value in queryset]
-            return Q(entity__id__in=entity_ids)
+            return Q(entity__id__in=queryset.values('entity_id'))
         else:
             queryset = models.ContactCustomFieldValue.objects.filter(custom_field=self.custom_field, value=value)
-            contact_ids = [custom_field_value.contact.id for custom_field_value in queryset]
-            return Q(id__in=contact_ids)
+            return Q(id__in=queryset.values('contact_id'))
 
 
 class UnitTestEntityCustomFieldForm(CustomFieldBaseSearchForm):
@@ -1569,7 +1599,7 @@ class SortContacts(SearchFieldForm):
             )
         )
         self._add_field(field)
-        self.default_country = get_default_country()
+        self.default_country = None
 
     def _sort_by_name(self, contact):
         return sort_by_name_callback(contact)
@@ -1602,8 +1632,21 @@ class SortContacts(SearchFieldForm):
     def global_post_process(self, contacts):
         """filter the final results"""
         callback = getattr(self, '_sort_by_{0}'.format(self.value), None)
+        if self.value == 'zipcode':
+            self.default_country = get_cached('default_country', (models.Zone, models.ZoneType), get_default_country)
         return sorted(contacts, key=callback)
 
+    def get_global_queryset(self, queryset):
+        """sort the results in the database. None if the sort can only be done in Python (zipcode)"""
+        get_ordering = {
+            'entity': sort_by_entity_ordering,
+            'contact': sort_by_contact_ordering,
+            'name': sort_by_name_ordering,
+        }.get(self.value)
+        if get_ordering is None:
+            return None
+        return queryset.order_by(*get_ordering())
+
 
 class ContactWithEmailInGroupSearchForm(SearchFieldForm):
     """get contacts with someone with the same email in group"""
@@ -1634,14 +1677,19 @@ class ContactWithEmailInGroupSearchForm(SearchFieldForm):
     #     """lookup"""
     #     return Q(entity__group__id=self.value) | Q(group__id=self.value)
 
+    def _get_group_contacts(self):
+        """contacts of the group (directly or by their entity)"""
+        return models.Contact.objects.filter(Q(entity__group__id=self.value) | Q(group__id=self.value))
+
     def global_post_process(self, contacts):
         """filter the final results"""
-        group_contacts = models.Contact.objects.filter(Q(entity__group__id=self.value) | Q(group__id=self.value))
-
-        contacts_with_same_email_in_group = []
-        for contact in contacts:
-            email = contact.get_email
-            if group_contacts.filter(Q(email=email) | Q(email='', entity__email=email)):
-                contacts_with_same_email_in_group.append(contact)
-
-        return contacts_with_same_email_in_group
+        group_emails = set(self._get_group_contacts().values_list('effective_email', flat=True))
+        group_emails.discard('')
+        return [contact for contact in contacts if contact.get_email in group_emails]
+
+    def get_global_queryset(self, queryset):
+        """filter the results in the database"""
+        same_email_in_group = self._get_group_contacts().filter(effective_email=OuterRef('effective_email'))
+        return queryset.exclude(effective_email='').annotate(
+            has_same_email_in_group=Exists(same_email_in_group.values('id'))
+        ).filter(has_same_email_in_group=True)
@@ -6,3 +6,7 @@ import django.dispatch
 action_cloned = django.dispatch.Signal(providing_args=["original_action", "new_action"])
 
 new_subscription = django.dispatch.Signal(providing_args=["instance", "contact"])
+
+actions_bulk_created = django.dispatch.Signal(providing_args=["actions"])
+
+subscriptions_bulk_updated = django.dispatch.Signal(providing_args=["subscription_type", "contact_ids"])
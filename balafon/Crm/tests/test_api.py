@@ -231,3 +231,23 @@ class ContactOrEntityTest(APITestCase):
         self.assertEqual(len(response.data), 10)
         for elt in response.data:
             self.assertEqual(elt['name'][0], 'A')
+
+    def test_api_phone(self):
+        """returns the contacts and entities with a phone number starting with the same digits"""
+        contact_type = ContentType.objects.get_for_model(models.Contact)
+        entity_type = ContentType.objects.get_for_model(models.Entity)
+
+        entity1 = mommy.make(models.Entity, name='Alpha', is_single_contact=False, phone='01.23.45.67.89')
+        entity2 = mommy.make(models.Entity, name='Beta', is_single_contact=False, phone='09 87 65 43 21')
+        contact1 = mommy.make(models.Contact, lastname='Zorro', mobile='0123 456 000', entity=entity2)
+        mommy.make(models.Contact, lastname='Bernard', phone='0223456789', entity=entity2)
+
+        self._login()
+
+        url = reverse('crm_api_contacts_or_entities') + "?name=01 23 4"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [
+            {'id': entity1.id, 'name': 'Alpha', 'type': entity_type.id, 'city': ''},
+            {'id': contact1.id, 'name': 'Zorro', 'type': contact_type.id, 'city': ''},
+        ])
@@ -132,6 +132,62 @@ class AddressOverloadTest(BaseTestCase):
                 self.assertEqual(getattr(contact, att), val)
 
 
+
+class EffectiveFieldsTest(BaseTestCase):
+    """effective fields are the values of the entity if not defined for the contact"""
+
+    def test_values_of_entity(self):
+        """contact without values"""
+        city = mommy.make(models.City, name='city1')
+        entity = mommy.make(
+            models.Entity, email="contact@tiny.fr", phone="0102030405", zip_code="12345", city=city
+        )
+        contact = mommy.make(models.Contact, entity=entity, email="", phone="", zip_code="", city=None)
+        contact = models.Contact.objects.get(id=contact.id)
+        self.assertEqual("contact@tiny.fr", contact.effective_email)
+        self.assertEqual("0102030405", contact.effective_phone)
+        self.assertEqual("12345", contact.effective_zip_code)
+        self.assertEqual(city, contact.effective_city)
+
+    def test_values_of_contact(self):
+        """contact with values"""
+        city1 = mommy.make(models.City, name='city1')
+        city2 = mommy.make(models.City, name='city2')
+        entity = mommy.make(
+            models.Entity, email="contact@tiny.fr", phone="0102030405", zip_code="12345", city=city1
+        )
+        contact = mommy.make(
+            models.Contact, entity=entity, email="john@tiny.fr", phone="0504030201", zip_code="", city=city2
+        )
+        contact = models.Contact.objects.get(id=contact.id)
+        self.assertEqual("john@tiny.fr", contact.effective_email)
+        self.assertEqual("0504030201", contact.effective_phone)
+        self.assertEqual("", contact.effective_zip_code)
+        self.assertEqual(city2, contact.effective_city)
+
+    def test_update_entity(self):
+        """the contacts are updated when the entity is saved"""
+        city1 = mommy.make(models.City, name='city1')
+        city2 = mommy.make(models.City, name='city2')
+        entity = mommy.make(models.Entity, email="contact@tiny.fr", zip_code="12345", city=city1)
+        contact1 = mommy.make(models.Contact, entity=entity, email="", zip_code="", city=None)
+        contact2 = mommy.make(models.Contact, entity=entity, email="john@tiny.fr", zip_code="", city=city2)
+
+        entity.email = "info@tiny.fr"
+        entity.zip_code = "54321"
+        entity.city = city2
+        entity.save()
+
+        contact1 = models.Contact.objects.get(id=contact1.id)
+        self.assertEqual("info@tiny.fr", contact1.effective_email)
+        self.assertEqual("54321", contact1.effective_zip_code)
+        self.assertEqual(city2, contact1.effective_city)
+
+        contact2 = models.Contact.objects.get(id=contact2.id)
+        self.assertEqual("john@tiny.fr", contact2.effective_email)
+        self.assertEqual("", contact2.effective_zip_code)
+        self.assertEqual(city2, contact2.effective_city)
+
 class SingleContactTest(BaseTestCase):
 
     def test_view_add_single_contact(self):
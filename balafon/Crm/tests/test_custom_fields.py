@@ -391,3 +391,52 @@ class SetFieldTest(BaseTestCase):
         )
         self.assertEqual(custom_field_value.value, '2')
 
+
+
+class LoadCustomFieldsTest(BaseTestCase):
+    """preload the values of the custom fields"""
+
+    def setUp(self):
+        super(LoadCustomFieldsTest, self).setUp()
+        self.contact_field = models.CustomField.objects.create(name='cf1', model=models.CustomField.MODEL_CONTACT)
+        self.entity_field = models.CustomField.objects.create(name='cf2', model=models.CustomField.MODEL_ENTITY)
+        models.CustomField.objects.create(name='cf3', model=models.CustomField.MODEL_CONTACT)
+        self.entities = []
+        for index in range(3):
+            entity = mommy.make(models.Entity, name="Entity{0}".format(index))
+            if index > 0:
+                entity.set_custom_field('cf2', 'E{0}'.format(index))
+            contact = entity.default_contact
+            if index < 2:
+                contact.set_custom_field('cf1', 'C{0}'.format(index))
+            self.entities.append(entity)
+
+    def test_with_custom_fields(self):
+        """custom fields are loaded with the queryset: contacts, entities, fields and values"""
+        with self.assertNumQueries(6):
+            contacts = list(
+                models.Contact.objects.filter(entity__in=self.entities).order_by('entity__name').with_custom_fields()
+            )
+            self.assertEqual(['C0', 'C1', ''], [contact.custom_field_cf1 for contact in contacts])
+            self.assertEqual(['', '', ''], [contact.custom_field_cf3 for contact in contacts])
+            self.assertEqual(['', 'E1', 'E2'], [contact.entity_custom_field_cf2 for contact in contacts])
+
+    def test_with_custom_fields_names(self):
+        """only the given custom fields are loaded"""
+        entities = list(models.Entity.objects.filter(id__in=[entity.id for entity in self.entities]).order_by(
+            'name'
+        ).with_custom_fields(['cf2']))
+        with self.assertNumQueries(0):
+            self.assertEqual(['', 'E1', 'E2'], [entity.custom_field_cf2 for entity in entities])
+
+    def test_load_custom_fields(self):
+        """load the custom fields of a list"""
+        contacts = list(models.Contact.objects.filter(entity__in=self.entities).order_by('entity__name'))
+        models.load_custom_fields(contacts, ['cf1', 'cf2'])
+        with self.assertNumQueries(0):
+            self.assertEqual(['C0', 'C1', ''], [contact.custom_field_cf1 for contact in contacts])
+            self.assertEqual(['', 'E1', 'E2'], [contact.entity_custom_field_cf2 for contact in contacts])
+
+        contacts[2].set_custom_field('cf1', 'C2')
+        with self.assertNumQueries(0):
+            self.assertEqual('C2', contacts[2].custom_field_cf1)
@@ -3,7 +3,12 @@
 
 from django.core.exceptions import ValidationError
 
-from balafon.utils import validate_rgb
+from django.core.management import call_command
+
+from model_mommy import mommy
+
+from balafon.utils import get_phone_digits, is_phone_number, validate_rgb
+from balafon.Crm import models
 from balafon.Crm.tests import BaseTestCase
 
 
@@ -51,3 +56,42 @@ class CheckRgbTest(BaseTestCase):
         """it should raise an error"""
         self.assertRaises(ValidationError, validate_rgb, '#1234567')
         self.assertRaises(ValidationError, validate_rgb, '#12345678')
+
+
+class PhoneDigitsTest(BaseTestCase):
+    """digits of the phone numbers"""
+
+    def test_get_phone_digits(self):
+        """only the digits are kept"""
+        self.assertEqual("0612345678", get_phone_digits("06 12.34-56/78"))
+        self.assertEqual("33612345678", get_phone_digits("+33 (6) 12 34 56 78"))
+        self.assertEqual("", get_phone_digits(""))
+
+    def test_is_phone_number(self):
+        """a text can be searched as a phone number if it has only digits and separators"""
+        self.assertTrue(is_phone_number("06 12"))
+        self.assertTrue(is_phone_number("+33.6"))
+        self.assertFalse(is_phone_number("0"))
+        self.assertFalse(is_phone_number("Skywalker"))
+        self.assertFalse(is_phone_number("06 to 07"))
+
+    def test_save(self):
+        """the digits are updated when saved"""
+        entity = mommy.make(models.Entity, phone="01 23 45 67 89")
+        contact = mommy.make(models.Contact, entity=entity, phone="02.23.45.67.89", mobile="06-12-34-56-78")
+        self.assertEqual("0123456789", models.Entity.objects.get(id=entity.id).phone_digits)
+        contact = models.Contact.objects.get(id=contact.id)
+        self.assertEqual("0223456789", contact.phone_digits)
+        self.assertEqual("0612345678", contact.mobile_digits)
+
+    def test_update_phone_digits(self):
+        """the command fills the digits of the existing contacts and entities"""
+        entity = mommy.make(models.Entity, phone="01 23 45 67 89")
+        contact = mommy.make(models.Contact, entity=entity, phone="02.23.45.67.89", confirmed=False)
+        models.Entity.objects.update(phone_digits='')
+        models.Contact.all_objects.update(phone_digits='', mobile_digits='')
+
+        call_command('update_phone_digits', verbosity=0)
+
+        self.assertEqual("0123456789", models.Entity.objects.get(id=entity.id).phone_digits)
+        self.assertEqual("0223456789", models.Contact.all_objects.get(id=contact.id).phone_digits)
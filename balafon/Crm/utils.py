@@ -3,15 +3,25 @@
 
 import csv
 import codecs
+from datetime import datetime
+import uuid
 
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.db import transaction
+from django.db.models.signals import m2m_changed
+from django.db.models import Case, CharField, F, Q, Value, When
+from django.db.models.functions import Concat, Upper
 
 from coop_cms.moves import StringIO
 
 from balafon.Crm import models
 from balafon.Crm import settings as crm_settings
-from balafon.utils import logger
+from balafon.Crm.signals import actions_bulk_created, subscriptions_bulk_updated
+from balafon.utils import get_phone_digits, logger, now_rounded
+
+
+# Number of rows inserted by a single statement
+BULK_BATCH_SIZE = 500
 
 
 def filter_icontains_unaccent(queryset, field, text):
@@ -200,3 +210,257 @@ def sort_by_entity_callback(contact):
     value3 = "{0} {1}".format(contact.lastname, contact.firstname) if not contact.entity.is_single_contact else ""
     return value1, value2, value3
 
+
+def _contact_name_expression():
+    """SQL expression: same value as "{lastname} {firstname}" """
+    return Concat('lastname', Value(' '), 'firstname', output_field=CharField())
+
+
+def _entity_or_contact_name_expression():
+    """SQL expression: contact name for single contact, entity name otherwise"""
+    return Case(
+        When(entity__is_single_contact=True, then=_contact_name_expression()),
+        default=F('entity__name'),
+        output_field=CharField()
+    )
+
+
+def sort_by_name_ordering():
+    """order_by arguments for sorting a contacts queryset like sort_by_name_callback"""
+    return [Upper(_entity_or_contact_name_expression()), 'id']
+
+
+def sort_by_contact_ordering():
+    """order_by arguments for sorting a contacts queryset like sort_by_contact_callback"""
+    return [Upper(_contact_name_expression()), 'id']
+
+
+def sort_by_entity_ordering():
+    """order_by arguments for sorting a contacts queryset like sort_by_entity_callback"""
+    contact_name = Case(
+        When(entity__is_single_contact=True, then=Value('')),
+        default=_contact_name_expression(),
+        output_field=CharField()
+    )
+    return ['entity__is_single_contact', Upper(_entity_or_contact_name_expression()), contact_name, 'id']
+
+
+def contact_fullname_expression():
+    """SQL expression: same value as contact.fullname for contacts with a lastname"""
+    gender_title = Case(
+        When(gender=models.Contact.GENDER_NOT_SET, then=Value('')),
+        When(~Q(gender_title=''), then=Concat('gender_title', Value(' '))),
+        *[
+            When(gender=value, then=Value('{0} '.format(label)))
+            for (value, label) in models.Contact.GENDER_CHOICE if value != models.Contact.GENDER_NOT_SET
+        ],
+        default=Value(''),
+        output_field=CharField()
+    )
+    firstname = Case(
+        When(firstname='', then=Value('')),
+        default=Concat('firstname', Value(' ')),
+        output_field=CharField()
+    )
+    return Concat(gender_title, firstname, 'lastname', output_field=CharField())
+
+
+def create_actions_for_contacts(contacts, per_contact_fields=None, **fields):
+    """
+    create an action with the given fields for each contact in a constant number of queries.
+    per_contact_fields is an optional list of dict: the fields which are different for each contact (subject...)
+    The rows are inserted with bulk_create: Action.save is not called and no post_save signal is sent.
+    The actions_bulk_created signal is sent once with all the actions
+    """
+    contacts = list(contacts)
+    if not contacts:
+        return []
+    per_contact_fields = list(per_contact_fields) if per_contact_fields is not None else [{}] * len(contacts)
+
+    # Apply the rules of Action.save once for all the actions
+    template = models.Action(**fields)
+    action_type = template.type
+    if action_type and action_type.default_status:
+        template.status = action_type.default_status
+    if template.status and template.status.is_final:
+        template.done = True
+    elif action_type and action_type.has_final_status():
+        template.done = False
+    if template.done and not template.done_date:
+        template.done_date = now_rounded()
+    track_status = template.status and action_type and action_type.track_status
+    if track_status:
+        template.previous_status = template.status
+    current_user = models.get_current_user()
+    if current_user:
+        template.created_by = template.last_modified_by = current_user
+
+    # the ids are not returned by bulk_create on every database: the actions are marked for getting them back
+    batch_uuid = 'bulk-{0}'.format(uuid.uuid4().hex)
+    template.uuid = batch_uuid
+    values = dict(
+        (field.attname, getattr(template, field.attname))
+        for field in models.Action._meta.concrete_fields if not field.primary_key
+    )
+
+    with transaction.atomic():
+        first_number = None
+        if action_type and action_type.number_auto_generated and not template.number:
+            first_number = action_type.reserve_numbers(len(contacts))
+
+        actions = []
+        for index, contact in enumerate(contacts):
+            action = models.Action(**values)
+            action.type = action_type
+            for field_name, value in per_contact_fields[index].items():
+                setattr(action, field_name, value)
+            if first_number is not None:
+                action.number = first_number + index
+            actions.append(action)
+        models.Action.objects.bulk_create(actions, batch_size=BULK_BATCH_SIZE)
+
+        action_ids = models.Action.objects.filter(uuid=batch_uuid).order_by('id').values_list('id', flat=True)
+        for action, action_id in zip(actions, action_ids):
+            action.id = action_id
+            action.uuid = ''
+
+        if action_type and action_type.generate_uuid:
+            for action in actions:
+                action.uuid = '{0}'.format(action.build_uuid())
+            models.Action.objects.bulk_update(actions, ['uuid'], batch_size=BULK_BATCH_SIZE)
+        else:
+            models.Action.objects.filter(uuid=batch_uuid).update(uuid='')
+
+        through_model = models.Action.contacts.through
+        through_model.objects.bulk_create(
+            [through_model(action_id=action.id, contact_id=contact.id) for action, contact in zip(actions, contacts)],
+            batch_size=BULK_BATCH_SIZE
+        )
+
+        if track_status:
+            now = datetime.now()
+            models.ActionStatusTrack.objects.bulk_create(
+                [models.ActionStatusTrack(action=action, status=template.status, datetime=now) for action in actions],
+                batch_size=BULK_BATCH_SIZE
+            )
+
+    actions_bulk_created.send(sender=models.Action, actions=actions)
+    return actions
+
+
+def _get_id_chunks(ids):
+    """split a list of ids in chunks of BULK_BATCH_SIZE"""
+    ids = list(ids)
+    return [ids[index:index + BULK_BATCH_SIZE] for index in range(0, len(ids), BULK_BATCH_SIZE)]
+
+
+def _add_to_groups(groups, related_model, related_ids):
+    """
+    add the objects of related_model to the groups: only the missing rows of the through table are inserted.
+    returns the number of added rows
+    """
+    field_name = 'contacts' if related_model is models.Contact else 'entities'
+    through_model = getattr(models.Group, field_name).through
+    related_field = '{0}_id'.format(related_model._meta.model_name)
+    groups = list(groups)
+    added_ids = dict((group.id, set()) for group in groups)
+
+    with transaction.atomic():
+        for chunk_ids in _get_id_chunks(related_ids):
+            existing = set(
+                through_model.objects.filter(
+                    group__in=groups, **{related_field + '__in': chunk_ids}
+                ).values_list('group_id', related_field)
+            )
+            rows = []
+            for group in groups:
+                for related_id in chunk_ids:
+                    if (group.id, related_id) not in existing:
+                        rows.append(through_model(group_id=group.id, **{related_field: related_id}))
+                        added_ids[group.id].add(related_id)
+            through_model.objects.bulk_create(rows, batch_size=BULK_BATCH_SIZE)
+
+    # same signal as group.contacts.add: sent once per group
+    for group in groups:
+        if added_ids[group.id]:
+            m2m_changed.send(
+                sender=through_model, action='post_add', instance=group, reverse=False, model=related_model,
+                pk_set=added_ids[group.id], using='default'
+            )
+    return sum(len(ids) for ids in added_ids.values())
+
+
+def add_contacts_to_groups(groups, contacts):
+    """add the contacts to the groups in bulk. returns the number of added memberships"""
+    return _add_to_groups(groups, models.Contact, set(contact.id for contact in contacts))
+
+
+def add_entities_to_groups(groups, entity_ids):
+    """add the entities to the groups in bulk. returns the number of added memberships"""
+    return _add_to_groups(groups, models.Entity, set(entity_ids))
+
+
+def update_subscriptions(contacts, subscription_type, accept_subscription):
+    """
+    subscribe or unsubscribe the contacts: a single update for the existing subscriptions
+    and the missing ones are created at once when subscribing. returns the number of modified contacts
+    """
+    contact_ids = set(contact.id for contact in contacts)
+    nb_contacts = 0
+    with transaction.atomic():
+        for chunk_ids in _get_id_chunks(contact_ids):
+            queryset = models.Subscription.objects.filter(
+                subscription_type=subscription_type, contact_id__in=chunk_ids
+            )
+            nb_contacts += queryset.exclude(accept_subscription=accept_subscription).update(
+                accept_subscription=accept_subscription
+            )
+            if accept_subscription:
+                existing_ids = set(queryset.values_list('contact_id', flat=True))
+                subscriptions = [
+                    models.Subscription(
+                        contact_id=contact_id, subscription_type=subscription_type, accept_subscription=True
+                    )
+                    for contact_id in chunk_ids if contact_id not in existing_ids
+                ]
+                models.Subscription.objects.bulk_create(subscriptions, batch_size=BULK_BATCH_SIZE)
+                nb_contacts += len(subscriptions)
+
+    subscriptions_bulk_updated.send(
+        sender=models.Subscription, subscription_type=subscription_type, contact_ids=contact_ids
+    )
+    return nb_contacts
+
+
+def _update_digits(queryset, fields):
+    """set the digits fields of the objects of queryset: fields is a list of (field, digits_field)"""
+    updated_count = 0
+    digits_fields = [digits_field for field, digits_field in fields]
+    objs = []
+    queryset = queryset.only('id', *[field for field, digits_field in fields] + digits_fields).order_by('id')
+    for obj in queryset.iterator(chunk_size=BULK_BATCH_SIZE):
+        changed = False
+        for field, digits_field in fields:
+            digits = get_phone_digits(getattr(obj, field))
+            if digits != getattr(obj, digits_field):
+                setattr(obj, digits_field, digits)
+                changed = True
+        if changed:
+            objs.append(obj)
+        if len(objs) == BULK_BATCH_SIZE:
+            queryset.bulk_update(objs, digits_fields)
+            updated_count += len(objs)
+            objs = []
+    if objs:
+        queryset.bulk_update(objs, digits_fields)
+        updated_count += len(objs)
+    return updated_count
+
+
+def update_phone_digits():
+    """fill the digits of the phones of all contacts and entities. Returns the number of updated objects"""
+    contacts_count = _update_digits(
+        models.Contact.all_objects.all(), [('phone', 'phone_digits'), ('mobile', 'mobile_digits')]
+    )
+    entities_count = _update_digits(models.Entity.all_objects.all(), [('phone', 'phone_digits')])
+    return contacts_count + entities_count
@@ -32,3 +32,11 @@ class MagicLinkAdmin(admin.ModelAdmin):
     list_display = ['url', 'emailing']
     search_fields = ['url', 'emailing']
     raw_id_admin = ('emailing',)
+
+
+@admin.register(models.EmailingDelivery)
+class EmailingDeliveryAdmin(admin.ModelAdmin):
+    """Emailing delivery"""
+    list_display = ['contact', 'emailing', 'status', 'attempts', 'next_attempt_dt', 'sent_dt']
+    list_filter = ['status']
+    raw_id_fields = ['emailing', 'contact']
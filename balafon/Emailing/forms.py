@@ -32,6 +32,7 @@ from balafon.Emailing.settings import notify_subscription_on_confirmation
 from balafon.Emailing.utils import (
     create_subscription_action, send_notification_email, get_language, subscribe_contact_to_newsletter
 )
+from balafon.Search.models import ResultSelection
 
 
 class UnregisterForm(BsForm):
@@ -88,7 +89,8 @@ class NewEmailingForm(BsForm):
         initial = kwargs.get('initial')
         initial_contacts = ''
         if initial and 'contacts' in initial:
-            initial_contacts = ';'.join(['{0}'.format(contact.id) for contact in initial['contacts']])
+            # the contacts are stored on the server: the form only keeps the token
+            initial_contacts = ResultSelection.create_for_contacts(initial['contacts']).token
             initial.pop('contacts')
         super(NewEmailingForm, self).__init__(*args, **kwargs)
         if initial_contacts:
@@ -119,10 +121,16 @@ class NewEmailingForm(BsForm):
         else:
             self.fields['from_email'].widget = forms.HiddenInput()
 
+    def clean_contacts(self):
+        """the selection must still exist: they are deleted after a few days. The field is hidden"""
+        value = self.cleaned_data["contacts"]
+        if not ResultSelection.is_valid_value(value):
+            self.add_error(None, ugettext("The selection of contacts has expired. Please search again."))
+        return value
+
     def get_contacts(self):
-        """get the list of contacts stored by ids"""
-        ids = self.cleaned_data["contacts"].split(";")
-        return models.Contact.objects.filter(id__in=ids)
+        """get the list of contacts stored in the selection"""
+        return ResultSelection.get_contacts(self.cleaned_data["contacts"])
 
     def clean_subject(self):
         """subject validation"""
@@ -13,6 +13,14 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('max_nb', type=int, default=20, nargs='?')
+        parser.add_argument(
+            '--chunk-size', type=int, dest='chunk_size', default=None,
+            help='number of emails sent and recorded together (BALAFON_EMAILING_CHUNK_SIZE by default)'
+        )
+        parser.add_argument(
+            '--workers', type=int, dest='workers', default=None,
+            help='number of connections to the mail server (BALAFON_EMAILING_SENDING_WORKERS by default)'
+        )
 
     def handle(self, max_nb, *args, **options):
         # look for emailing to be sent
@@ -27,7 +35,9 @@ class Command(BaseCommand):
             emailing.status = Emailing.STATUS_SENDING
             emailing.save()
             
-            nb_sent = send_newsletter(emailing, max_nb)
+            nb_sent = send_newsletter(
+                emailing, max_nb, chunk_size=options.get('chunk_size'), workers=options.get('workers')
+            )
             
             if verbose:
                 print(nb_sent, "emails sent for emailing", emailing.id)
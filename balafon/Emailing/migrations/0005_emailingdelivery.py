@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Crm', '0036_phone_digits'),
+        ('Emailing', '0004_auto_20190328_1336'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailingDelivery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.IntegerField(choices=[(1, 'Queued'), (2, 'Sending'), (3, 'Sent'), (4, 'Failed')], db_index=True, default=1)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_dt', models.DateTimeField(blank=True, default=None, null=True)),
+                ('sending_dt', models.DateTimeField(blank=True, default=None, null=True)),
+                ('sent_dt', models.DateTimeField(blank=True, default=None, null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('contact', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='Crm.Contact')),
+                ('emailing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='Emailing.Emailing')),
+            ],
+            options={
+                'verbose_name': 'emailing delivery',
+                'verbose_name_plural': 'emailing deliveries',
+                'unique_together': {('emailing', 'contact')},
+            },
+        ),
+    ]
@@ -20,6 +20,7 @@ from django_extensions.db.models import TimeStampedModel
 
 from balafon.Crm.models import Contact, Action, SubscriptionType
 from balafon.Crm.settings import get_language_choices
+from balafon.Crm.signals import actions_bulk_created
 from balafon.Users.models import UserPreferences, Favorite
 
 
@@ -155,6 +156,39 @@ class MagicLink(models.Model):
             return super(MagicLink, self).save()
 
 
+class EmailingDelivery(models.Model):
+    """the delivery of an emailing to a contact: the queue of the emails to send"""
+
+    STATUS_QUEUED = 1
+    STATUS_SENDING = 2
+    STATUS_SENT = 3
+    STATUS_FAILED = 4
+
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, _('Queued')),
+        (STATUS_SENDING, _('Sending')),
+        (STATUS_SENT, _('Sent')),
+        (STATUS_FAILED, _('Failed')),
+    )
+
+    emailing = models.ForeignKey(Emailing, on_delete=models.CASCADE)
+    contact = models.ForeignKey(Contact, on_delete=models.CASCADE)
+    status = models.IntegerField(default=STATUS_QUEUED, choices=STATUS_CHOICES, db_index=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt_dt = models.DateTimeField(blank=True, default=None, null=True)
+    sending_dt = models.DateTimeField(blank=True, default=None, null=True)
+    sent_dt = models.DateTimeField(blank=True, default=None, null=True)
+    last_error = models.TextField(blank=True, default='')
+
+    class Meta:
+        verbose_name = _('emailing delivery')
+        verbose_name_plural = _('emailing deliveries')
+        unique_together = (('emailing', 'contact'), )
+
+    def __str__(self):
+        return "{0} - {1}".format(self.contact, self.get_status_display())
+
+
 def force_message_in_favorites(sender, instance, signal, created, **kwargs):
     """force an action to be in user favorites"""
     action = instance
@@ -168,3 +202,24 @@ def force_message_in_favorites(sender, instance, signal, created, **kwargs):
             )
             
 signals.post_save.connect(force_message_in_favorites, sender=Action)
+
+
+def force_messages_in_favorites(sender, actions, **kwargs):
+    """force the actions created in bulk to be in user favorites: same as post_save in a constant number of queries"""
+    message_actions = [action for action in actions if action.type and action.type.name == ugettext("Message")]
+    if not message_actions:
+        return
+    user_ids = list(UserPreferences.objects.filter(message_in_favorites=True).values_list('user', flat=True))
+    if not user_ids:
+        return
+    content_type = ContentType.objects.get_for_model(Action)
+    Favorite.objects.bulk_create(
+        [
+            Favorite(user_id=user_id, content_type=content_type, object_id=action.id)
+            for user_id in user_ids for action in message_actions
+        ],
+        ignore_conflicts=True
+    )
+
+
+actions_bulk_created.connect(force_messages_in_favorites, sender=Action)
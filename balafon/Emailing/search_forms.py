@@ -5,9 +5,10 @@ from django.db.models import Q
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext as _
 
-import floppyforms.__future__ as forms
+from coop_cms.models import Newsletter
 
 from balafon.Emailing import models
+from balafon.Search.choices_cache import CachedModelChoiceField
 from balafon.Search.forms import SearchFieldForm
 
 
@@ -21,9 +22,9 @@ class EmailingSearchForm(SearchFieldForm):
         queryset = models.Emailing.objects.all()
         if self.allowed_status:
             queryset = queryset.filter(status__in=self.allowed_status)
-        queryset = queryset.order_by("-created", "-id")
+        queryset = queryset.order_by("-created", "-id").select_related('newsletter')
 
-        field = forms.ModelChoiceField(queryset, label=self.label, **kwargs)
+        field = CachedModelChoiceField(queryset, dependencies=(Newsletter, ), label=self.label, **kwargs)
         self._add_field(field)
         
     def _get_emailing(self):
@@ -35,3 +35,28 @@ def get_subscription_form():
     except AttributeError:
         subscribe_form = None
     return subscribe_form
+
+
+def get_sending_chunk_size():
+    """number of emails rendered, sent and recorded together by the newsletter sending"""
+    return getattr(project_settings, 'BALAFON_EMAILING_CHUNK_SIZE', 100)
+
+
+def get_sending_workers():
+    """number of threads sending the newsletter: each of them has its own connection to the mail server"""
+    return getattr(project_settings, 'BALAFON_EMAILING_SENDING_WORKERS', 1)
+
+
+def get_sending_max_attempts():
+    """number of attempts for sending the newsletter to a contact before giving up"""
+    return getattr(project_settings, 'BALAFON_EMAILING_MAX_ATTEMPTS', 3)
+
+
+def get_sending_retry_delay():
+    """seconds before the first retry of a failed email: the delay is doubled after each attempt"""
+    return getattr(project_settings, 'BALAFON_EMAILING_RETRY_DELAY', 300)
+
+
+def get_sending_timeout():
+    """seconds after which an email still marked as being sent is queued again: the scheduler has crashed"""
+    return getattr(project_settings, 'BALAFON_EMAILING_SENDING_TIMEOUT', 3600)
@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
 
+from datetime import datetime
+
 from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+
+from coop_cms.models import Newsletter
+from model_mommy import mommy
 
+from balafon.Crm import models
+from balafon.Emailing.models import Emailing
 from balafon.unit_tests import TestCase
 
 
@@ -16,4 +24,27 @@ class BaseTestCase(TestCase):
         self._login()
 
     def _login(self):
-        return self.client.login(username="toto", password="abc")
\ No newline at end of file
+        return self.client.login(username="toto", password="abc")
+
+class ScheduledEmailingTestCase(BaseTestCase):
+    """an emailing scheduled for now"""
+
+    def setUp(self):
+        super(ScheduledEmailingTestCase, self).setUp()
+        site = Site.objects.get_current()
+        site.domain = "toto.fr"
+        site.save()
+        newsletter = mommy.make(Newsletter, subject="Hello", content="<p>Hello #!-fullname-!#</p>")
+        self.emailing = mommy.make(
+            Emailing,
+            newsletter=newsletter,
+            status=Emailing.STATUS_SCHEDULED,
+            scheduling_dt=datetime.now(),
+            subscription_type=mommy.make(models.SubscriptionType, site=site)
+        )
+
+    def _make_contacts(self, emails):
+        """contacts in the recipients of the emailing"""
+        contacts = [mommy.make(models.Contact, lastname=email, email=email) for email in emails]
+        self.emailing.send_to.add(*contacts)
+        return contacts
@@ -7,6 +7,7 @@ from django.utils.translation import ugettext
 from model_mommy import mommy
 
 from balafon.Crm import models
+from balafon.Crm.utils import create_actions_for_contacts
 from balafon.Emailing.tests import BaseTestCase
 from balafon.Users.models import UserPreferences
 
@@ -31,4 +32,29 @@ class ActionInFavoriteTestCase(BaseTestCase):
         action_type = mommy.make(models.ActionType, name=ugettext("Message"))
         mommy.make(models.Action, type=action_type)
 
-        self.assertEqual(0, user.user_favorite_set.count())
\ No newline at end of file
+        self.assertEqual(0, user.user_favorite_set.count())
+    def test_create_actions_in_bulk_in_favorite(self):
+        user1 = mommy.make(User, is_active=True, is_staff=True, email="toto@toto.fr")
+        mommy.make(UserPreferences, user=user1, message_in_favorites=True)
+        user2 = mommy.make(User, is_active=True, is_staff=True, email="titi@toto.fr")
+        mommy.make(UserPreferences, user=user2, message_in_favorites=False)
+        contacts = [mommy.make(models.Contact, lastname="Contact{0}".format(index)) for index in range(3)]
+
+        action_type = mommy.make(models.ActionType, name=ugettext("Message"))
+        actions = create_actions_for_contacts(contacts, type=action_type, subject="Hello")
+
+        self.assertEqual(
+            sorted(action.id for action in actions),
+            sorted(fav.content_object.id for fav in user1.user_favorite_set.all())
+        )
+        self.assertEqual(0, user2.user_favorite_set.count())
+
+    def test_create_actions_in_bulk_not_in_favorite(self):
+        user = mommy.make(User, is_active=True, is_staff=True, email="toto@toto.fr")
+        mommy.make(UserPreferences, user=user, message_in_favorites=True)
+        contacts = [mommy.make(models.Contact, lastname="Contact{0}".format(index)) for index in range(3)]
+
+        action_type = mommy.make(models.ActionType, name="Call")
+        create_actions_for_contacts(contacts, type=action_type, subject="Hello")
+
+        self.assertEqual(0, user.user_favorite_set.count())
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""the deliveries of an emailing are queued and claimed by the schedulers"""
+
+from datetime import datetime, timedelta
+
+from django.core import mail, management
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from balafon.Emailing.models import Emailing, EmailingDelivery
+from balafon.Emailing.tests import ScheduledEmailingTestCase
+from balafon.Emailing.utils import claim_emailing_deliveries, queue_emailing_deliveries, send_newsletter
+
+
+@override_settings(EMAIL_BACKEND='balafon.Emailing.tests.test_sending_chunks.CountingEmailBackend')
+class EmailingDeliveryQueueTest(ScheduledEmailingTestCase):
+    """the delivery state of each recipient"""
+
+    def _get_delivery(self, contact):
+        """the delivery of the emailing to a contact"""
+        return EmailingDelivery.objects.get(emailing=self.emailing, contact=contact)
+
+    def test_queue_deliveries(self):
+        """a delivery for each contact to be sent"""
+        contacts = self._make_contacts(['contact1@toto.fr', 'contact2@toto.fr'])
+        queue_emailing_deliveries(self.emailing)
+        queue_emailing_deliveries(self.emailing)
+        self.assertEqual(2, EmailingDelivery.objects.filter(emailing=self.emailing).count())
+        for contact in contacts:
+            delivery = self._get_delivery(contact)
+            self.assertEqual(EmailingDelivery.STATUS_QUEUED, delivery.status)
+            self.assertEqual(0, delivery.attempts)
+
+    def test_sent_deliveries(self):
+        """the deliveries are marked as sent"""
+        contacts = self._make_contacts(['contact1@toto.fr', 'contact2@toto.fr'])
+
+        self.assertEqual(2, send_newsletter(self.emailing, 20))
+
+        for contact in contacts:
+            delivery = self._get_delivery(contact)
+            self.assertEqual(EmailingDelivery.STATUS_SENT, delivery.status)
+            self.assertEqual(1, delivery.attempts)
+            self.assertNotEqual(None, delivery.sent_dt)
+        self.assertEqual(0, send_newsletter(self.emailing, 20))
+        self.assertEqual(2, len(mail.outbox))
+
+    def test_claims_dont_overlap(self):
+        """the deliveries claimed by a scheduler are not claimed by another one"""
+        self._make_contacts(['contact{0}@toto.fr'.format(index) for index in range(5)])
+        queue_emailing_deliveries(self.emailing)
+
+        claimed1 = claim_emailing_deliveries(self.emailing, 3)
+        claimed2 = claim_emailing_deliveries(self.emailing, 3)
+
+        self.assertEqual(3, len(claimed1))
+        self.assertEqual(2, len(claimed2))
+        self.assertEqual(set(), set(delivery.id for delivery in claimed1) & set(delivery.id for delivery in claimed2))
+        for delivery in claimed1 + claimed2:
+            self.assertEqual(EmailingDelivery.STATUS_SENDING, delivery.status)
+            self.assertEqual(1, delivery.attempts)
+        self.assertEqual([], claim_emailing_deliveries(self.emailing, 3))
+
+    @override_settings(BALAFON_EMAILING_SENDING_TIMEOUT=60)
+    def test_stale_deliveries(self):
+        """the deliveries being sent for too long are claimed again"""
+        self._make_contacts(['contact1@toto.fr', 'contact2@toto.fr'])
+        queue_emailing_deliveries(self.emailing)
+        claimed = claim_emailing_deliveries(self.emailing, 1)
+        EmailingDelivery.objects.filter(id=claimed[0].id).update(sending_dt=datetime.now() - timedelta(seconds=120))
+
+        self.assertEqual(2, send_newsletter(self.emailing, 20))
+        self.assertEqual(2, len(mail.outbox))
+        self.assertEqual(2, self._get_delivery(claimed[0].contact).attempts)
+
+    def test_contact_removed(self):
+        """a contact removed from the recipients is not sent"""
+        contacts = self._make_contacts(['contact1@toto.fr', 'contact2@toto.fr'])
+        queue_emailing_deliveries(self.emailing)
+        self.emailing.send_to.remove(contacts[0])
+
+        self.assertEqual(1, send_newsletter(self.emailing, 20))
+        self.assertEqual([contacts[1].get_email_address()], [email.to[0] for email in mail.outbox])
+
+    @override_settings(BALAFON_EMAILING_MAX_ATTEMPTS=2, BALAFON_EMAILING_RETRY_DELAY=60)
+    def test_retry_with_backoff(self):
+        """a failed email is queued again later: the contact is given up after the max number of attempts"""
+        contact, failing_contact = self._make_contacts(['contact1@toto.fr', 'fail@toto.fr'])
+
+        self.assertEqual(1, send_newsletter(self.emailing, 20, chunk_size=1))
+        delivery = self._get_delivery(failing_contact)
+        self.assertEqual(EmailingDelivery.STATUS_QUEUED, delivery.status)
+        self.assertEqual(1, delivery.attempts)
+        self.assertTrue('fail@toto.fr' in delivery.last_error)
+        delay = delivery.next_attempt_dt - datetime.now()
+        self.assertTrue(timedelta(seconds=50) < delay <= timedelta(seconds=60))
+        self.assertEqual([failing_contact], list(self.emailing.send_to.all()))
+
+        # not retried before the delay
+        self.assertEqual(0, send_newsletter(self.emailing, 20, chunk_size=1))
+        self.assertEqual(1, self._get_delivery(failing_contact).attempts)
+
+        EmailingDelivery.objects.filter(id=delivery.id).update(next_attempt_dt=datetime.now())
+        self.assertEqual(0, send_newsletter(self.emailing, 20, chunk_size=1))
+        delivery = self._get_delivery(failing_contact)
+        self.assertEqual(EmailingDelivery.STATUS_FAILED, delivery.status)
+        self.assertEqual(2, delivery.attempts)
+        self.assertEqual(0, self.emailing.send_to.count())
+        self.assertEqual([contact], list(self.emailing.sent_to.all()))
+
+    @override_settings(BALAFON_EMAILING_MAX_ATTEMPTS=2, BALAFON_EMAILING_RETRY_DELAY=60)
+    def test_failed_email_in_chunk(self):
+        """the emails sent before and after a refused one are not sent again"""
+        contacts = self._make_contacts(['contact1@toto.fr', 'contact2-fail@toto.fr', 'contact3@toto.fr'])
+
+        self.assertEqual(2, send_newsletter(self.emailing, 20, chunk_size=10))
+        EmailingDelivery.objects.filter(contact=contacts[1]).update(next_attempt_dt=datetime.now())
+        self.assertEqual(0, send_newsletter(self.emailing, 20, chunk_size=10))
+
+        self.assertEqual(
+            sorted([contacts[0].get_email_address(), contacts[2].get_email_address()]),
+            sorted(email.to[0] for email in mail.outbox)
+        )
+        for contact in (contacts[0], contacts[2]):
+            delivery = self._get_delivery(contact)
+            self.assertEqual(EmailingDelivery.STATUS_SENT, delivery.status)
+            self.assertEqual(1, delivery.attempts)
+        self.assertEqual(EmailingDelivery.STATUS_FAILED, self._get_delivery(contacts[1]).status)
+        self.assertEqual(sorted([contacts[0].id, contacts[2].id]), sorted(
+            self.emailing.sent_to.values_list('id', flat=True)
+        ))
+        self.assertEqual(0, self.emailing.send_to.count())
+
+    def test_claimed_by_chunks(self):
+        """the deliveries are claimed just before the sending of their chunk"""
+        self._make_contacts(['contact{0}@toto.fr'.format(index) for index in range(5)])
+
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(5, send_newsletter(self.emailing, 20, chunk_size=2))
+
+        claims = [
+            query for query in context.captured_queries
+            if query['sql'].startswith('UPDATE "Emailing_emailingdelivery" SET "status" = {0}'.format(
+                EmailingDelivery.STATUS_SENDING
+            ))
+        ]
+        self.assertEqual(3, len(claims))
+
+    def test_overlapping_schedulers(self):
+        """each contact receives the emailing once"""
+        self._make_contacts(['contact{0}@toto.fr'.format(index) for index in range(4)])
+        # a scheduler has claimed some deliveries and is still sending them
+        queue_emailing_deliveries(self.emailing)
+        claimed = claim_emailing_deliveries(self.emailing, 2)
+
+        management.call_command('emailing_scheduler', verbosity=0)
+
+        self.assertEqual(2, len(mail.outbox))
+        self.assertEqual(
+            sorted(delivery.contact.get_email_address() for delivery in claimed),
+            sorted(contact.get_email_address() for contact in self.emailing.send_to.all())
+        )
+        self.assertEqual(Emailing.STATUS_SENDING, Emailing.objects.get(id=self.emailing.id).status)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""the magic links of an emailing are loaded or created once"""
+
+from django.contrib.sites.models import Site
+from django.urls import reverse
+
+from coop_cms.models import Newsletter
+from model_mommy import mommy
+
+from balafon.Crm import models
+from balafon.Emailing.models import Emailing, MagicLink
+from balafon.Emailing.tests import BaseTestCase
+from balafon.Emailing.utils import get_magic_links, patch_emailing_html
+
+
+class MagicLinksTest(BaseTestCase):
+    """patch the links of the emailing"""
+
+    def setUp(self):
+        super(MagicLinksTest, self).setUp()
+        site = Site.objects.get_current()
+        site.domain = "toto.fr"
+        site.save()
+        newsletter = mommy.make(Newsletter, subject="Hello", content="Hello")
+        self.emailing = mommy.make(
+            Emailing, newsletter=newsletter, subscription_type=mommy.make(models.SubscriptionType, site=site)
+        )
+
+    def _get_magic_url(self, url, contact):
+        """the magic link of the url for a contact"""
+        magic_link = MagicLink.objects.get(emailing=self.emailing, url=url)
+        return self.emailing.newsletter.get_site_prefix() + reverse(
+            'emailing_view_link', args=[magic_link.uuid, contact.uuid]
+        )
+
+    def test_patch_links(self):
+        """the links are replaced by the magic links: the magic links are created once"""
+        html_text = '<a href="http://toto.fr/a">A</a><a href="http://toto.fr/b">B</a><a href="http://toto.fr/a">A</a>'
+        html_text += '<a href="mailto:me@toto.fr">me</a><a href="#top">top</a>'
+        contact1 = mommy.make(models.Contact)
+        contact2 = mommy.make(models.Contact)
+
+        magic_links = {}
+        patched_html = patch_emailing_html(html_text, self.emailing, contact1, magic_links)
+        self.assertEqual(2, MagicLink.objects.filter(emailing=self.emailing).count())
+        self.assertEqual(['http://toto.fr/a', 'http://toto.fr/b'], sorted(magic_links.keys()))
+        self.assertEqual(2, patched_html.count(self._get_magic_url('http://toto.fr/a', contact1)))
+        self.assertEqual(1, patched_html.count(self._get_magic_url('http://toto.fr/b', contact1)))
+        self.assertTrue('href="mailto:me@toto.fr"' in patched_html)
+        self.assertTrue('href="#top"' in patched_html)
+
+        with self.assertNumQueries(0):
+            patched_html = patch_emailing_html(html_text, self.emailing, contact2, magic_links)
+        self.assertEqual(1, patched_html.count(self._get_magic_url('http://toto.fr/b', contact2)))
+        self.assertEqual(2, MagicLink.objects.filter(emailing=self.emailing).count())
+
+    def test_existing_links(self):
+        """the existing magic links are loaded in one query"""
+        magic_link1 = MagicLink.objects.create(emailing=self.emailing, url="http://toto.fr/a")
+        MagicLink.objects.create(emailing=self.emailing, url="http://toto.fr/a")
+        magic_link2 = MagicLink.objects.create(emailing=self.emailing, url="http://toto.fr/b")
+        with self.assertNumQueries(1):
+            magic_links = get_magic_links(self.emailing, ["http://toto.fr/a", "http://toto.fr/b"])
+        self.assertEqual(
+            {"http://toto.fr/a": str(magic_link1.uuid), "http://toto.fr/b": str(magic_link2.uuid)}, magic_links
+        )
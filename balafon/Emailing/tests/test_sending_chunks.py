@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""the newsletter is sent by chunks over several connections"""
+
+from smtplib import SMTPRecipientsRefused, SMTPServerDisconnected
+
+from django.core import mail, management
+from django.core.mail.backends.locmem import EmailBackend
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from model_mommy import mommy
+
+from balafon.Crm import models
+from balafon.Emailing.models import Emailing
+from balafon.Emailing.tests import ScheduledEmailingTestCase
+from balafon.Emailing.utils import send_newsletter
+
+
+class CountingEmailBackend(EmailBackend):
+    """keeps track of the connections"""
+    connections = []
+
+    def __init__(self, *args, **kwargs):
+        super(CountingEmailBackend, self).__init__(*args, **kwargs)
+        self.opened = 0
+        self.closed = 0
+        self.sent = 0
+        CountingEmailBackend.connections.append(self)
+
+    def open(self):
+        self.opened += 1
+
+    def close(self):
+        self.closed += 1
+
+    def send_messages(self, messages):
+        """like the smtp backend: the messages before an error are sent"""
+        for message in messages:
+            if 'fail' in message.to[0]:
+                raise SMTPRecipientsRefused({message.to[0]: (550, 'refused')})
+            if 'disconnect' in message.to[0]:
+                raise SMTPServerDisconnected('Connection unexpectedly closed')
+            super(CountingEmailBackend, self).send_messages([message])
+            self.sent += 1
+        return len(messages)
+
+
+@override_settings(EMAIL_BACKEND='balafon.Emailing.tests.test_sending_chunks.CountingEmailBackend')
+class SendNewsletterChunksTest(ScheduledEmailingTestCase):
+    """send the newsletter by chunks"""
+
+    def setUp(self):
+        super(SendNewsletterChunksTest, self).setUp()
+        CountingEmailBackend.connections = []
+
+    def _emails(self, contacts):
+        """the emails of the contacts"""
+        return sorted(contact.get_email_address() for contact in contacts)
+
+    def test_send_chunks(self):
+        """every contact is sent and recorded: a connection by worker"""
+        contacts = self._make_contacts(['contact{0}@toto.fr'.format(index) for index in range(7)])
+        contacts.append(mommy.make(models.Contact, lastname="no-email", email=""))
+        self.emailing.send_to.add(contacts[-1])
+
+        nb_sent = send_newsletter(self.emailing, 20, chunk_size=2, workers=2)
+
+        self.assertEqual(7, nb_sent)
+        self.assertEqual(self._emails(contacts[:-1]), sorted(email.to[0] for email in mail.outbox))
+        self.assertEqual(0, self.emailing.send_to.count())
+        self.assertEqual(8, self.emailing.sent_to.count())
+        self.assertEqual(7, models.Action.objects.filter(type__name="Emailing").count())
+
+        connections = CountingEmailBackend.connections
+        self.assertTrue(1 <= len(connections) <= 2)
+        self.assertEqual(7, sum(connection.sent for connection in connections))
+        for connection in connections:
+            self.assertEqual(1, connection.opened)
+            self.assertEqual(1, connection.closed)
+
+    def test_max_nb(self):
+        """only max_nb contacts are sent"""
+        self._make_contacts(['contact{0}@toto.fr'.format(index) for index in range(5)])
+
+        nb_sent = send_newsletter(self.emailing, 3, chunk_size=2, workers=2)
+
+        self.assertEqual(3, nb_sent)
+        self.assertEqual(3, len(mail.outbox))
+        self.assertEqual(2, self.emailing.send_to.count())
+        self.assertEqual(3, self.emailing.sent_to.count())
+
+    def test_failed_email(self):
+        """the other emails of the chunk are recorded: only the failed email is queued again"""
+        self._make_contacts(['contact{0}@toto.fr'.format(index) for index in range(5)] + ['contact1-fail@toto.fr'])
+
+        nb_sent = send_newsletter(self.emailing, 20, chunk_size=3, workers=1)
+
+        self.assertEqual(5, nb_sent)
+        sent_emails = sorted(email.to[0] for email in mail.outbox)
+        self.assertEqual(5, len(sent_emails))
+        self.assertEqual(sent_emails, self._emails(self.emailing.sent_to.all()))
+        self.assertEqual(5, models.Action.objects.filter(type__name="Emailing").count())
+        self.assertEqual(
+            self._emails(models.Contact.objects.filter(email='contact1-fail@toto.fr')),
+            self._emails(self.emailing.send_to.all())
+        )
+        for connection in CountingEmailBackend.connections:
+            self.assertEqual(1, connection.closed)
+
+    def test_reconnect_after_error(self):
+        """the connection of a thread is replaced after an error of the mail server"""
+        self._make_contacts(['contact1@toto.fr', 'contact2-disconnect@toto.fr', 'contact3@toto.fr', 'contact4@toto.fr'])
+
+        nb_sent = send_newsletter(self.emailing, 20, chunk_size=1, workers=1)
+
+        self.assertEqual(3, nb_sent)
+        self.assertEqual(3, len(mail.outbox))
+        connections = CountingEmailBackend.connections
+        self.assertEqual(2, len(connections))
+        self.assertEqual(3, sum(connection.sent for connection in connections))
+        for connection in connections:
+            self.assertEqual(1, connection.opened)
+            self.assertEqual(1, connection.closed)
+
+    def test_bulk_bookkeeping(self):
+        """the actions and the recipients of a chunk are recorded in bulk"""
+        contacts = self._make_contacts(['contact{0}@toto.fr'.format(index) for index in range(10)])
+
+        with CaptureQueriesContext(connection) as context:
+            send_newsletter(self.emailing, 20, chunk_size=5)
+
+        for table in ('Crm_action', 'Crm_action_contacts', 'Emailing_emailing_sent_to'):
+            inserts = [
+                query for query in context.captured_queries
+                if query['sql'].startswith('INSERT INTO "{0}"'.format(table))
+            ]
+            self.assertEqual(2, len(inserts))
+        deletes = [
+            query for query in context.captured_queries
+            if query['sql'].startswith('DELETE FROM "Emailing_emailing_send_to"')
+        ]
+        self.assertEqual(2, len(deletes))
+
+        self.assertEqual(0, self.emailing.send_to.count())
+        self.assertEqual(10, self.emailing.sent_to.count())
+        for contact in contacts:
+            action = models.Action.objects.get(contacts=contact)
+            self.assertEqual("Hello", action.subject)
+            self.assertTrue(contact.lastname in action.detail)
+            self.assertTrue(action.done)
+            self.assertFalse(action.display_on_board)
+            self.assertEqual(self.emailing.scheduling_dt, action.planned_date)
+
+    def test_scheduler_options(self):
+        """the chunks and workers can be set by the command"""
+        self._make_contacts(['contact{0}@toto.fr'.format(index) for index in range(3)])
+
+        management.call_command('emailing_scheduler', verbosity=0, chunk_size=1, workers=3)
+
+        self.assertEqual(3, len(mail.outbox))
+        emailing = Emailing.objects.get(id=self.emailing.id)
+        self.assertEqual(Emailing.STATUS_SENT, emailing.status)
+        self.assertEqual(3, emailing.sent_to.count())
@@ -1,14 +1,24 @@
 # -*- coding: utf-8 -*-
 """utilities"""
 
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import re
+import smtplib
 import sys
+import threading
+import uuid
 
+from bs4 import BeautifulSoup
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.sites.models import Site
 from django.core.mail import get_connection, EmailMessage, EmailMultiAlternatives
+from django.db import transaction
+from django.db.models import F, Q
+from django.template import Context
+from django.template.base import render_value_in_context
 from django.template.loader import get_template
 from django.urls import reverse
 from django.utils import translation
@@ -24,10 +34,14 @@ from balafon.utils import logger
 from balafon.Crm.models import (
     Action, ActionType, Contact, Entity, Subscription, SubscriptionType, EntityType
 )
-from balafon.Emailing.models import Emailing, MagicLink
+from balafon.Crm.utils import BULK_BATCH_SIZE, create_actions_for_contacts
+from balafon.Emailing.models import Emailing, EmailingDelivery, MagicLink
 from balafon.Emailing import settings as emailing_settings
 
 
+HREF_REGEX = 'href="(?P<url>.+?)"'
+
+
 class EmailSendError(Exception):
     """An exception raise when sending email failed"""
     pass
@@ -45,25 +59,43 @@ def format_context(text, data):
     return text.format(**data)
 
 
-def get_emailing_context(emailing, contact):
-    """get context for emailing: user,...."""
+def get_format_data(contact):
+    """the values of the #!-field-!# of a newsletter for a contact"""
     data = dict(contact.__dict__)
     for field in ('gender_name', 'gender_dear', 'city_name', 'entity_name', 'full_address', 'fullname'):
         data[field] = getattr(contact, field)
+    return data
+
+
+def get_emailing_title(subject):
+    """the title of the email: the subject as a single line of text"""
+    return dehtml(subject).replace('\n\n', '\n').replace('\n', ' ')
+
+
+def get_unregister_url(emailing, contact):
+    """url for unsubscribing from the emailing"""
+    return emailing.newsletter.get_site_prefix() + reverse('emailing_unregister', args=[emailing.id, contact.uuid])
+
+
+def get_emailing_context(emailing, contact):
+    """get context for emailing: user,...."""
+    data = get_format_data(contact)
     
     # clone the object: Avoid overwriting {tags} for ever
     newsletter = Newsletter()
     newsletter.__dict__ = dict(emailing.newsletter.__dict__)
     newsletter.subject = format_context(newsletter.subject, data)
+    newsletter.content = format_context(newsletter.content, data)
 
-    html_content = format_context(newsletter.content, data)
+    return _get_emailing_context_dict(
+        emailing, contact, newsletter, get_emailing_title(newsletter.subject), get_unregister_url(emailing, contact)
+    )
 
-    unregister_url = newsletter.get_site_prefix() + reverse('emailing_unregister', args=[emailing.id, contact.uuid])
-    
-    newsletter.content = html_content
 
+def _get_emailing_context_dict(emailing, contact, newsletter, title, unregister_url):
+    """the context of the newsletter template"""
     context_dict = {
-        'title': dehtml(newsletter.subject).replace('\n\n', '\n').replace('\n', ' '),
+        'title': title,
         'newsletter': newsletter,
         'by_email': True,
         'MEDIA_URL': settings.MEDIA_URL,
@@ -83,51 +115,566 @@ def get_emailing_context(emailing, contact):
     return context_dict
 
 
-def patch_emailing_html(html_text, emailing, contact):
-    """transform links into magic link"""
-    links = re.findall('href="(?P<url>.+?)"', html_text)
-
+def _get_not_magic_links(emailing, contact):
+    """the links of the contact which are not turned into magic links"""
     ignore_links = [
         reverse("emailing_unregister", args=[emailing.id, contact.uuid]),
         reverse("emailing_view_online", args=[emailing.id, contact.uuid]),
     ]
-    ignore_prefixes = ['mailto:', 'tel:']
-
     for lang_tuple in settings.LANGUAGES:
         ignore_links.append(
             reverse("emailing_view_online_lang", args=[emailing.id, contact.uuid, lang_tuple[0]])
         )
-
-    for link in links:
-        ignore_link = False
-        for prefix in ignore_prefixes:
-            if link.lower().startswith(prefix):
-                ignore_link = True
-                break
-
-        if (not ignore_link) and (link[0] != "#") and link not in ignore_links:
-            # mailto, internal links, 'unregister' and 'view online' are not magic
+    return ignore_links
+
+
+def _is_magic_link(link, ignore_links):
+    """mailto, internal links, 'unregister' and 'view online' are not magic"""
+    if link[0] == "#" or link in ignore_links:
+        return False
+    return not any(link.lower().startswith(prefix) for prefix in ('mailto:', 'tel:'))
+
+
+def get_magic_links(emailing, urls, magic_links=None):
+    """
+    returns a dict {url: uuid of the magic link} for the urls of the emailing: the missing magic links are created.
+    magic_links is the dict of the magic links already known: it is completed and returned
+    """
+    if magic_links is None:
+        magic_links = {}
+    missing_urls = set(urls) - set(magic_links.keys())
+    if missing_urls:
+        existing_links = MagicLink.objects.filter(emailing=emailing, url__in=missing_urls).order_by('id')
+        for url, link_uuid in existing_links.values_list('url', 'uuid'):
+            magic_links.setdefault(url, link_uuid)
+        for url in sorted(missing_urls - set(magic_links.keys())):
+            magic_links[url] = '{0}'.format(MagicLink.objects.create(emailing=emailing, url=url).uuid)
+    return magic_links
+
+
+def patch_emailing_html(html_text, emailing, contact, magic_links=None):
+    """
+    transform links into magic link.
+    magic_links is a dict {url: uuid} of the magic links of the emailing: the missing ones are loaded or created.
+    The links are replaced in a single pass
+    """
+    ignore_links = _get_not_magic_links(emailing, contact)
+    urls = set()
+    for link in set(re.findall(HREF_REGEX, html_text)):
+        if _is_magic_link(link, ignore_links):
             if len(link) < 500:
-
-                magic_links = MagicLink.objects.filter(emailing=emailing, url=link)
-                if magic_links.count() == 0:
-                    magic_link = MagicLink.objects.create(emailing=emailing, url=link)
-                else:
-                    magic_link = magic_links[0]
-
-                view_magic_link_url = reverse('emailing_view_link', args=[magic_link.uuid, contact.uuid])
-                magic_url = emailing.newsletter.get_site_prefix() + view_magic_link_url
-                html_text = html_text.replace('href="{0}"'.format(link), 'href="{0}"'.format(magic_url))
+                urls.add(link)
             else:
                 if 'test' not in sys.argv:
                     logger.warning(
                         "magic link size is greater than 500 ({0}) : {1}".format(len(link), link)
                     )
-    return html_text
+    if not urls:
+        return html_text
+
+    magic_links = get_magic_links(emailing, urls, magic_links)
+    site_prefix = emailing.newsletter.get_site_prefix()
+
+    def get_magic_href(match):
+        link = match.group('url')
+        if link not in urls:
+            return match.group(0)
+        view_magic_link_url = reverse('emailing_view_link', args=[magic_links[link], contact.uuid])
+        return 'href="{0}"'.format(site_prefix + view_magic_link_url)
+
+    return re.sub(HREF_REGEX, get_magic_href, html_text)
+
+
+def render_newsletter_email(emailing, contact, magic_links=None):
+    """
+    render the newsletter for a contact.
+    returns the subject, the html, the text and the text of the email (with a max length for the lines).
+    magic_links is the dict of the magic links of the emailing (see patch_emailing_html)
+    """
+    context = get_emailing_context(emailing, contact)
+    context["LANGUAGE_CODE"] = get_language()
+    the_template = get_template(emailing.newsletter.get_template_name())
+
+    html_text = the_template.render(context)
+
+    html_text = patch_emailing_html(html_text, emailing, contact, magic_links)
+
+    html_text = make_links_absolute(
+        html_text, emailing.newsletter, site_prefix=emailing.get_domain_url_prefix()
+    )
+
+    text = dehtml(html_text)
+    html_text = force_line_max_length(html_text, max_length_per_line=400, dont_cut_in_quotes=True)
+    return context['title'], html_text, text, force_line_max_length(text)
+
+
+class _SkeletonText(str):
+    """a text of the skeleton context which depends on the contact: the subject, the unsubscribe url..."""
+
+    def __new__(cls, skeleton, path):
+        text = str.__new__(cls, skeleton.get_marker(path, escape=False))
+        text.escaped_marker = skeleton.get_marker(path, escape=True)
+        return text
+
+    def __html__(self):
+        return self.escaped_marker
+
+
+class _SkeletonValue(object):
+    """
+    the contact (or one of its attributes) in the skeleton context: it is rendered as a marker.
+    The skeleton can not be used if the template makes a test or a comparison on a value of the contact
+    """
+
+    def __init__(self, skeleton, path):
+        self._skeleton = skeleton
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._skeleton.get_value(self._path + (name, ))
+
+    def __str__(self):
+        return self._skeleton.get_marker(self._path, escape=False)
+
+    def __html__(self):
+        return self._skeleton.get_marker(self._path, escape=True)
+
+    def _depends_on_contact(self):
+        """the result depends on the contact"""
+        self._skeleton.is_valid = False
+
+    def __bool__(self):
+        # a contact is always set but its attributes may be empty
+        if len(self._path) > 1:
+            self._depends_on_contact()
+        return True
+
+    def __eq__(self, other):
+        self._depends_on_contact()
+        return False
+
+    def __ne__(self, other):
+        self._depends_on_contact()
+        return True
+
+    __hash__ = object.__hash__
+
+    def __lt__(self, other):
+        self._depends_on_contact()
+        return False
+
+    __le__ = __gt__ = __ge__ = __lt__
+
+    def __len__(self):
+        self._depends_on_contact()
+        return 0
+
+    def __iter__(self):
+        self._depends_on_contact()
+        return iter([])
+
+    def __contains__(self, item):
+        self._depends_on_contact()
+        return False
+
+
+class NewsletterSkeleton(object):
+    """
+    the newsletter of an emailing rendered once for a language: the template rendering, the magic links,
+    the absolute links and the html to text conversion are done once. The values depending on the contact
+    (#!-field-!#, contact attributes, unsubscribe url...) are rendered as markers which are replaced for each contact.
+    is_valid is False if the template uses the values of the contact in a way which can't be replaced later
+    (a test, a filter, a link...): the newsletter must be rendered for each contact in this case
+    """
+    marker_prefix = 'BfSk'
+
+    def __init__(self, emailing, magic_links=None):
+        self.emailing = emailing
+        self.magic_links = {} if magic_links is None else magic_links
+        self.is_valid = True
+        self._token = self.marker_prefix + uuid.uuid4().hex[:12]
+        self._marker_regex = re.compile(self._token + r'X(\d+)([ER])')
+        self._paths = []
+        self._indexes = {}
+        self._raw_indexes = set()
+        self._values = {}
+        self._html_lines = []
+        self._text = ''
+        self._text_lines = []
+        self._raw_context = Context(autoescape=False)
+        self._escape_context = Context(autoescape=True)
+        self._render()
+
+    def get_marker(self, path, escape):
+        """the marker of a value: the escaped marker is used if the value is escaped by the template"""
+        if path not in self._indexes:
+            self._indexes[path] = len(self._paths)
+            self._paths.append(path)
+        if not escape:
+            self._raw_indexes.add(self._indexes[path])
+        return '{0}X{1}{2}'.format(self._token, self._indexes[path], 'E' if escape else 'R')
+
+    def get_value(self, path):
+        """the value of a contact attribute in the skeleton context"""
+        if path not in self._values:
+            self._values[path] = _SkeletonValue(self, path)
+        return self._values[path]
+
+    def _format_markers(self, text):
+        """replace the #!-field-!# of a text by markers"""
+        return re.sub(
+            r'#!-(?P<field>.+?)-!#',
+            lambda match: self.get_marker(('format', match.group(0)), escape=False),
+            text
+        )
+
+    def _has_broken_markers(self, text):
+        """True if some markers have been modified by the template (a filter for example)"""
+        return len(re.findall(self._token, text, re.IGNORECASE)) != len(self._marker_regex.findall(text))
+
+    def _split_lines(self, text, **kwargs):
+        """
+        the lines of the text: the lines without marker have their final length.
+        The length of the other lines is forced after the replacement of the markers
+        """
+        return [
+            (True, line) if self._token in line else (False, force_line_max_length(line, **kwargs))
+            for line in text.split("\n")
+        ]
+
+    def _render(self):
+        """render the newsletter with the markers"""
+        emailing = self.emailing
+        contact = self.get_value(('contact', ))
+
+        newsletter = Newsletter()
+        newsletter.__dict__ = dict(emailing.newsletter.__dict__)
+        newsletter.subject = _SkeletonText(self, ('subject', ))
+        newsletter.content = self._format_markers(newsletter.content)
+
+        context = _get_emailing_context_dict(
+            emailing, contact, newsletter, _SkeletonText(self, ('title', )),
+            _SkeletonText(self, ('unregister_url', ))
+        )
+        context["LANGUAGE_CODE"] = get_language()
+        html_text = get_template(emailing.newsletter.get_template_name()).render(context)
+        if not self.is_valid or self._has_broken_markers(html_text):
+            self.is_valid = False
+            return
+
+        # The links depending on the contact would be a different magic link for each contact
+        ignore_links = _get_not_magic_links(emailing, contact)
+        for link in re.findall(HREF_REGEX, html_text):
+            if self._token in link and link not in ignore_links:
+                self.is_valid = False
+                return
+
+        html_text = patch_emailing_html(html_text, emailing, contact, self.magic_links)
+        html_text = make_links_absolute(
+            html_text, emailing.newsletter, site_prefix=emailing.get_domain_url_prefix()
+        )
+        self._html_lines = self._split_lines(html_text, max_length_per_line=400, dont_cut_in_quotes=True)
+        self._text = dehtml(html_text)
+        self._text_lines = self._split_lines(self._text)
+
+    def _get_values(self, contact):
+        """
+        the title and the values of the markers for a contact.
+        returns None if a value not escaped by the template contains html: it changes the html structure
+        """
+        data = get_format_data(contact)
+        title = get_emailing_title(format_context(self.emailing.newsletter.subject, data))
+        values = []
+        for index, path in enumerate(self._paths):
+            if path[0] == 'contact':
+                value = contact
+                try:
+                    for name in path[1:]:
+                        value = getattr(value, name)
+                        if callable(value) and not getattr(value, 'do_not_call_in_templates', False):
+                            value = value()
+                except Exception:  # pylint: disable=broad-except
+                    # like a template: an invalid variable is empty
+                    value = ''
+            elif path[0] == 'format':
+                value = format_context(path[1], data)
+            elif path[0] == 'subject':
+                value = format_context(self.emailing.newsletter.subject, data)
+            elif path[0] == 'title':
+                value = title
+            else:
+                value = get_unregister_url(self.emailing, contact)
+            raw = render_value_in_context(value, self._raw_context)
+            if '<' in raw and index in self._raw_indexes:
+                return None
+            escaped = render_value_in_context(value, self._escape_context)
+            values.append({
+                'R': self._as_parsed_html(raw),
+                'E': self._as_parsed_html(escaped),
+                # the spaces are collapsed by the html to text conversion
+                'text': re.sub(r'[ \t\r\n]+', ' ', raw),
+            })
+        return title, values
+
+    @staticmethod
+    def _as_parsed_html(value):
+        """the value as written by make_links_absolute: the html entities are normalized by BeautifulSoup"""
+        if '&' in value or '<' in value or '>' in value:
+            return str(BeautifulSoup(value, 'html.parser'))
+        return value
+
+    def _replace_markers(self, text, values, as_text=False):
+        """replace the markers by the values of a contact"""
+        if as_text:
+            return self._marker_regex.sub(lambda match: values[int(match.group(1))]['text'], text)
+        return self._marker_regex.sub(lambda match: values[int(match.group(1))][match.group(2)], text)
+
+    def _join_lines(self, lines, values, as_text=False, **kwargs):
+        """the text of the lines for a contact"""
+        return "\n".join(
+            force_line_max_length(self._replace_markers(line, values, as_text), **kwargs) if has_markers else line
+            for has_markers, line in lines
+        )
+
+    def render(self, contact):
+        """returns the subject, the html, the text and the text of the email for a contact"""
+        title_and_values = self._get_values(contact)
+        if title_and_values is None:
+            return render_newsletter_email(self.emailing, contact, self.magic_links)
+        title, values = title_and_values
+        html_text = self._join_lines(self._html_lines, values, max_length_per_line=400, dont_cut_in_quotes=True)
+        text = self._replace_markers(self._text, values, as_text=True)
+        return title, html_text, text, self._join_lines(self._text_lines, values, as_text=True)
+
+
+class NewsletterSender(object):
+    """
+    sends the emails of a newsletter by chunks over a pool of threads.
+    Each thread opens its own connection to the mail server once and keeps it until the sender is closed
+    or until an error of the mail server: the next chunk of the thread opens a new connection
+    """
+
+    def __init__(self, workers=None):
+        self.workers = max(1, workers or emailing_settings.get_sending_workers())
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _get_connection(self):
+        """the connection of the current thread"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = get_connection()
+            # An opened connection is not closed by send_messages
+            connection.open()
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def _drop_connection(self):
+        """close the connection of the current thread: it may be unusable after an error"""
+        connection = self._local.connection
+        self._local.connection = None
+        with self._lock:
+            self._connections.remove(connection)
+        try:
+            connection.close()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    def _send_messages(self, emails):
+        """
+        send the emails one by one: called by the threads of the pool.
+        returns the error of each email: None if it has been sent
+        """
+        errors = []
+        for email in emails:
+            try:
+                connection = self._get_connection()
+            except (smtplib.SMTPException, OSError) as err:
+                # the mail server can not be reached: the next emails are not sent
+                return errors + [err] * (len(emails) - len(errors))
+            try:
+                connection.send_messages([email])
+            except (smtplib.SMTPException, OSError) as err:
+                # the session is reset by smtplib when the recipient is refused: the connection can be used again
+                if not isinstance(err, smtplib.SMTPRecipientsRefused):
+                    self._drop_connection()
+                errors.append(err)
+            except Exception as err:  # pylint: disable=broad-except
+                # an error of the email itself (invalid header...)
+                errors.append(err)
+            else:
+                errors.append(None)
+        return errors
+
+    def submit(self, emails):
+        """send the emails in the background: returns a future of the list of errors (None if sent)"""
+        return self._executor.submit(self._send_messages, emails)
 
+    def close(self):
+        """wait for the emails being sent and close the connections"""
+        self._executor.shutdown(wait=True)
+        for connection in self._connections:
+            connection.close()
+        self._connections = []
 
-def send_newsletter(emailing, max_nb):
-    """send newsletter"""
+
+def get_newsletter_email(emailing, contact, from_email, title, html_text, email_text):
+    """the email of the newsletter for a contact"""
+    list_unsubscribe_url = emailing.get_domain_url_prefix() + reverse(
+        "emailing_unregister", args=[emailing.id, contact.uuid]
+    )
+    list_unsubscribe_email = getattr(settings, 'COOP_CMS_REPLY_TO', '') or from_email
+    headers = {
+        "List-Unsubscribe": "<{0}>, <mailto:{1}?subject=unsubscribe>".format(
+            list_unsubscribe_url, list_unsubscribe_email
+        )
+    }
+
+    if getattr(settings, 'COOP_CMS_REPLY_TO', None):
+        headers['Reply-To'] = settings.COOP_CMS_REPLY_TO
+
+    email = EmailMultiAlternatives(
+        title,
+        email_text,
+        from_email,
+        [contact.get_email_address()],
+        headers=headers
+    )
+    email.attach_alternative(html_text, "text/html")
+    return email
+
+
+def queue_emailing_deliveries(emailing):
+    """create the missing deliveries of the contacts to be sent: a contact added again is queued again"""
+    contacts = emailing.send_to.all()
+    EmailingDelivery.objects.filter(
+        emailing=emailing, contact__in=contacts,
+        status__in=(EmailingDelivery.STATUS_SENT, EmailingDelivery.STATUS_FAILED)
+    ).update(status=EmailingDelivery.STATUS_QUEUED, attempts=0, next_attempt_dt=None, last_error='')
+    queued_contacts = EmailingDelivery.objects.filter(emailing=emailing).values('contact_id')
+    EmailingDelivery.objects.bulk_create(
+        [
+            EmailingDelivery(emailing=emailing, contact_id=contact_id)
+            for contact_id in contacts.exclude(id__in=queued_contacts).values_list('id', flat=True)
+        ],
+        batch_size=BULK_BATCH_SIZE, ignore_conflicts=True
+    )
+
+
+def claim_emailing_deliveries(emailing, max_nb):
+    """
+    mark the next deliveries of the emailing as being sent and return them.
+    The rows are locked while claimed: the ones locked by another scheduler are skipped.
+    The deliveries being sent for too long are claimed again: their scheduler has probably crashed
+    """
+    now = datetime.now()
+    stale_dt = now - timedelta(seconds=emailing_settings.get_sending_timeout())
+    with transaction.atomic():
+        delivery_ids = list(
+            EmailingDelivery.objects.select_for_update(skip_locked=True).filter(
+                Q(status=EmailingDelivery.STATUS_QUEUED, next_attempt_dt__isnull=True) |
+                Q(status=EmailingDelivery.STATUS_QUEUED, next_attempt_dt__lte=now) |
+                Q(status=EmailingDelivery.STATUS_SENDING, sending_dt__lt=stale_dt),
+                emailing=emailing,
+                contact__in=emailing.send_to.all()
+            ).order_by('id').values_list('id', flat=True)[:max_nb]
+        )
+        # send_newsletter claims the deliveries chunk by chunk: the sending date is when the chunk is sent
+        EmailingDelivery.objects.filter(id__in=delivery_ids).update(
+            status=EmailingDelivery.STATUS_SENDING, sending_dt=now, attempts=F('attempts') + 1
+        )
+    return list(EmailingDelivery.objects.filter(id__in=delivery_ids).select_related('contact').order_by('id'))
+
+
+def _record_newsletter_chunk(emailing, emailing_action_type, chunk):
+    """
+    record the sent emails of a chunk in a transaction.
+    The chunk is a list of (delivery, title, text, email): the email is None if the contact has no address
+    """
+    sent = [(delivery.contact, title, text) for (delivery, title, text, email) in chunk if email is not None]
+    contacts = [delivery.contact for (delivery, title, text, email) in chunk]
+    with transaction.atomic():
+        # an action by contact: the subject and the detail are the ones of the email of the contact
+        create_actions_for_contacts(
+            [contact for (contact, title, text) in sent],
+            per_contact_fields=[{'subject': title, 'detail': text} for (contact, title, text) in sent],
+            planned_date=emailing.scheduling_dt, type=emailing_action_type, done=True,
+            display_on_board=False, done_date=datetime.now()
+        )
+        EmailingDelivery.objects.filter(id__in=[delivery.id for (delivery, title, text, email) in chunk]).update(
+            status=EmailingDelivery.STATUS_SENT, sent_dt=datetime.now(), last_error=''
+        )
+        # the contacts are moved from send_to to sent_to in a few queries
+        emailing.send_to.remove(*contacts)
+        emailing.sent_to.add(*contacts)
+
+
+def _retry_newsletter_deliveries(emailing, failed):
+    """
+    queue again the deliveries which couldn't be sent: the delay is doubled after each attempt.
+    The contacts are removed from the recipients once the max number of attempts is reached.
+    failed is a list of (delivery, error)
+    """
+    max_attempts = emailing_settings.get_sending_max_attempts()
+    retry_delay = emailing_settings.get_sending_retry_delay()
+    now = datetime.now()
+    given_up = []
+    with transaction.atomic():
+        for delivery, error in failed:
+            last_error = '{0}'.format(error)
+            if delivery.attempts >= max_attempts:
+                given_up.append(delivery.contact)
+                EmailingDelivery.objects.filter(id=delivery.id).update(
+                    status=EmailingDelivery.STATUS_FAILED, last_error=last_error
+                )
+            else:
+                EmailingDelivery.objects.filter(id=delivery.id).update(
+                    status=EmailingDelivery.STATUS_QUEUED, last_error=last_error,
+                    next_attempt_dt=now + timedelta(seconds=retry_delay * 2 ** (delivery.attempts - 1))
+                )
+            if 'test' not in sys.argv:
+                logger.warning(
+                    "emailing {0}: email to {1} not sent (attempt {2}): {3}".format(
+                        emailing.id, delivery.contact_id, delivery.attempts, last_error
+                    )
+                )
+        if given_up:
+            emailing.send_to.remove(*given_up)
+
+
+def _end_newsletter_chunk(emailing, emailing_action_type, chunk, future):
+    """
+    wait for the emails of a chunk: each of them is recorded if sent or queued again.
+    returns the number of sent emails
+    """
+    error = future.exception()
+    if error is not None:
+        # unexpected error of the sending thread: the emails are considered as not sent
+        errors = [error] * len(chunk)
+    else:
+        emails_errors = iter(future.result())
+        errors = [next(emails_errors) if email is not None else None for (delivery, title, text, email) in chunk]
+    sent = [entry for (entry, entry_error) in zip(chunk, errors) if entry_error is None]
+    failed = [(entry[0], entry_error) for (entry, entry_error) in zip(chunk, errors) if entry_error is not None]
+    if sent:
+        _record_newsletter_chunk(emailing, emailing_action_type, sent)
+    if failed:
+        _retry_newsletter_deliveries(emailing, failed)
+    return len([entry for entry in sent if entry[3] is not None])
+
+
+def send_newsletter(emailing, max_nb, chunk_size=None, workers=None):
+    """
+    send newsletter: the contacts are queued and the emails are rendered and sent by chunks.
+    The deliveries of each chunk are claimed before being sent: several schedulers can send the same emailing.
+    Each email is recorded once sent or queued again if it couldn't be sent
+    """
 
     # Create automatically an action type for logging one action by contact
     emailing_action_type = ActionType.objects.get_or_create(name=_('Emailing'))[0]
@@ -136,72 +683,77 @@ def send_newsletter(emailing, max_nb):
     emailing.newsletter.content = make_links_absolute(
         emailing.newsletter.content, emailing.newsletter, site_prefix=emailing.get_domain_url_prefix()
     )
-    
-    connection = get_connection()
+
+    chunk_size = max(1, chunk_size or emailing_settings.get_sending_chunk_size())
     from_email = emailing.from_email or settings.COOP_CMS_FROM_EMAIL
-    emails = []
-    
-    contacts = list(emailing.send_to.all()[:max_nb])
-    for contact in contacts:
-        
-        if contact.get_email:
-            lang = emailing.lang or contact.favorite_language or settings.LANGUAGE_CODE[:2]
-            translation.activate(lang)
-
-            emailing_context = get_emailing_context(emailing, contact)
-            emailing_context["LANGUAGE_CODE"] = lang
-            context = emailing_context
-            the_template = get_template(emailing.newsletter.get_template_name())
-
-            html_text = the_template.render(context)
-
-            html_text = patch_emailing_html(html_text, emailing, contact)
-
-            html_text = make_links_absolute(
-                html_text, emailing.newsletter, site_prefix=emailing.get_domain_url_prefix()
-            )
-            
-            text = dehtml(html_text)
-            list_unsubscribe_url = emailing.get_domain_url_prefix() + reverse(
-                "emailing_unregister", args=[emailing.id, contact.uuid]
-            )
-            list_unsubscribe_email = getattr(settings, 'COOP_CMS_REPLY_TO', '') or from_email
-            headers = {
-                "List-Unsubscribe": "<{0}>, <mailto:{1}?subject=unsubscribe>".format(
-                    list_unsubscribe_url, list_unsubscribe_email
-                )
-            }
-
-            if getattr(settings, 'COOP_CMS_REPLY_TO', None):
-                headers['Reply-To'] = settings.COOP_CMS_REPLY_TO
-
-            email = EmailMultiAlternatives(
-                context['title'],
-                force_line_max_length(text),
-                from_email,
-                [contact.get_email_address()],
-                headers=headers
-            )
-            html_text = force_line_max_length(html_text, max_length_per_line=400, dont_cut_in_quotes=True)
-            email.attach_alternative(html_text, "text/html")
-            emails.append(email)
-            
-            # create action
-            action = Action.objects.create(
-                subject=context['title'], planned_date=emailing.scheduling_dt,
-                type=emailing_action_type, detail=text, done=True,
-                display_on_board=False, done_date=datetime.now()
-            )
-            action.contacts.add(contact)
-            action.save()
-            
-        # print contact, "processed"
-        emailing.send_to.remove(contact)
-        emailing.sent_to.add(contact)
-    
-    emailing.save()
-    nb_sent = connection.send_messages(emails)
-    return nb_sent or 0
+    # The newsletter is rendered once by language if possible
+    skeletons = {}
+    # The magic links are loaded or created once: {url: uuid}
+    magic_links = {}
+
+    queue_emailing_deliveries(emailing)
+    sender = NewsletterSender(workers)
+    # The chunks being sent: a chunk is rendered while the previous ones are sent
+    pending_chunks = deque()
+    nb_sent = 0
+    nb_claimed = 0
+    try:
+        while nb_claimed < max_nb:
+            # claimed just before being sent: the deliveries are not seen as stale by the other schedulers
+            deliveries = claim_emailing_deliveries(emailing, min(chunk_size, max_nb - nb_claimed))
+            if not deliveries:
+                break
+            nb_claimed += len(deliveries)
+
+            chunk, emails = [], []
+            for delivery in deliveries:
+                contact = delivery.contact
+
+                if not contact.get_email:
+                    chunk.append((delivery, None, None, None))
+                    continue
+
+                lang = emailing.lang or contact.favorite_language or settings.LANGUAGE_CODE[:2]
+                translation.activate(lang)
+
+                if lang not in skeletons:
+                    skeleton = NewsletterSkeleton(emailing, magic_links)
+                    # the skeleton is checked with the first contact
+                    rendered_email = render_newsletter_email(emailing, contact, magic_links)
+                    if not skeleton.is_valid or skeleton.render(contact) != rendered_email:
+                        skeleton = None
+                    skeletons[lang] = skeleton
+                elif skeletons[lang] is not None:
+                    rendered_email = skeletons[lang].render(contact)
+                else:
+                    rendered_email = render_newsletter_email(emailing, contact, magic_links)
+                title, html_text, text, email_text = rendered_email
+
+                email = get_newsletter_email(emailing, contact, from_email, title, html_text, email_text)
+                chunk.append((delivery, title, text, email))
+                emails.append(email)
+
+            pending_chunks.append((chunk, sender.submit(emails)))
+
+            # back-pressure: wait for the oldest chunk when all the workers are busy
+            while len(pending_chunks) > sender.workers:
+                nb_sent += _end_newsletter_chunk(emailing, emailing_action_type, *pending_chunks.popleft())
+
+        while pending_chunks:
+            nb_sent += _end_newsletter_chunk(emailing, emailing_action_type, *pending_chunks.popleft())
+
+    except Exception:
+        # The chunks being sent must be recorded: the claimed deliveries of the failed chunk are sent again
+        # after the timeout
+        while pending_chunks:
+            _end_newsletter_chunk(emailing, emailing_action_type, *pending_chunks.popleft())
+        raise
+
+    finally:
+        sender.close()
+        emailing.save()
+
+    return nb_sent
 
 
 def create_subscription_action(contact, subscriptions):
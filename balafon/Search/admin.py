@@ -10,15 +10,8 @@ class SearchAdmin(admin.ModelAdmin):
     pass
 
 
-@admin.register(models.SearchGroup)
-class SearchGroupAdmin(admin.ModelAdmin):
-    list_display = ['name', 'search']
-    search_fields = ['name', 'search']
-    raw_id_admin = ('search',)
-
-
-@admin.register(models.SearchField)
-class SearchFieldAdmin(admin.ModelAdmin):
-    list_display = ['field', 'search_group', 'value']
-    search_fields = ['field', 'field__group__search']
-    raw_id_admin = ('search_group',)
+@admin.register(models.ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'export_type', 'status', 'progress', 'total', 'created']
+    list_filter = ['export_type', 'status']
+    raw_id_admin = ('user',)
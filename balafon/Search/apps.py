@@ -10,3 +10,8 @@ from django.utils.translation import ugettext_lazy as _
 class BalafonAppConfig(AppConfig):
     name = 'balafon.Search'
     verbose_name = _("Balafon Search")
+
+    def ready(self):
+        """build the registry of the search field forms once"""
+        from balafon.Search.forms import get_field_forms
+        get_field_forms()
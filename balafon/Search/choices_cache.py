@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+cache of the choices of the search fields (groups of users, zones, action types...).
+The choices are kept in the process for each language. They are loaded again when one of the models they depend on
+has been modified: a version of each model is kept in the django cache and changed by the post_save and post_delete
+signals. The versions are seen by all the processes only if BALAFON_SEARCH_CACHE is a shared cache (memcached,
+redis...): the choices are also loaded again after BALAFON_SEARCH_CHOICES_TIMEOUT seconds.
+The fields check in the database a value missing from the cached choices: an object created by another process
+is accepted before being listed.
+"""
+
+from collections import OrderedDict
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.translation import get_language
+
+import floppyforms.__future__ as forms
+
+
+EMPTY_LABEL = "---------"
+
+# Max number of choices kept in the process: the least recently used are removed
+MAX_ENTRIES = 200
+
+_CHOICES = OrderedDict()
+
+
+def _get_cache():
+    """the django cache used for the versions"""
+    return caches[getattr(settings, 'BALAFON_SEARCH_CACHE', 'default')]
+
+
+def get_timeout():
+    """number of seconds the choices are kept in the process"""
+    return getattr(settings, 'BALAFON_SEARCH_CHOICES_TIMEOUT', 60)
+
+
+def _get_version_key(model):
+    """key of the version of a model"""
+    return 'balafon_search_choices_version_{0}'.format(model._meta.label_lower)
+
+
+def get_cached(key, dependencies, load):
+    """
+    returns the value of load(): it is called only the first time, after the timeout or if one of the models
+    of dependencies has been saved or deleted since then. The value is kept for each language
+    """
+    key = (get_language(), key)
+    cache = _get_cache()
+    version_keys = [_get_version_key(model) for model in dependencies]
+    cached_versions = cache.get_many(version_keys)
+    for version_key in version_keys:
+        if version_key not in cached_versions:
+            # A random value: the choices loaded before the eviction of a version can not be used again
+            cached_versions[version_key] = uuid.uuid4().hex
+            cache.set(version_key, cached_versions[version_key], None)
+    versions = tuple(cached_versions[version_key] for version_key in version_keys)
+    now = time.time()
+    if key in _CHOICES:
+        cached_for_versions, expires, value = _CHOICES[key]
+        if cached_for_versions == versions and expires > now:
+            _CHOICES.move_to_end(key)
+            return value
+    value = load()
+    _CHOICES[key] = (versions, now + get_timeout(), value)
+    _CHOICES.move_to_end(key)
+    while len(_CHOICES) > MAX_ENTRIES:
+        _CHOICES.popitem(last=False)
+    return value
+
+
+def clear_choices():
+    """remove the choices kept in the process"""
+    _CHOICES.clear()
+
+
+def get_queryset_choices(queryset, label_field='', empty_label=EMPTY_LABEL, dependencies=()):
+    """
+    the choices of a select for the objects of a queryset (like a ModelChoiceField): the label is the label_field
+    attribute or the object itself. The queryset model and dependencies are the models which invalidate the choices
+    """
+    def load():
+        choices = [('', empty_label)] if empty_label is not None else []
+        return choices + [
+            ('{0}'.format(obj.id), '{0}'.format(getattr(obj, label_field) if label_field else obj))
+            for obj in queryset
+        ]
+    key = 'queryset-{0}-{1}-{2}'.format(queryset.query, label_field, empty_label)
+    return get_cached(key, (queryset.model, ) + tuple(dependencies), load)
+
+
+def invalidate_choices(sender, **kwargs):
+    """signal receiver: the choices depending on the sender model must be loaded again"""
+    _get_cache().set(_get_version_key(sender), uuid.uuid4().hex, None)
+
+
+class CachedChoicesMixin(object):
+    """the choices of a queryset are cached: a value which is not in the choices is checked in the database"""
+
+    def __init__(self, queryset, label_field='', empty_label=EMPTY_LABEL, dependencies=(), **kwargs):
+        self.queryset = queryset
+        kwargs['choices'] = get_queryset_choices(queryset, label_field, empty_label, dependencies)
+        super(CachedChoicesMixin, self).__init__(**kwargs)
+
+    def valid_value(self, value):
+        """the choices may not have been loaded again yet if the object has been created by another process"""
+        if super(CachedChoicesMixin, self).valid_value(value):
+            return True
+        return '{0}'.format(value).isdigit() and self.queryset.filter(pk=value).exists()
+
+
+class CachedModelChoiceField(CachedChoicesMixin, forms.ChoiceField):
+    """a select of the objects of a queryset with cached choices"""
+
+
+class CachedModelMultipleChoiceField(CachedChoicesMixin, forms.MultipleChoiceField):
+    """a multiple select of the objects of a queryset with cached choices"""
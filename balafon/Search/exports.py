@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""export of the search results: used by the views and by the export jobs"""
+
+import csv
+import json
+import tempfile
+import traceback
+from datetime import datetime
+
+from django.conf import settings
+from django.core.files import File
+from django.db.models import prefetch_related_objects
+from django.template.loader import get_template
+from django.utils.datastructures import MultiValueDict
+from django.utils.translation import ugettext as _
+
+import xlwt
+
+from balafon.Crm.models import Contact, CustomField, load_custom_fields
+from balafon.Search.forms import PdfTemplateForm, SearchForm
+from balafon.Search.models import ExportJob
+from balafon.utils import logger
+
+
+EXPORT_CHUNK_SIZE = 500
+
+
+def get_export_fields():
+    """returns the fields of the contacts to export, their header and the names of the exported custom fields"""
+    fields = [
+        'id', 'get_gender_text', 'lastname', 'firstname', 'title', 'get_entity_name', 'job', 'role',
+        'get_address', 'get_address2', 'get_address3', 'get_zip_code', 'get_cedex', 'get_city',
+        'get_foreign_country', 'mobile', 'get_phone', 'get_email', 'birth_date', 'favorite_language'
+    ]
+
+    # create a map of verbose name for each field
+    field_dict = dict([(field.name, _(field.verbose_name).capitalize()) for field in Contact._meta.fields])
+    field_dict['foreign_country'] = _("Country")
+    field_dict['entity_name'] = _("Entity")
+
+    # Add custom fields
+    custom_field_names = []
+    for cf in CustomField.objects.filter(export_order__gt=0).order_by('export_order'):
+        custom_field_names.append(cf.name)
+        if cf.model == CustomField.MODEL_CONTACT:
+            fields.append('custom_field_'+cf.name)
+            field_dict['custom_field_'+cf.name] = cf.label
+        elif cf.model == CustomField.MODEL_ENTITY:
+            fields.append('entity_custom_field_'+cf.name)
+            field_dict['entity_custom_field_'+cf.name] = cf.label
+
+    header = []
+    for field in fields:
+        if field[:4] == 'get_':
+            field = field[4:]
+            if field[-8:] == '_display':
+                field = field[:-8]
+        # print the verbose name if exists, the field name if not
+        header.append(field_dict.get(field, field))
+
+    return fields, header, custom_field_names
+
+
+def get_export_value(contact, field_name):
+    """the value of a field of contact as exported"""
+    field = getattr(contact, field_name)
+
+    if field_name == 'role':
+        field = ", ".join([r.name for r in field.all()])
+
+    elif callable(field):
+        field = field()
+
+    return '{0}'.format(field) if field else ''
+
+
+def get_chunks(iterable, size):
+    """split an iterable in lists of size elements"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_export_contacts_count(search_form):
+    """number of contacts to export"""
+    queryset = search_form.get_queryset()
+    if queryset is None:
+        return len(search_form.get_contacts())
+    return queryset.count()
+
+
+def iter_export_contacts(search_form, custom_field_names):
+    """
+    iterate on the contacts to export by chunks: the contacts are not all loaded in memory
+    The roles and custom fields of a chunk are loaded at once
+    """
+    queryset = search_form.get_queryset()
+    if queryset is None:
+        # The search can't be compiled in the database
+        contacts = search_form.get_contacts()
+        if not search_form.contacts_display:
+            # if the form already has a sort criteria: don't sort again
+            contacts.sort(key=lambda x: "{0}-{1}-{2}".format(x.entity, x.lastname, x.firstname))
+        chunks = (contacts[index:index + EXPORT_CHUNK_SIZE] for index in range(0, len(contacts), EXPORT_CHUNK_SIZE))
+    else:
+        if not search_form.contacts_display:
+            queryset = queryset.order_by('entity__name', 'lastname', 'firstname', 'id')
+        contacts = queryset.select_related('entity', 'entity__city', 'city').iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        chunks = get_chunks(contacts, EXPORT_CHUNK_SIZE)
+
+    for chunk in chunks:
+        prefetch_related_objects(chunk, 'role')
+        load_custom_fields(chunk, custom_field_names)
+        for contact in chunk:
+            yield contact
+
+
+def write_excel(search_form, output, on_progress=None):
+    """write the contacts of the search as an excel document in output"""
+    fields, header, custom_field_names = get_export_fields()
+
+    # create the excel document
+    workbook = xlwt.Workbook()
+    worksheet = workbook.add_sheet('balafon')
+
+    # header
+    header_style = xlwt.easyxf('font: bold 1; pattern: pattern solid, fore-colour gray25;')
+    for index, value in enumerate(header):
+        worksheet.write(0, index, value, header_style)
+
+    style = xlwt.Style.default_style
+    for index, contact in enumerate(iter_export_contacts(search_form, custom_field_names)):
+        for index2, field_name in enumerate(fields):
+            value = get_export_value(contact, field_name)
+            if value:
+                worksheet.write(index+1, index2, value, style)
+        if on_progress and (index + 1) % EXPORT_CHUNK_SIZE == 0:
+            on_progress(index + 1)
+
+    workbook.save(output)
+
+
+def write_csv(search_form, output, on_progress=None):
+    """write the contacts of the search as csv lines in output (a text file)"""
+    fields, header, custom_field_names = get_export_fields()
+    writer = csv.writer(output)
+    writer.writerow(header)
+    for index, contact in enumerate(iter_export_contacts(search_form, custom_field_names)):
+        writer.writerow([get_export_value(contact, field_name) for field_name in fields])
+        if on_progress and (index + 1) % EXPORT_CHUNK_SIZE == 0:
+            on_progress(index + 1)
+
+
+def get_pdf_cmd_options(template_name):
+    """the wkhtmltopdf options for a template"""
+    pdf_options = getattr(settings, 'BALAFON_PDF_OPTIONS', None)
+    if pdf_options is None:
+        return {'margin-top': 0, 'margin-bottom': 0, 'margin-right': 0, 'margin-left': 0, }
+    return pdf_options.get(template_name, {})
+
+
+def get_pdf_context(form):
+    """the context of the pdf template for a valid PdfTemplateForm"""
+    context = {
+        "contacts": form.get_contacts(),
+        "search_dict": json.loads(form.cleaned_data['search_dict']),
+    }
+    return form.patch_context(context)
+
+
+def create_export_job(user, export_type, search_data=None, options=None):
+    """
+    create an export job: search_data and options are the posted data (QueryDict) of the search form and of the
+    pdf form. They are stored as json and posted again to the forms by the job
+    """
+    return ExportJob.objects.create(
+        user=user,
+        export_type=export_type,
+        search_data=json.dumps(dict(search_data.lists())) if search_data else '',
+        options=json.dumps(dict(options.lists())) if options else '',
+    )
+
+
+def _write_pdf(job, output):
+    """write the pdf of the job in output"""
+    # wkhtmltopdf is only imported by the worker
+    from wkhtmltopdf.utils import render_pdf_from_template
+
+    form = PdfTemplateForm(MultiValueDict(json.loads(job.options)))
+    if not form.is_valid():
+        raise ValueError('{0}'.format(form.errors))
+    template_name = form.cleaned_data['template']
+    context = get_pdf_context(form)
+    ExportJob.objects.filter(id=job.id).update(total=len(context['contacts']))
+    content = render_pdf_from_template(
+        get_template(template_name), None, None, context, cmd_options=get_pdf_cmd_options(template_name)
+    )
+    output.write(content)
+
+
+def run_export_job(job):
+    """generate the file of a job. The progress is saved while the job is running"""
+    def on_progress(progress):
+        ExportJob.objects.filter(id=job.id).update(progress=progress)
+
+    try:
+        if job.export_type == ExportJob.TYPE_PDF:
+            output = tempfile.TemporaryFile()
+            _write_pdf(job, output)
+        else:
+            search_form = SearchForm(MultiValueDict(json.loads(job.search_data)))
+            if not search_form.is_valid():
+                raise ValueError('{0}'.format(search_form.errors))
+            job.total = get_export_contacts_count(search_form)
+            ExportJob.objects.filter(id=job.id).update(total=job.total)
+            if job.export_type == ExportJob.TYPE_CSV:
+                output = tempfile.TemporaryFile(mode='w+', encoding='utf-8', newline='')
+                write_csv(search_form, output, on_progress)
+            else:
+                output = tempfile.TemporaryFile()
+                write_excel(search_form, output, on_progress)
+    except Exception as msg:
+        logger.exception("export job #{0}".format(job.id))
+        job.status = ExportJob.STATUS_FAILED
+        job.error = '{0}\n{1}'.format(msg, traceback.format_exc())
+    else:
+        output.seek(0)
+        job.result.save(job.get_filename(), File(output), save=False)
+        output.close()
+        job.refresh_from_db(fields=['total'])
+        job.progress = job.total
+        job.status = ExportJob.STATUS_DONE
+    job.ended_dt = datetime.now()
+    job.save()
+    return job
@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 """forms"""
 
+from contextlib import contextmanager
 from datetime import date, datetime, time
 from itertools import chain
 import importlib
 import json
 
-from django.db.models import Q
+from django.db.models import Count, Prefetch, Q
+from django.db.models.functions import Lower
 from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
@@ -21,15 +23,20 @@ import floppyforms.__future__ as forms
 from coop_cms.bs_forms import Form as BsForm
 
 from balafon.fields import HidableModelMultipleChoiceField
-from balafon.Crm.models import Contact, Action, Group, Subscription, SubscriptionType
+from balafon.Crm.models import Contact, Action, Entity, Group, Subscription, SubscriptionType
 from balafon.Crm.widgets import OpportunityAutoComplete
-from balafon.Crm.utils import sort_by_entity_callback
-from balafon.Search import models
+from balafon.Crm.utils import sort_by_entity_callback, sort_by_entity_ordering
+from balafon.Search import models, results_cache
 from balafon.Search.widgets import DatespanInput
-from balafon.Search.utils import get_date_bounds
+from balafon.Search.utils import get_contacts_by_ids, get_date_bounds
 
 SEARCH_FORMS = None
 
+# The search field forms by name and the choices of the FieldChoiceForm: built once from SEARCH_FORMS
+FIELD_FORMS = None
+
+FIELD_CHOICES = None
+
 
 def load_from_name(constant_full_name):
     """load module dynamically"""
@@ -55,13 +62,38 @@ def get_search_forms():
     return SEARCH_FORMS
 
 
+def get_field_forms():
+    """the registry of the search field forms: dict by name"""
+    global FIELD_FORMS  #pylint: disable=global-statement
+    if FIELD_FORMS is None:
+        FIELD_FORMS = dict(
+            [(_form.name, _form) for (cat, forms_) in get_search_forms() for _form in forms_ if _form]
+        )
+    return FIELD_FORMS
+
+
 def get_field_form(field):
     """get field form"""
-    _forms = []
-    for cat_and_form in get_search_forms():
-        _forms.extend(cat_and_form[1])
-    field_dict = dict([(_form.name, _form) for _form in _forms if _form])
-    return field_dict[field]
+    return get_field_forms()[field]
+
+
+def get_field_choices():
+    """the filters which can be added to a search: url of the field and label grouped by category"""
+    global FIELD_CHOICES  #pylint: disable=global-statement
+    if FIELD_CHOICES is None:
+        choices = [('', [('', '')])]
+        for (cat, forms_) in get_search_forms():
+            choices.append(
+                (
+                    cat,
+                    [
+                        (reverse('search_get_field', args=[form.name]), form.label)
+                        for form in forms_ if form
+                    ]
+                )
+            )
+        FIELD_CHOICES = choices
+    return FIELD_CHOICES
 
 
 class GroupedSelect(forms.Select):
@@ -132,17 +164,7 @@ class FieldChoiceForm(forms.Form):
     
     def __init__(self, *args, **kwargs):
         super(FieldChoiceForm, self).__init__(*args, **kwargs)
-        choices = [('', [('', '')])]
-        for (cat, forms_) in get_search_forms():
-            choices.append(
-                (
-                    cat,
-                    [
-                        (reverse('search_get_field', args=[form.name]), form.label)
-                        for form in forms_ if form
-                    ]
-                )
-            )
+        choices = get_field_choices()
         widget = GroupedSelect(attrs={
             'class': 'form-control half-width',
             'data-placeholder': _(u'Please select a filter'),
@@ -174,24 +196,19 @@ class SearchForm(forms.Form):
             'chosen/chosen.jquery.js',
         )
 
-    def __init__(self, data=None, instance=None, save=False, *args, **kwargs):
+    def __init__(self, data=None, instance=None, save=False, profiler=None, *args, **kwargs):
         super(SearchForm, self).__init__(data=data, *args, **kwargs)
         self._forms = {}
         self._instance = instance
         self._save = save
+        self._profiler = profiler
+        self._union_queryset = None
         self.contacts_display = False
         self.contains_refuse_newsletter = set()
         if instance:
             self.fields['name'].initial = instance.name
         if not data and instance:
-            data = {}
-            for group in instance.searchgroup_set.all():
-                for search_field in group.searchfield_set.all():
-                    key = '-_-'.join((group.name, search_field.field, str(search_field.count or len(data))))
-                    if search_field.is_list:
-                        data[key] = self._str_to_list(search_field.value)
-                    else:
-                        data[key] = search_field.value
+            data = instance.get_search_data()
 
         if data:
             for key in data:
@@ -226,33 +243,6 @@ class SearchForm(forms.Form):
         """number of fields"""
         return sum([len(f) for f in self._forms])
     
-    def _str_to_list(self, str_value):
-        """convert string to list"""
-        def _split_unicode(unicode_str):
-            """remove trailing ' " from string"""
-            unicode_str0 = unicode_str
-            try:
-                if unicode_str[:2] in ("u'", 'u"'):
-                    unicode_str = unicode_str[2:]
-                elif unicode_str[0] in ("'", '"'):
-                    unicode_str = unicode_str[1:]
-                
-                if unicode_str[-1] in ("'", '"'):
-                    unicode_str = unicode_str[:-1]
-            except IndexError:
-                return unicode_str0
-            return unicode_str
-            
-        if str_value[0] == '[' and str_value[-1] == ']':
-            # remove [ and ]
-            values = str_value[1:-1]
-            # get things separated by ', '
-            values = values.split(", ")
-            values = [value for value in values]
-            values = [_split_unicode(value) for value in values]
-            return values
-        return []
-    
     def serialize(self):
         """serialize the form for json"""
         data = {}
@@ -293,18 +283,14 @@ class SearchForm(forms.Form):
     
     def save_search(self):
         """save search"""
-        self._instance.searchgroup_set.all().delete()
         self._instance.name = self.cleaned_data['name']
+        self._instance.set_definition(
+            dict(
+                (key, [{'field': form.name, 'count': form.count, 'value': form.value} for form in the_forms])
+                for key, the_forms in self._forms.items()
+            )
+        )
         self._instance.save()
-        keys = self._forms.keys()
-        for key in keys:
-            group = models.SearchGroup.objects.create(name=key, search=self._instance)
-            for form in self._forms[key]:
-                field = models.SearchField.objects.create(
-                    search_group=group, field=form.name, value=form.value, count=form.count)
-                if form.multi_values:
-                    field.is_list = True
-                    field.save()
         return self._instance
     
     def clean_excluded(self):
@@ -326,89 +312,242 @@ class SearchForm(forms.Form):
                     return False
         return True
     
-    def _get_contacts(self):
-        """get contacts"""
-        keys = list(self._forms.keys())
-        keys.sort()
-        contacts = set([])
-        global_post_processors = []
-        self.contains_refuse_newsletter = set()
-        has_sort_forms = False
-
-        for key in keys:
-            post_processors = []
-            contacts_set = Contact.objects.all()
-            actions_set = Action.objects.all()
-            exclude_actions_set = Action.objects.all()
-            has_action_forms = False
-            has_exclude_action_forms = False
-
-            if not ('secondary_contact' in [form.name for form in self._forms[key]]):
-                contacts_set = contacts_set.filter(main_contact=True)
-            
-            for form in self._forms[key]:
-
-                if form.is_sort_form:
-                    has_sort_forms = True
-
+    @contextmanager
+    def _profile(self, block, form_name, step):
+        """measure a step of the search if a profiler is set: yields the profile entry or None"""
+        if self._profiler is None:
+            yield None
+        else:
+            with self._profiler.measure(block, form_name, step) as entry:
+                yield entry
+
+    def _count_rows(self, entry, results):
+        """set the rows of a profile entry"""
+        if entry is not None:
+            self._profiler.count_rows(entry, results)
+
+    def _get_block_queryset(self, key):
+        """returns the queryset of the contacts matching every filter of a block"""
+        with self._profile(key, '', 'block') as block_entry:
+            contacts_set = self._build_block_queryset(key)
+        self._count_rows(block_entry, contacts_set)
+        return contacts_set
+
+    def _build_block_queryset(self, key):
+        """build the queryset of a block"""
+        post_processors = []
+        contacts_set = Contact.objects.all()
+        actions_set = Action.objects.all()
+        exclude_actions_set = Action.objects.all()
+        has_action_forms = False
+        has_exclude_action_forms = False
+
+        if not ('secondary_contact' in [form.name for form in self._forms[key]]):
+            contacts_set = contacts_set.filter(main_contact=True)
+
+        for form in self._forms[key]:
+            with self._profile(key, form.name, 'get_queryset') as entry:
                 if not form.is_action_form:
-                    contacts_set = form.get_queryset(contacts_set)
+                    contacts_set = form_queryset = form.get_queryset(contacts_set)
                 else:
                     if form.is_exclude_action_form:
                         has_exclude_action_forms = True
-                        exclude_actions_set = form.get_queryset(exclude_actions_set)
+                        exclude_actions_set = form_queryset = form.get_queryset(exclude_actions_set)
                     else:
                         has_action_forms = True
-                        actions_set = form.get_queryset(actions_set)
+                        actions_set = form_queryset = form.get_queryset(actions_set)
+            self._count_rows(entry, form_queryset)
 
-                if hasattr(form, 'post_process'):
-                    post_processors.append(form.post_process)
-                    
-                if hasattr(form, 'global_post_process'):
-                    global_post_processors.append(form.global_post_process)
-
-            if has_action_forms:
-                contacts_set = contacts_set.filter(
-                    Q(action__in=actions_set) | Q(entity__action__in=actions_set)
-                ).distinct()
-
-            if has_exclude_action_forms:
-                contacts_set = contacts_set.exclude(
-                    Q(action__in=exclude_actions_set) | Q(entity__action__in=exclude_actions_set)
-                ).distinct()
-
-            for post_processor in post_processors:
-                contacts_set = post_processor(contacts_set)
-                
-            contacts = contacts.union(set(contacts_set))
-        
-        for global_post_processor in global_post_processors:
-            contacts = global_post_processor(contacts)
+            if hasattr(form, 'post_process'):
+                post_processors.append(form)
+
+        if has_action_forms:
+            contacts_set = contacts_set.filter(
+                Q(action__in=actions_set) | Q(entity__action__in=actions_set)
+            ).distinct()
+
+        if has_exclude_action_forms:
+            contacts_set = contacts_set.exclude(
+                Q(action__in=exclude_actions_set) | Q(entity__action__in=exclude_actions_set)
+            ).distinct()
+
+        for form in post_processors:
+            with self._profile(key, form.name, 'post_process') as entry:
+                contacts_set = form.post_process(contacts_set)
+            self._count_rows(entry, contacts_set)
+
+        return contacts_set
+
+    def _get_global_forms(self):
+        """returns the forms which need to process the whole results"""
+        keys = list(self._forms.keys())
+        keys.sort()
+        return [
+            form for key in keys for form in self._forms[key] if hasattr(form, 'global_post_process')
+        ]
+
+    def _get_union_queryset(self):
+        """
+        returns the union of all blocks as a single queryset.
+        Each block is compiled as a subquery: the database makes the union and removes duplicates.
+        It is built once: the filters of the blocks are only called (and profiled) one time
+        """
+        if self._union_queryset is not None:
+            return self._union_queryset
+        keys = list(self._forms.keys())
+        keys.sort()
+        union_lookup = None
+        for key in keys:
+            block_lookup = Q(id__in=self._get_block_queryset(key).values('id'))
+            union_lookup = block_lookup if union_lookup is None else (union_lookup | block_lookup)
+        if union_lookup is None:
+            self._union_queryset = Contact.objects.none()
+        else:
+            self._union_queryset = Contact.objects.filter(union_lookup)
+        return self._union_queryset
+
+    def _get_compiled_queryset(self):
+        """
+        returns the union of the blocks filtered by the global forms in the database.
+        returns None if a global filter can only be applied in Python
+        """
+        queryset = self._get_union_queryset()
+        for form in self._get_global_forms():
+            get_global_queryset = getattr(form, 'get_global_queryset', None)
+            if get_global_queryset is None:
+                return None
+            with self._profile('', form.name, 'get_global_queryset') as entry:
+                queryset = get_global_queryset(queryset)
+            if queryset is None:
+                return None
+            self._count_rows(entry, queryset)
+        return queryset
+
+    def get_queryset(self):
+        """
+        returns the search results as a single queryset: blocks, global filters, excluded contacts and
+        sort are compiled in one query. It makes possible to count and paginate the results in the database.
+        returns None if a global filter can only be applied in Python: use get_contacts in this case
+        """
+        queryset = self._get_compiled_queryset()
+        if queryset is None:
+            return None
+
+        excluded_ids = self.cleaned_data.get('excluded')
+        if excluded_ids:
+            queryset = queryset.exclude(id__in=excluded_ids)
+
+        if not self._include_contacts_who_left():
+            queryset = queryset.filter(has_left=False)
 
         # By default sort by entity
-        if not has_sort_forms:
+        if not self._has_sort_forms():
+            queryset = queryset.order_by(*sort_by_entity_ordering())
+
+        return queryset.select_related('entity')
+
+    def get_entities_queryset(self):
+        """
+        database version of get_contacts_by_entity: returns a lazy queryset of the entities sorted by name,
+        the number of contacts and True if some entities are empty.
+        The contacts of the entities (search_contacts) are only loaded for the evaluated entities:
+        for example the current page. returns None if a global filter can only be applied in Python
+        """
+        queryset = self._get_compiled_queryset()
+        if queryset is None:
+            return None
+
+        contacts_queryset = queryset
+        if not self._include_contacts_who_left():
+            contacts_queryset = contacts_queryset.filter(has_left=False)
+
+        entities = Entity.all_objects.filter(id__in=queryset.values('entity_id'))
+        has_empty_entities = entities.exclude(id__in=contacts_queryset.values('entity_id')).exists()
+
+        search_contacts = contacts_queryset.select_related('entity', 'city').order_by(Lower('lastname'), 'id')
+        entities = entities.order_by('name', 'id').prefetch_related(
+            Prefetch('contact_set', queryset=search_contacts, to_attr='search_contacts')
+        )
+        return entities, contacts_queryset.count(), has_empty_entities
+
+    def get_refuse_newsletter(self, contacts_queryset):
+        """
+        returns the names of the subscription types refused by at least one of the contacts:
+        no subscription or subscription not accepted. The number of queries doesn't depend on the contacts count
+        """
+        current_site = Site.objects.get_current()
+        subscription_types = SubscriptionType.objects.filter(
+            Q(site=current_site) | Q(allowed_on_sites=current_site)
+        ).distinct()
+        names = dict(subscription_types.values_list('id', 'name'))
+        if not names:
+            return set()
+        contacts_count = contacts_queryset.count()
+        if not contacts_count:
+            return set()
+        accepted_counts = dict(
+            Subscription.objects.filter(
+                contact__in=contacts_queryset.values('id'), subscription_type__in=list(names.keys()),
+                accept_subscription=True
+            ).values('subscription_type').annotate(
+                contacts_count=Count('contact', distinct=True)
+            ).values_list('subscription_type', 'contacts_count')
+        )
+        return set(
+            name for (type_id, name) in names.items() if accepted_counts.get(type_id, 0) < contacts_count
+        )
+
+    def _get_contacts(self):
+        """get contacts: the results are kept in cache for the next actions on the same search"""
+        search_data = self.serialize()
+        cached_results = results_cache.get_results(search_data)
+        if cached_results is not None:
+            contact_ids, refuse_newsletter = cached_results
+            self.contains_refuse_newsletter = set(refuse_newsletter)
+            return get_contacts_by_ids(contact_ids)
+
+        contacts = self._compute_contacts()
+        results_cache.set_results(
+            search_data, [contact.id for contact in contacts], self.contains_refuse_newsletter
+        )
+        return contacts
+
+    def _compute_contacts(self):
+        """get contacts from the database"""
+        union_queryset = self._get_union_queryset()
+        contacts = set(union_queryset.select_related('entity'))
+        global_forms = self._get_global_forms()
+
+        for form in global_forms:
+            with self._profile('', form.name, 'global_post_process') as entry:
+                contacts = form.global_post_process(contacts)
+            self._count_rows(entry, contacts)
+
+        # By default sort by entity
+        if not self._has_sort_forms():
             contacts = sorted(contacts, key=sort_by_entity_callback)
 
         # Just for compatibility
-        current_site = Site.objects.get_current()
-        queryset = SubscriptionType.objects.filter(Q(site=current_site) | Q(allowed_on_sites=current_site))
-        if queryset.count():
-            for contact in contacts:
-                for subscription_type in queryset:
-                    try:
-                        if not contact.subscription_set.get(subscription_type=subscription_type).accept_subscription:
-                            self.contains_refuse_newsletter.add(subscription_type.name)
-                            break
-                    except Subscription.DoesNotExist:
-                        self.contains_refuse_newsletter.add(subscription_type.name)
-                        break
-                
+        if global_forms:
+            refuse_queryset = Contact.objects.filter(id__in=[contact.id for contact in contacts])
+        else:
+            refuse_queryset = union_queryset
+        self.contains_refuse_newsletter = self.get_refuse_newsletter(refuse_queryset)
+
         return list(contacts)
-    
+
+    def _has_sort_forms(self):
+        """True if the results are sorted by one of the forms"""
+        return any(form.is_sort_form for form in chain.from_iterable(self._forms.values()))
+
+    def _include_contacts_who_left(self):
+        """True if the contacts who left must be kept in the results"""
+        form_names = [form.name for form in chain.from_iterable(self._forms.values())]
+        return 'contact_has_left' in form_names
+
     def _get_filter_func(self):
         """filter function"""
-        form_names = [form.name for form in chain.from_iterable(self._forms.values())]
-        if 'contact_has_left' in form_names:
+        if self._include_contacts_who_left():
             return lambda contact: contact
         return lambda contact: contact and (not contact.has_left)
 
@@ -427,12 +566,12 @@ class SearchForm(forms.Form):
                 empty_entities[entity.id] = entity
             if pass_filter:
                 entities[entity.id][1].append(contact)
-                entities[entity.id][1].sort(key=lambda c: c.lastname.lower())
                 empty_entities.pop(entity.id, None)
                 contacts_count += 1
             
         results = []
         for entity, contacts in entities.values():
+            contacts.sort(key=lambda c: c.lastname.lower())
             entity.search_contacts = contacts
             if entity.id in empty_entities:
                 setattr(entity, 'is_empty', True)
@@ -627,11 +766,11 @@ class SearchActionBaseMixin(object):
     Example : Pdf, CreateActions...
     """
     def _pre_init(self, *args, **kwargs):
-        """at the beginning of __init__"""
+        """at the beginning of __init__: the contacts are stored on the server. The form only keeps the token"""
         initial = kwargs.get('initial')
         initial_contacts = ''
         if initial and 'contacts' in initial:
-            initial_contacts = ';'.join(['{0}'.format(contact.id) for contact in initial['contacts']])
+            initial_contacts = models.ResultSelection.create_for_contacts(initial['contacts']).token
             initial.pop('contacts')
         return initial_contacts
         
@@ -640,17 +779,16 @@ class SearchActionBaseMixin(object):
         if initial_contacts:
             self.fields['contacts'].initial = initial_contacts
 
+    def clean_contacts(self):
+        """the selection must still exist: they are deleted after a few days. The field is hidden"""
+        value = self.cleaned_data["contacts"]
+        if not models.ResultSelection.is_valid_value(value):
+            self.add_error(None, _("The selection of contacts has expired. Please search again."))
+        return value
+
     def get_contacts(self):
         """get contacts"""
-        ids = self.cleaned_data["contacts"].split(";")
-        contacts = Contact.objects.filter(id__in=ids)
-        contact_by_ids = {}
-        for contact in contacts:
-            contact_by_ids['{0}'.format(contact.id)] = contact
-        ordered_contacts = []
-        for contact_id in ids:
-            ordered_contacts.append(contact_by_ids[contact_id])
-        return ordered_contacts
+        return models.ResultSelection.get_contacts(self.cleaned_data["contacts"])
 
 
 class SearchActionForm(BsForm, SearchActionBaseMixin):
@@ -687,6 +825,10 @@ class SubscribeContactsAdminForm(SearchActionForm):
 class PdfTemplateForm(SearchActionForm):
     """Form for Pdf generation"""
     search_dict = forms.CharField(widget=forms.HiddenInput())
+    in_background = forms.BooleanField(
+        label=_('Generate in background'), required=False,
+        help_text=_('Recommended for many contacts: the file will be available in the export jobs')
+    )
     
     def __init__(self, *args, **kwargs):
         super(PdfTemplateForm, self).__init__(*args, **kwargs)
@@ -735,12 +877,12 @@ class PdfTemplateForm(SearchActionForm):
         These values are passed to the template
         """
         extra_data = dict(self.cleaned_data)
-        for field in ('template', 'contacts', 'search_dict'):
+        for field in ('template', 'contacts', 'search_dict', 'in_background'):
             extra_data.pop(field)
         return extra_data
         
         
-class ActionForContactsForm(forms.ModelForm):
+class ActionForContactsForm(forms.ModelForm, SearchActionBaseMixin):
     """Create action for contacts"""
     date = forms.DateField(label=_("planned date"), required=False, widget=forms.TextInput())
     time = forms.TimeField(label=_("planned time"), required=False)
@@ -754,23 +896,13 @@ class ActionForContactsForm(forms.ModelForm):
         )
         
     def __init__(self, *args, **kwargs):
-        initial = kwargs.get('initial')
-        initial_contacts = ''
-        if initial and 'contacts' in initial:
-            initial_contacts = ';'.join(['{0}'.format(c.id) for c in initial['contacts']])
-            initial.pop('contacts')
+        initial_contacts = self._pre_init(*args, **kwargs)
         super(ActionForContactsForm, self).__init__(*args, **kwargs)
-        if initial_contacts:
-            self.fields['contacts'].initial = initial_contacts
+        self._post_init(initial_contacts)
         self.fields['opportunity'].widget = OpportunityAutoComplete(
             attrs={'placeholder': _('Enter the name of an opportunity'), 'size': '80', 'class': 'colorbox'}
         )
         
-    def get_contacts(self):
-        """return contacts"""
-        contact_ids = self.cleaned_data["contacts"].split(";")
-        return Contact.objects.filter(id__in=contact_ids)
-        
     def clean_planned_date(self):
         """validate planned date"""
         the_date = self.cleaned_data["date"]
@@ -780,7 +912,7 @@ class ActionForContactsForm(forms.ModelForm):
         return None
 
 
-class GroupForContactsForm(forms.Form):
+class GroupForContactsForm(forms.Form, SearchActionBaseMixin):
     """Add contacts to group"""
     contacts = forms.CharField(widget=forms.HiddenInput())
     groups = HidableModelMultipleChoiceField(queryset=Group.objects.all())
@@ -801,14 +933,9 @@ class GroupForContactsForm(forms.Form):
         )
         
     def __init__(self, *args, **kwargs):
-        initial = kwargs.get('initial')
-        initial_contacts = ''
-        if initial and 'contacts' in initial:
-            initial_contacts = ';'.join(['{0}'.format(contact.id) for contact in initial['contacts']])
-            initial.pop('contacts')
+        initial_contacts = self._pre_init(*args, **kwargs)
         super(GroupForContactsForm, self).__init__(*args, **kwargs)
-        if initial_contacts:
-            self.fields['contacts'].initial = initial_contacts
+        self._post_init(initial_contacts)
     
         self.fields['groups'].widget.attrs = {
             'class': 'chzn-select',
@@ -817,11 +944,6 @@ class GroupForContactsForm(forms.Form):
         }
         self.fields['groups'].help_text = ''
 
-    def get_contacts(self):
-        """get contacts"""
-        contact_ids = self.cleaned_data["contacts"].split(";")
-        return Contact.objects.filter(id__in=contact_ids)
-
 
 class SearchNameForm(forms.Form):
     """Save search form"""
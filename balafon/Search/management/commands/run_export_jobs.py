@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+
+from balafon.Search.exports import run_export_job
+from balafon.Search.models import ExportJob
+
+
+class Command(BaseCommand):
+    help = "generate the files of the pending export jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('max_nb', type=int, default=5, nargs='?')
+
+    def handle(self, max_nb, *args, **options):
+        verbose = options.get('verbosity', 0)
+
+        pending_jobs = ExportJob.objects.filter(status=ExportJob.STATUS_PENDING).order_by('created', 'id')
+        for job_id in list(pending_jobs.values_list('id', flat=True)[:max_nb]):
+            # take the job only if it has not been taken by another worker in the meantime
+            is_taken = ExportJob.objects.filter(id=job_id, status=ExportJob.STATUS_PENDING).update(
+                status=ExportJob.STATUS_RUNNING, started_dt=datetime.now()
+            )
+            if not is_taken:
+                continue
+
+            job = run_export_job(ExportJob.objects.get(id=job_id))
+            if verbose:
+                print("export job", job.id, job.get_status_display())
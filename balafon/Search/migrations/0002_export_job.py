@@ -0,0 +1,42 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:57
+
+import balafon.Search.models
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('Search', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('export_type', models.IntegerField(choices=[(1, 'Excel'), (2, 'CSV'), (3, 'PDF')], verbose_name='type')),
+                ('status', models.IntegerField(choices=[(1, 'Pending'), (2, 'In progress'), (3, 'Done'), (4, 'Failed')], default=1, verbose_name='status')),
+                ('search_data', models.TextField(blank=True, default='', help_text='The posted search form as json')),
+                ('options', models.TextField(blank=True, default='', help_text='The posted pdf form as json')),
+                ('progress', models.IntegerField(default=0)),
+                ('total', models.IntegerField(default=0)),
+                ('result', models.FileField(blank=True, default='', upload_to=balafon.Search.models._get_export_job_dir, verbose_name='result')),
+                ('error', models.TextField(blank=True, default='')),
+                ('started_dt', models.DateTimeField(blank=True, default=None, null=True, verbose_name='start date')),
+                ('ended_dt', models.DateTimeField(blank=True, default=None, null=True, verbose_name='end date')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'export job',
+                'verbose_name_plural': 'export jobs',
+                'ordering': ['-created'],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Search', '0002_export_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResultSelection',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=32, unique=True)),
+                ('contact_ids', models.BinaryField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'result selection',
+                'verbose_name_plural': 'result selections',
+            },
+        ),
+    ]
@@ -0,0 +1,92 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:02
+
+import ast
+import json
+
+from django.db import migrations, models
+
+
+def _str_to_list(str_value):
+    """the list of a value saved as its repr: the old way of saving the multi-values fields"""
+    try:
+        value = ast.literal_eval(str_value)
+        if isinstance(value, (list, tuple)):
+            return ['{0}'.format(item) for item in value]
+    except (ValueError, SyntaxError):
+        pass
+
+    def _strip_quotes(item):
+        if item[:2] in ("u'", 'u"'):
+            item = item[2:]
+        elif item[:1] in ("'", '"'):
+            item = item[1:]
+        if item[-1:] in ("'", '"'):
+            item = item[:-1]
+        return item
+
+    if str_value[:1] == '[' and str_value[-1:] == ']':
+        return [_strip_quotes(item) for item in str_value[1:-1].split(", ")]
+    return []
+
+
+def fields_to_definition(apps, schema_editor):
+    """store the groups and fields of each search in its json definition"""
+    search_class = apps.get_model('Search', 'Search')
+    search_field_class = apps.get_model('Search', 'SearchField')
+    definitions = {}
+    search_fields = search_field_class.objects.select_related('search_group').order_by(
+        'search_group__search', 'search_group__id', 'id'
+    )
+    for search_field in search_fields:
+        search_group = search_field.search_group
+        definition = definitions.setdefault(search_group.search_id, {})
+        # Same key as the one built by the SearchForm before: the count defaults to the number of fields before
+        count = search_field.count or sum(len(fields) for fields in definition.values())
+        value = _str_to_list(search_field.value) if search_field.is_list else search_field.value
+        definition.setdefault(search_group.name, []).append(
+            {'field': search_field.field, 'count': count, 'value': value}
+        )
+    for search_id, definition in definitions.items():
+        search_class.objects.filter(id=search_id).update(definition=json.dumps(definition, sort_keys=True))
+
+
+def definition_to_fields(apps, schema_editor):
+    """create the groups and fields of each search from its json definition"""
+    search_class = apps.get_model('Search', 'Search')
+    search_group_class = apps.get_model('Search', 'SearchGroup')
+    search_field_class = apps.get_model('Search', 'SearchField')
+    for search in search_class.objects.exclude(definition=''):
+        for group_name, fields in json.loads(search.definition).items():
+            search_group = search_group_class.objects.create(search=search, name=group_name)
+            for field in fields:
+                is_list = isinstance(field['value'], list)
+                search_field_class.objects.create(
+                    search_group=search_group, field=field['field'], count=field['count'],
+                    value='{0}'.format(field['value']), is_list=is_list
+                )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Search', '0003_result_selection'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='search',
+            name='definition',
+            field=models.TextField(blank=True, default='', help_text='The fields of the search as json'),
+        ),
+        migrations.RunPython(fields_to_definition, definition_to_fields),
+        migrations.RemoveField(
+            model_name='searchgroup',
+            name='search',
+        ),
+        migrations.DeleteModel(
+            name='SearchField',
+        ),
+        migrations.DeleteModel(
+            name='SearchGroup',
+        ),
+    ]
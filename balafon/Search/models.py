@@ -1,52 +1,212 @@
 # -*- coding: utf-8 -*-
 
+from array import array
+from datetime import datetime, timedelta
+import json
+import uuid
+import zlib
+
+from django.conf import settings
+from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericRelation
 from django.db import models
+from django.db.models import signals
 from django.utils.translation import ugettext_lazy as _
 
 from django_extensions.db.models import TimeStampedModel
+from coop_cms.models import Newsletter
 
+from balafon.Crm import models as crm_models
+from balafon.Crm.models import Action, Contact, Entity, Group, Subscription
+from balafon.Crm.signals import actions_bulk_created, subscriptions_bulk_updated
+from balafon.Emailing.models import Emailing
+from balafon.Search.choices_cache import invalidate_choices
+from balafon.Search.results_cache import invalidate_results
+from balafon.Search.utils import get_contacts_by_ids
 from balafon.Users.models import Favorite
 
 
 class Search(TimeStampedModel):
     """A search"""
     name = models.CharField(_('name'), max_length=100)
+    definition = models.TextField(
+        blank=True, default='', help_text=_('The fields of the search as json')
+    )
     
     favorites = GenericRelation(Favorite)
 
     def __str__(self):
         return self.name
 
+    def get_definition(self):
+        """the fields of the search by group: {group name: [{'field': name, 'count': count, 'value': value}]}"""
+        return json.loads(self.definition) if self.definition else {}
+
+    def set_definition(self, definition):
+        """set the fields of the search. Doesn't save"""
+        self.definition = json.dumps(definition, sort_keys=True)
+
+    def get_search_data(self):
+        """the data of the SearchForm"""
+        data = {}
+        for group_name, fields in self.get_definition().items():
+            for field in fields:
+                data['-_-'.join((group_name, field['field'], str(field['count'])))] = field['value']
+        return data
+
     class Meta:
         verbose_name = _('search')
         verbose_name_plural = _('searchs')
 
 
-class SearchGroup(models.Model):
-    """blocks"""
-    search = models.ForeignKey(Search, verbose_name=_('search'), on_delete=models.CASCADE)
-    name = models.CharField(_('name'), max_length=100)
-    
+def _get_export_job_dir(export_job, filename):
+    """directory for storing the files of the export jobs"""
+    return '{0}/{1}'.format(getattr(settings, 'BALAFON_EXPORT_JOBS_DIR', 'export_jobs'), filename)
+
+
+class ExportJob(TimeStampedModel):
+    """export of search results done out of the request by the run_export_jobs command"""
+
+    TYPE_EXCEL = 1
+    TYPE_CSV = 2
+    TYPE_PDF = 3
+
+    TYPE_CHOICES = (
+        (TYPE_EXCEL, _('Excel')),
+        (TYPE_CSV, _('CSV')),
+        (TYPE_PDF, _('PDF')),
+    )
+
+    EXTENSIONS = {
+        TYPE_EXCEL: 'xls',
+        TYPE_CSV: 'csv',
+        TYPE_PDF: 'pdf',
+    }
+
+    STATUS_PENDING = 1
+    STATUS_RUNNING = 2
+    STATUS_DONE = 3
+    STATUS_FAILED = 4
+
+    STATUS_CHOICES = (
+        (STATUS_PENDING, _('Pending')),
+        (STATUS_RUNNING, _('In progress')),
+        (STATUS_DONE, _('Done')),
+        (STATUS_FAILED, _('Failed')),
+    )
+
+    user = models.ForeignKey(User, verbose_name=_('user'), on_delete=models.CASCADE)
+    export_type = models.IntegerField(_('type'), choices=TYPE_CHOICES)
+    status = models.IntegerField(_('status'), default=STATUS_PENDING, choices=STATUS_CHOICES)
+    search_data = models.TextField(blank=True, default='', help_text=_('The posted search form as json'))
+    options = models.TextField(blank=True, default='', help_text=_('The posted pdf form as json'))
+    progress = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    result = models.FileField(_('result'), upload_to=_get_export_job_dir, blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    started_dt = models.DateTimeField(_('start date'), blank=True, default=None, null=True)
+    ended_dt = models.DateTimeField(_('end date'), blank=True, default=None, null=True)
+
     def __str__(self):
-        return '{0} {1}'.format(self.search, self.name)
+        return '{0} #{1}'.format(self.get_export_type_display(), self.id)
+
+    def get_filename(self):
+        """the name of the file proposed for download"""
+        return 'balafon.{0}'.format(self.EXTENSIONS[self.export_type])
 
     class Meta:
-        verbose_name = _('search group')
-        verbose_name_plural = _('search groups')
+        verbose_name = _('export job')
+        verbose_name_plural = _('export jobs')
+        ordering = ['-created']
 
 
-class SearchField(models.Model):
-    """fields"""
-    search_group = models.ForeignKey(SearchGroup, verbose_name=_('search group'), on_delete=models.CASCADE)
-    field = models.CharField(_('field'), max_length=100)
-    value = models.CharField(_('value'), max_length=200)
-    is_list = models.BooleanField(default=False)
-    count = models.IntegerField(default=0)
-    
+class ResultSelection(models.Model):
+    """
+    contacts of search results stored on the server: the forms of the actions on the results post its token
+    rather than the list of ids. The ids are stored as a compressed array of integers
+    """
+    token = models.CharField(max_length=32, unique=True)
+    contact_ids = models.BinaryField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    # Number of days a selection is kept
+    LIFETIME = 7
+
     def __str__(self):
-        return '{0} {1}'.format(self.search_group, self.field)
+        return self.token
+
+    @classmethod
+    def create_for_contacts(cls, contacts):
+        """store the contacts ids: the old selections are deleted"""
+        cls.objects.filter(created__lt=datetime.now() - timedelta(days=cls.LIFETIME)).delete()
+        ids = array('I', [contact.id for contact in contacts])
+        return cls.objects.create(token=uuid.uuid4().hex, contact_ids=zlib.compress(ids.tobytes()))
+
+    def get_contact_ids(self):
+        """the ids in the order of the results"""
+        ids = array('I')
+        ids.frombytes(zlib.decompress(self.contact_ids))
+        return ids.tolist()
+
+    @classmethod
+    def is_valid_value(cls, value):
+        """True if the value is the token of a selection or a list of ids separated by ';'"""
+        if cls.objects.filter(token=value).exists():
+            return True
+        contact_ids = [contact_id.strip() for contact_id in value.split(';') if contact_id.strip()]
+        return bool(contact_ids) and all(contact_id.isdigit() for contact_id in contact_ids)
+
+    @classmethod
+    def get_contacts(cls, value):
+        """
+        the contacts of a selection token. A list of ids separated by ';' is still accepted
+        returns the contacts in the order of the selection
+        """
+        try:
+            contact_ids = cls.objects.get(token=value).get_contact_ids()
+        except cls.DoesNotExist:
+            contact_ids = [int(contact_id) for contact_id in value.split(';') if contact_id.strip().isdigit()]
+        return get_contacts_by_ids(contact_ids)
 
     class Meta:
-        verbose_name = _('search field')
-        verbose_name_plural = _('search fied')
+        verbose_name = _('result selection')
+        verbose_name_plural = _('result selections')
+
+
+# the cached search results are invalidated on changes of the data read by the search filters
+for _model in (
+    Contact, Entity, Group, Action, Subscription, crm_models.ContactCustomFieldValue,
+    crm_models.EntityCustomFieldValue, crm_models.Relationship, crm_models.Opportunity, crm_models.SameAs,
+    crm_models.City, crm_models.Zone
+):
+    signals.post_save.connect(invalidate_results, sender=_model, dispatch_uid='search_results_save')
+    signals.post_delete.connect(invalidate_results, sender=_model, dispatch_uid='search_results_delete')
+for _through in (
+    Group.contacts.through, Group.entities.through, Action.contacts.through, Action.entities.through,
+    Emailing.send_to.through, Emailing.sent_to.through, Emailing.opened_emails.through,
+    Emailing.hard_bounce.through, Emailing.soft_bounce.through, Emailing.spam.through, Emailing.unsub.through,
+    Emailing.rejected.through
+):
+    signals.m2m_changed.connect(invalidate_results, sender=_through, dispatch_uid='search_results_m2m')
+actions_bulk_created.connect(invalidate_results, sender=Action, dispatch_uid='search_results_actions')
+subscriptions_bulk_updated.connect(
+    invalidate_results, sender=Subscription, dispatch_uid='search_results_subscriptions'
+)
+
+
+def invalidate_emailing_choices(sender, **kwargs):
+    """the labels of the emailings show their number of recipients"""
+    invalidate_choices(Emailing)
+
+
+# the cached choices of the search fields are invalidated on changes of the models they are built from
+for _model in (
+    crm_models.ActionStatus, crm_models.ActionType, crm_models.ContactsImport, crm_models.CustomField,
+    crm_models.EntityRole, crm_models.EntityType, crm_models.Group, crm_models.Opportunity,
+    crm_models.RelationshipType, crm_models.SubscriptionType, crm_models.TeamMember, crm_models.Zone,
+    crm_models.ZoneType, Emailing, Newsletter, User
+):
+    signals.post_save.connect(invalidate_choices, sender=_model, dispatch_uid='search_choices_save')
+    signals.post_delete.connect(invalidate_choices, sender=_model, dispatch_uid='search_choices_delete')
+for _through in (Emailing.send_to.through, Emailing.sent_to.through):
+    signals.m2m_changed.connect(invalidate_emailing_choices, sender=_through, dispatch_uid='search_choices_m2m')
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+profiling of the searches: the queries, the rows and the time of each step of each filter.
+It is enabled for the staff by the BALAFON_SEARCH_PROFILING setting or by the profile parameter of the search request.
+The rows are counted by additional queries: the profiling mode should only be used for finding the slow filters
+"""
+
+from contextlib import contextmanager
+import json
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.query import QuerySet
+
+from balafon.utils import logger
+
+
+@contextmanager
+def _capture_sql():
+    """the sql of the queries executed in the with statement: the parameters are included like in connection.queries"""
+    queries = []
+
+    def execute(execute_query, sql, params, many, context):
+        """call the query and keep its sql"""
+        try:
+            return execute_query(sql, params, many, context)
+        finally:
+            queries.append(sql if many else connection.ops.last_executed_query(context['cursor'], sql, params))
+
+    with connection.execute_wrapper(execute):
+        yield queries
+
+
+def is_profiling_enabled(request):
+    """returns True if the search of this request must be profiled"""
+    if not request.user.is_staff:
+        return False
+    return getattr(settings, 'BALAFON_SEARCH_PROFILING', False) or bool(request.GET.get('profile')) or \
+        bool(request.POST.get('profile'))
+
+
+class SearchProfiler(object):
+    """records a profile entry for each measured step of the search"""
+
+    def __init__(self):
+        self.entries = []
+
+    @contextmanager
+    def measure(self, block, form_name, step):
+        """measure the code of the with statement: the rows can be set by calling count_rows on the entry"""
+        entry = {
+            'block': block, 'filter': form_name, 'step': step, 'rows': None, 'count_time_ms': None, 'count_sql': [],
+        }
+        # added before running the step: a block is listed before its filters
+        self.entries.append(entry)
+        with _capture_sql() as queries:
+            start = time.time()
+            yield entry
+            entry['time_ms'] = (time.time() - start) * 1000
+        entry['sql'] = queries
+        entry['queries'] = len(entry['sql'])
+
+    def count_rows(self, entry, results):
+        """
+        the number of rows produced by a step: a queryset is counted in the database.
+        The querysets are lazy: the time of the count is the time spent by the database for the filters of the step
+        """
+        with _capture_sql() as queries:
+            start = time.time()
+            entry['rows'] = results.count() if isinstance(results, QuerySet) else len(results)
+            entry['count_time_ms'] = (time.time() - start) * 1000
+        entry['count_sql'] = queries
+
+    def log(self, search_data):
+        """write the profile in the logs as json"""
+        logger.info(
+            'search profile: %s',
+            json.dumps({'search': search_data, 'entries': self.entries}, sort_keys=True, default=str)
+        )
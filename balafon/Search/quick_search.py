@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+quick search of the menu box: the hits of each category are ranked and limited in the database.
+On PostgreSQL, the searched columns have trigram indexes which serve the icontains lookups
+(see the Crm 0035_quick_search_indexes migration)
+"""
+
+from django.conf import settings
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import connection
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+
+from balafon.Crm.models import City, Contact, Entity, Group
+from balafon.Crm import settings as crm_settings
+from balafon.utils import get_phone_digits, is_phone_number
+
+
+def get_limit():
+    """max number of hits displayed for each category"""
+    return getattr(settings, 'BALAFON_QUICK_SEARCH_LIMIT', 20)
+
+
+def is_trigram_similarity_supported():
+    """returns True if the hits can be ranked by similarity (Postgres pg_trgm is installed)"""
+    return connection.vendor == 'postgresql' and getattr(settings, 'BALAFON_TRIGRAM_SEARCH_SUPPORT', False)
+
+
+def filter_contains(queryset, field, text):
+    """filter the queryset on field containing text: ignore the accents if Postgres unaccent is installed"""
+    if crm_settings.is_unaccent_filter_supported():
+        field += '__unaccent'
+    return queryset.filter(**{field + '__icontains': text})
+
+
+def order_by_rank(queryset, field, text):
+    """exact matches first, then the values starting with text, then by similarity (if supported) and value"""
+    queryset = queryset.annotate(
+        quick_search_rank=Case(
+            When(**{field + '__iexact': text, 'then': Value(0)}),
+            When(**{field + '__istartswith': text, 'then': Value(1)}),
+            default=Value(2),
+            output_field=IntegerField()
+        )
+    )
+    ordering = ['quick_search_rank']
+    if is_trigram_similarity_supported():
+        queryset = queryset.annotate(quick_search_similarity=TrigramSimilarity(field, text))
+        ordering.append('-quick_search_similarity')
+    return queryset.order_by(*(ordering + [field, 'id']))
+
+
+def search_contacts(text, limit):
+    """entities and contacts by name: the contacts of a matching entity are not repeated"""
+    entities = filter_contains(Entity.objects.filter(is_single_contact=False), 'name', text)
+    contacts = filter_contains(Contact.objects.all(), 'lastname', text).exclude(entity__in=entities)
+    count = entities.count() + contacts.count()
+
+    hits = list(order_by_rank(entities, 'name', text)[:limit])
+    for entity in hits:
+        entity.is_entity = True
+    hits += list(
+        order_by_rank(contacts, 'lastname', text).select_related('entity', 'city').prefetch_related('role')[:limit]
+    )
+    hits.sort(key=lambda hit: (hit.quick_search_rank, getattr(hit, 'name', getattr(hit, 'lastname', '')).lower()))
+    return hits[:limit], count
+
+
+def search_groups(text, limit):
+    """groups by name"""
+    groups = filter_contains(Group.objects.all(), 'name', text)
+    return list(order_by_rank(groups, 'name', text)[:limit]), groups.count()
+
+
+def search_emails(text, limit):
+    """contacts by email: the email of the entity is used if the contact doesn't have one"""
+    contacts = Contact.objects.filter(effective_email__icontains=text)
+    hits = order_by_rank(contacts, 'effective_email', text).select_related('entity')[:limit]
+    return list(hits), contacts.count()
+
+
+def search_phones(text, limit):
+    """contacts and entities by phone number: the numbers starting with the digits of text whatever their format"""
+    if not is_phone_number(text):
+        return [], 0
+    digits = get_phone_digits(text)
+    contacts = Contact.objects.filter(Q(phone_digits__startswith=digits) | Q(mobile_digits__startswith=digits))
+    entities = Entity.objects.filter(phone_digits__startswith=digits)
+    hits = list(contacts.select_related('entity').order_by('lastname', 'firstname', 'id')[:limit])
+    hits += list(entities.order_by('name', 'id')[:max(limit - len(hits), 0)])
+    return hits, contacts.count() + entities.count()
+
+
+def search_cities(text, limit):
+    """cities by name with their number of entities and contacts: only the cities having some"""
+    cities = City.objects.filter(name__icontains=text).annotate(
+        entities_count=Count('entity', distinct=True),
+        contacts_count=Count('contact', distinct=True),
+    ).filter(Q(entities_count__gt=0) | Q(contacts_count__gt=0))
+    return [
+        (city, city.entities_count, city.contacts_count)
+        for city in order_by_rank(cities, 'name', text)[:limit]
+    ]
+
+
+def quick_search(text, limit=None):
+    """returns the hits and the number of matches of each category"""
+    if limit is None:
+        limit = get_limit()
+    contacts, contacts_count = search_contacts(text, limit)
+    groups, groups_count = search_groups(text, limit)
+    contacts_by_email, emails_count = search_emails(text, limit)
+    contacts_by_phone, phones_count = search_phones(text, limit)
+    return {
+        'contacts': contacts,
+        'contacts_count': contacts_count,
+        'groups_by_name': groups,
+        'groups_count': groups_count,
+        'contacts_by_email': contacts_by_email,
+        'emails_count': emails_count,
+        'contacts_by_phone': contacts_by_phone,
+        'phones_count': phones_count,
+        'cities_by_name': search_cities(text, limit),
+    }
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+cache of the search results: the ordered ids of the contacts matching a search definition.
+The search then the actions on its results (mailto, export, emailing, add to group...) pay for the query once.
+The cache is disabled by default: it is enabled by the BALAFON_SEARCH_CACHE_TIMEOUT setting.
+All the results are invalidated when one of the models read by the search filters is modified (see Search.models).
+The version of the results is kept in the django cache: if several processes serve the site, BALAFON_SEARCH_CACHE
+must be a cache shared by all of them (memcached, redis...). Otherwise a process doesn't see the invalidations
+of the other ones and can return results up to BALAFON_SEARCH_CACHE_TIMEOUT seconds old
+"""
+
+from hashlib import sha1
+import json
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+VERSION_KEY = 'balafon_search_results_version'
+
+
+def get_timeout():
+    """number of seconds the results are kept. 0 (default) disables the cache"""
+    return getattr(settings, 'BALAFON_SEARCH_CACHE_TIMEOUT', 0)
+
+
+def _get_cache():
+    """the django cache used for results: LRU eviction depends on its backend (MAX_ENTRIES for locmem)"""
+    return caches[getattr(settings, 'BALAFON_SEARCH_CACHE', 'default')]
+
+
+def _get_version():
+    """
+    the version of the results: changed on every invalidation.
+    A random value rather than a counter: results of an evicted version can not be served again
+    """
+    cache = _get_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(VERSION_KEY, version, None)
+    return version
+
+
+def get_cache_key(search_data):
+    """the key of the results for the serialized data of a search form"""
+    digest = sha1(json.dumps(search_data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return 'balafon_search_results_{0}_{1}'.format(_get_version(), digest)
+
+
+def get_results(search_data):
+    """returns (contact_ids, refuse_newsletter) or None if not in cache"""
+    if not get_timeout():
+        return None
+    return _get_cache().get(get_cache_key(search_data))
+
+
+def set_results(search_data, contact_ids, refuse_newsletter):
+    """keep the results of a search"""
+    timeout = get_timeout()
+    if timeout:
+        _get_cache().set(get_cache_key(search_data), (list(contact_ids), sorted(refuse_newsletter)), timeout)
+
+
+def invalidate_results(*args, **kwargs):
+    """signal receiver: the cached results may be wrong after any change"""
+    if not get_timeout():
+        return
+    _get_cache().set(VERSION_KEY, uuid.uuid4().hex, None)
@@ -2,9 +2,11 @@
 """search test package"""
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 
 from coop_cms.utils import RequestManager
 
+from balafon.Search.choices_cache import clear_choices
 from balafon.unit_tests import TestCase
 
 
@@ -14,6 +16,9 @@ class BaseTestCase(TestCase):
     def setUp(self):
         """before"""
         super(BaseTestCase, self).setUp()
+        # the cached search results and choices must not be shared by the tests
+        cache.clear()
+        clear_choices()
         self.user = User.objects.create(username="toto")
         self.user.set_password("abc")
         self.user.is_staff = True
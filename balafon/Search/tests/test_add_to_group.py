@@ -6,6 +6,7 @@ from django.urls import reverse
 from model_mommy import mommy
 
 from balafon.Crm import models
+from balafon.Crm.utils import add_contacts_to_groups, add_entities_to_groups
 from balafon.Search.tests import BaseTestCase
 
 
@@ -97,3 +98,40 @@ class AddToGroupActionTest(BaseTestCase):
 
         for entity in [entity1, entity2]:
             self.assertTrue(entity in group2.entities.all())
+
+
+class AddToGroupsInBulkTest(BaseTestCase):
+    """the members are added to the groups in bulk"""
+
+    def test_add_contacts(self):
+        """only the missing members are added"""
+        contacts = [mommy.make(models.Contact) for index in range(3)]
+        group1 = mommy.make(models.Group, name="GROUP1")
+        group2 = mommy.make(models.Group, name="GROUP2")
+        group1.contacts.add(contacts[0])
+
+        self.assertEqual(5, add_contacts_to_groups([group1, group2], contacts))
+
+        for group in (group1, group2):
+            self.assertEqual(sorted([contact.id for contact in contacts]), sorted(
+                group.contacts.values_list('id', flat=True)
+            ))
+        self.assertEqual(0, add_contacts_to_groups([group1, group2], contacts))
+
+    def test_add_contacts_query_count(self):
+        """the number of queries doesn't depend on the number of contacts"""
+        group1 = mommy.make(models.Group, name="GROUP1")
+        group2 = mommy.make(models.Group, name="GROUP2")
+        contacts = [mommy.make(models.Contact) for index in range(20)]
+        with self.assertNumQueries(4):
+            add_contacts_to_groups([group1, group2], contacts)
+        self.assertEqual(20, group2.contacts.count())
+
+    def test_add_entities(self):
+        """only the missing entities are added"""
+        entities = [mommy.make(models.Entity) for index in range(2)]
+        group = mommy.make(models.Group, name="GROUP1")
+        group.entities.add(entities[1])
+
+        self.assertEqual(1, add_entities_to_groups([group], [entity.id for entity in entities]))
+        self.assertEqual(2, group.entities.count())
@@ -7,6 +7,8 @@ from coop_cms.tests import BeautifulSoup
 from model_mommy import mommy
 
 from balafon.Crm import models
+from balafon.Crm.utils import update_subscriptions
+from balafon.Search.models import ResultSelection
 from balafon.Search.tests import BaseTestCase
 
 
@@ -51,7 +53,7 @@ class SubscribeAdminContactsTest(BaseTestCase):
         id_contacts = soup.select('input#id_contacts')
         self.assertEqual(1, len(id_contacts))
         self.assertEqual(
-            sorted([int(x) for x in id_contacts[0]['value'].split(';')]),
+            sorted(ResultSelection.objects.get(token=id_contacts[0]['value']).get_contact_ids()),
             sorted([contact1.id, contact2.id])
         )
 
@@ -265,3 +267,42 @@ class SubscribeAdminContactsTest(BaseTestCase):
 
         subscription = models.Subscription.objects.get(subscription_type=subscription_type1, contact=contact1)
         self.assertEqual(subscription.accept_subscription, False)
+
+
+class UpdateSubscriptionsTest(BaseTestCase):
+    """subscriptions are updated in bulk"""
+
+    def test_subscribe(self):
+        """missing subscriptions are created and refused ones accepted"""
+        subscription_type = mommy.make(models.SubscriptionType)
+        contacts = [mommy.make(models.Contact) for index in range(4)]
+        mommy.make(
+            models.Subscription, subscription_type=subscription_type, contact=contacts[0], accept_subscription=True
+        )
+        mommy.make(
+            models.Subscription, subscription_type=subscription_type, contact=contacts[1], accept_subscription=False
+        )
+
+        with self.assertNumQueries(5):
+            self.assertEqual(3, update_subscriptions(contacts, subscription_type, True))
+
+        self.assertEqual(4, models.Subscription.objects.filter(
+            subscription_type=subscription_type, accept_subscription=True
+        ).count())
+        self.assertEqual(4, models.Subscription.objects.count())
+
+    def test_unsubscribe(self):
+        """only existing subscriptions are modified"""
+        subscription_type = mommy.make(models.SubscriptionType)
+        contacts = [mommy.make(models.Contact) for index in range(3)]
+        mommy.make(
+            models.Subscription, subscription_type=subscription_type, contact=contacts[0], accept_subscription=True
+        )
+        mommy.make(
+            models.Subscription, subscription_type=subscription_type, contact=contacts[1], accept_subscription=False
+        )
+
+        self.assertEqual(1, update_subscriptions(contacts, subscription_type, False))
+
+        self.assertEqual(0, models.Subscription.objects.filter(accept_subscription=True).count())
+        self.assertEqual(2, models.Subscription.objects.count())
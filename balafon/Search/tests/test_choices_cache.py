@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""cache of the choices of the search fields"""
+
+from django.test.utils import override_settings
+from django.utils.translation import activate, get_language
+
+from model_mommy import mommy
+
+from balafon.Crm import models
+from balafon.Crm.search_forms import (
+    ActionTypeSearchForm, ContactsRelationshipByType, DepartmentSearchForm, TypeSearchForm
+)
+from balafon.Search import choices_cache
+from balafon.Search.forms import FieldChoiceForm, get_field_form
+from balafon.Search.tests import BaseTestCase
+
+
+class ChoicesCacheTest(BaseTestCase):
+    """the choices of the search fields are kept in cache"""
+
+    def _get_choices(self, form_class):
+        """the choices of the field of a search form"""
+        form = form_class('gr0', 0)
+        return list(form.fields['gr0-_-{0}-_-0'.format(form_class.name)].choices)
+
+    def test_cached_choices(self):
+        """the choices are loaded only once"""
+        action_type1 = mommy.make(models.ActionType, name="Abc")
+        action_type2 = mommy.make(models.ActionType, name="Def")
+        expected = [('', '---------'), (str(action_type1.id), 'Abc'), (str(action_type2.id), 'Def')]
+
+        self.assertEqual(expected, self._get_choices(ActionTypeSearchForm))
+        with self.assertNumQueries(0):
+            self.assertEqual(expected, self._get_choices(ActionTypeSearchForm))
+
+    def test_invalidated_on_save(self):
+        """the choices are loaded again if an object is created, modified or deleted"""
+        action_type1 = mommy.make(models.ActionType, name="Abc")
+        self.assertEqual([('', '---------'), (str(action_type1.id), 'Abc')], self._get_choices(ActionTypeSearchForm))
+
+        action_type2 = mommy.make(models.ActionType, name="Def")
+        self.assertEqual(3, len(self._get_choices(ActionTypeSearchForm)))
+
+        action_type2.name = "Bcd"
+        action_type2.save()
+        self.assertEqual(
+            [('', '---------'), (str(action_type1.id), 'Abc'), (str(action_type2.id), 'Bcd')],
+            self._get_choices(ActionTypeSearchForm)
+        )
+
+        action_type1.delete()
+        self.assertEqual([('', '---------'), (str(action_type2.id), 'Bcd')], self._get_choices(ActionTypeSearchForm))
+
+    def test_dependencies(self):
+        """the choices are invalidated by the models they depend on"""
+        zone_type = mommy.make(models.ZoneType, type='department')
+        zone = mommy.make(models.Zone, name="Loire", code="42", type=zone_type)
+        self.assertEqual([(str(zone.id), "Loire")], self._get_choices(DepartmentSearchForm))
+
+        zone_type.type = 'region'
+        zone_type.save()
+        self.assertEqual([], self._get_choices(DepartmentSearchForm))
+
+    def test_relationship_types(self):
+        """the reverse relationships are in the choices"""
+        relationship_type = mommy.make(models.RelationshipType, name="parent", reverse="child")
+        form = ContactsRelationshipByType('gr0', 0)
+        field = form.fields['gr0-_-contacts_by_relationship_type-_-0']
+        self.assertEqual(
+            [(relationship_type.id, "parent"), (-relationship_type.id, "child")], list(field.widget.choices)
+        )
+
+    def test_created_by_another_process(self):
+        """a value missing from the cached choices is checked in the database"""
+        action_type1 = mommy.make(models.ActionType, name="Abc")
+        self.assertEqual(2, len(self._get_choices(ActionTypeSearchForm)))
+        # created without signal: as seen by a process not aware of the new version
+        models.ActionType.objects.bulk_create([models.ActionType(name="Def")])
+        action_type2 = models.ActionType.objects.get(name="Def")
+        self.assertEqual(2, len(self._get_choices(ActionTypeSearchForm)))
+
+        form = ActionTypeSearchForm('gr0', 0, {'action_type': str(action_type2.id)})
+        self.assertTrue(form.is_valid())
+        form = ActionTypeSearchForm('gr0', 0, {'action_type': str(action_type1.id)})
+        self.assertTrue(form.is_valid())
+
+    @override_settings(BALAFON_SEARCH_CHOICES_TIMEOUT=0)
+    def test_timeout(self):
+        """the choices are loaded again after the timeout"""
+        mommy.make(models.ActionType, name="Abc")
+        self.assertEqual(2, len(self._get_choices(ActionTypeSearchForm)))
+        models.ActionType.objects.bulk_create([models.ActionType(name="Def")])
+        self.assertEqual(3, len(self._get_choices(ActionTypeSearchForm)))
+
+    def test_language(self):
+        """the choices are kept for each language: their labels may be translated"""
+        entity_type = mommy.make(models.EntityType, name="Abc")
+        current_language = get_language()
+        try:
+            activate('fr')
+            self.assertEqual([('', '---------'), (str(entity_type.id), 'Abc')], self._get_choices(TypeSearchForm))
+            activate('en')
+            with self.assertNumQueries(1):
+                self._get_choices(TypeSearchForm)
+        finally:
+            activate(current_language)
+
+    def test_max_entries(self):
+        """the number of choices kept in the process is bounded"""
+        for index in range(choices_cache.MAX_ENTRIES + 10):
+            choices_cache.get_cached('test-{0}'.format(index), (models.ActionType, ), lambda: index)
+        self.assertEqual(choices_cache.MAX_ENTRIES, len(choices_cache._CHOICES))
+        last_key = 'test-{0}'.format(choices_cache.MAX_ENTRIES + 9)
+        self.assertEqual(
+            choices_cache.MAX_ENTRIES + 9, choices_cache.get_cached(last_key, (models.ActionType, ), lambda: None)
+        )
+
+    def test_valid_choice(self):
+        """the value must be one of the choices"""
+        action_type = mommy.make(models.ActionType, name="Abc")
+        form = ActionTypeSearchForm('gr0', 0, {'action_type': str(action_type.id)})
+        self.assertTrue(form.is_valid())
+        form = ActionTypeSearchForm('gr0', 0, {'action_type': str(action_type.id + 1)})
+        self.assertFalse(form.is_valid())
+
+
+class FieldFormsRegistryTest(BaseTestCase):
+    """the search field forms are registered once"""
+
+    def test_get_field_form(self):
+        """the form class of a name"""
+        self.assertEqual(ActionTypeSearchForm, get_field_form('action_type'))
+        self.assertRaises(KeyError, get_field_form, 'unknown')
+
+    def test_field_choice_form(self):
+        """no query for building the list of filters"""
+        with self.assertNumQueries(0):
+            form = FieldChoiceForm()
+        self.assertTrue(len(form.fields['field_choice'].choices) > 1)
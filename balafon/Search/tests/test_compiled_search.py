@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""search compiled as a single queryset"""
+
+from django.urls import reverse
+
+from model_mommy import mommy
+
+from balafon.Crm import models
+from balafon.Search.forms import SearchForm
+from balafon.Search.tests import BaseTestCase
+
+
+class CompiledSearchTest(BaseTestCase):
+    """The search results as a single queryset"""
+
+    def _get_search_form(self, data):
+        """returns a valid search form"""
+        search_form = SearchForm(data)
+        self.assertTrue(search_form.is_valid())
+        return search_form
+
+    def test_union_of_blocks(self):
+        """a contact matching several blocks is returned once"""
+        entity1 = mommy.make(models.Entity, name="Abc")
+        contact1 = entity1.default_contact
+        contact1.lastname = "Zzz"
+        contact1.save()
+
+        entity2 = mommy.make(models.Entity, name="Def")
+        contact2 = entity2.default_contact
+        contact2.lastname = "Yyy"
+        contact2.save()
+
+        entity3 = mommy.make(models.Entity, name="Ghi")
+
+        search_form = self._get_search_form(
+            {
+                "gr0-_-entity_name-_-0": 'Abc',
+                "gr1-_-contact_name-_-0": 'Z',
+                "gr2-_-entity_name-_-0": 'Def',
+            }
+        )
+        queryset = search_form.get_queryset()
+        self.assertEqual(2, queryset.count())
+        self.assertEqual([contact1, contact2], list(queryset))
+        self.assertEqual(search_form.get_contacts(), list(queryset))
+        self.assertNotIn(entity3.default_contact, list(queryset))
+
+    def test_excluded(self):
+        """excluded contacts are not in the queryset"""
+        entity1 = mommy.make(models.Entity, name="Abc")
+        entity2 = mommy.make(models.Entity, name="Abd")
+
+        search_form = self._get_search_form(
+            {
+                "gr0-_-entity_name-_-0": 'Ab',
+                "excluded": "#{0}#".format(entity1.default_contact.id),
+            }
+        )
+        queryset = search_form.get_queryset()
+        self.assertEqual([entity2.default_contact], list(queryset))
+        self.assertEqual(search_form.get_contacts(), list(queryset))
+
+    def test_has_left(self):
+        """contacts who left are excluded unless required"""
+        entity = mommy.make(models.Entity, name="Abc")
+        contact1 = entity.default_contact
+        contact1.lastname = "Aaa"
+        contact1.save()
+        contact2 = mommy.make(models.Contact, entity=entity, lastname="Bbb", main_contact=True, has_left=True)
+
+        search_form = self._get_search_form({"gr0-_-entity_name-_-0": 'Abc'})
+        self.assertEqual([contact1], list(search_form.get_queryset()))
+
+        search_form = self._get_search_form({"gr0-_-entity_name-_-0": 'Abc', "gr0-_-contact_has_left-_-1": '1'})
+        self.assertEqual([contact1, contact2], list(search_form.get_queryset()))
+
+    def test_action_filters(self):
+        """action filters of a block are compiled in the block subquery"""
+        entity1 = mommy.make(models.Entity, name="Abc")
+        entity2 = mommy.make(models.Entity, name="Abd")
+        action = mommy.make(models.Action, subject="Hello")
+        action.entities.add(entity1)
+        action.save()
+
+        search_form = self._get_search_form(
+            {"gr0-_-entity_name-_-0": 'Ab', "gr0-_-action_name-_-1": 'Hello'}
+        )
+        queryset = search_form.get_queryset()
+        self.assertEqual([entity1.default_contact], list(queryset))
+        self.assertNotIn(entity2.default_contact, list(queryset))
+
+    def test_sort_by_contact(self):
+        """sort form is applied in the database"""
+        entity1 = mommy.make(models.Entity, name="Abc")
+        contact1 = entity1.default_contact
+        contact1.lastname = "Zzz"
+        contact1.save()
+        entity2 = mommy.make(models.Entity, name="Abd")
+        contact2 = entity2.default_contact
+        contact2.lastname = "Aaa"
+        contact2.save()
+
+        search_form = self._get_search_form({"gr0-_-entity_name-_-0": 'Ab', "gr0-_-sort-_-1": 'contact'})
+        queryset = search_form.get_queryset()
+        self.assertEqual([contact2, contact1], list(queryset))
+        self.assertEqual(search_form.get_contacts(), list(queryset))
+
+    def test_sort_by_zipcode(self):
+        """sort by zipcode can not be compiled"""
+        mommy.make(models.Entity, name="Abc")
+        search_form = self._get_search_form({"gr0-_-entity_name-_-0": 'Ab', "gr0-_-sort-_-1": 'zipcode'})
+        self.assertEqual(None, search_form.get_queryset())
+        self.assertEqual(1, len(search_form.get_contacts()))
+
+    def test_no_blocks(self):
+        """empty search"""
+        mommy.make(models.Entity, name="Abc")
+        search_form = self._get_search_form({"name": ""})
+        self.assertEqual(0, search_form.get_queryset().count())
+        self.assertEqual([], search_form.get_contacts())
+
+
+class EntitiesQuerysetTest(BaseTestCase):
+    """The search results grouped by entities in the database"""
+
+    def _get_search_form(self, data):
+        """returns a valid search form"""
+        search_form = SearchForm(data)
+        self.assertTrue(search_form.is_valid())
+        return search_form
+
+    def test_entities_queryset(self):
+        """entities sorted by name with their contacts"""
+        entity1 = mommy.make(models.Entity, name="Abd")
+        contact1 = entity1.default_contact
+        contact1.lastname = "Zzz"
+        contact1.save()
+        contact2 = mommy.make(models.Contact, entity=entity1, lastname="aaa", main_contact=True, has_left=False)
+        contact3 = mommy.make(models.Contact, entity=entity1, lastname="Bbb", main_contact=True, has_left=True)
+        entity2 = mommy.make(models.Entity, name="Abc")
+        contact4 = entity2.default_contact
+        contact4.has_left = True
+        contact4.save()
+        entity3 = mommy.make(models.Entity, name="Def")
+
+        search_form = self._get_search_form({"gr0-_-entity_name-_-0": 'Ab'})
+        entities, contacts_count, has_empty_entities = search_form.get_entities_queryset()
+        self.assertEqual([entity2, entity1], list(entities))
+        self.assertEqual(2, contacts_count)
+        self.assertEqual(True, has_empty_entities)
+        self.assertNotIn(entity3, list(entities))
+
+        entities = list(entities)
+        self.assertEqual([], entities[0].search_contacts)
+        self.assertEqual([contact2, contact1], entities[1].search_contacts)
+        self.assertNotIn(contact3, entities[1].search_contacts)
+
+        results, old_contacts_count, old_has_empty_entities = search_form.get_contacts_by_entity()
+        self.assertEqual(results, entities)
+        self.assertEqual(old_contacts_count, contacts_count)
+        self.assertEqual(old_has_empty_entities, has_empty_entities)
+
+    def test_entities_queryset_page(self):
+        """only the entities of the page are loaded: constant number of queries"""
+        for index in range(10):
+            entity = mommy.make(models.Entity, name="Abc{0}".format(index))
+            mommy.make(models.Contact, entity=entity, main_contact=True, has_left=False)
+
+        search_form = self._get_search_form({"gr0-_-entity_name-_-0": 'Abc'})
+        with self.assertNumQueries(2):
+            entities, contacts_count, has_empty_entities = search_form.get_entities_queryset()
+        self.assertEqual(20, contacts_count)
+        self.assertEqual(False, has_empty_entities)
+        with self.assertNumQueries(2):
+            page = list(entities[2:5])
+            for entity in page:
+                self.assertEqual(2, len(entity.search_contacts))
+        self.assertEqual(["Abc2", "Abc3", "Abc4"], [entity.name for entity in page])
+
+    def test_entities_queryset_not_compiled(self):
+        """sort by zipcode can not be compiled"""
+        mommy.make(models.Entity, name="Abc")
+        search_form = self._get_search_form({"gr0-_-entity_name-_-0": 'Ab', "gr0-_-sort-_-1": 'zipcode'})
+        self.assertEqual(None, search_form.get_entities_queryset())
+
+    def test_search_view_paginated(self):
+        """the search view paginates the entities"""
+        for index in range(60):
+            mommy.make(models.Entity, name="Abc{0:02}".format(index))
+
+        response = self.client.post(reverse('search'), data={"gr0-_-entity_name-_-0": 'Abc'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(60, response.context['entities_count'])
+        self.assertEqual(60, response.context['contacts_count'])
+        self.assertEqual(50, len(response.context['results']))
+        self.assertContains(response, "Abc49")
+        self.assertNotContains(response, "Abc50")
+
+        response = self.client.post(reverse('search') + "?page=2", data={"gr0-_-entity_name-_-0": 'Abc'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(10, len(response.context['results']))
+        self.assertContains(response, "Abc50")
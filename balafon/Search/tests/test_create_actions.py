@@ -8,6 +8,8 @@ from model_mommy import mommy
 
 
 from balafon.Crm import models
+from balafon.Crm.utils import create_actions_for_contacts
+from balafon.Search.models import ResultSelection
 from balafon.Search.tests import BaseTestCase
 
 
@@ -43,7 +45,7 @@ class ActionForContactsTest(BaseTestCase):
         self.assertEqual(1, len(id_contacts))
 
         self.assertEqual(
-            sorted([int(x) for x in id_contacts[0]['value'].split(';')]),
+            sorted(ResultSelection.objects.get(token=id_contacts[0]['value']).get_contact_ids()),
             sorted([contact1.id, contact2.id])
         )
 
@@ -274,3 +276,115 @@ class ActionForContactsTest(BaseTestCase):
             self.assertEqual(action.contacts.count(), 1)
             self.assertEqual(action.subject, data['subject'])
             self.assertEqual(action.opportunity, opportunity)
+
+
+class BulkCreateActionsTest(BaseTestCase):
+    """create actions for contacts in bulk"""
+
+    def _make_contacts(self, count):
+        """returns contacts"""
+        return [mommy.make(models.Entity, name="Corp{0}".format(index)).default_contact for index in range(count)]
+
+    def test_create_actions(self):
+        """an action for each contact"""
+        contacts = self._make_contacts(3)
+        action_type = mommy.make(models.ActionType)
+
+        actions = create_actions_for_contacts(contacts, type=action_type, subject='test')
+
+        self.assertEqual(3, models.Action.objects.count())
+        for action, contact in zip(actions, contacts):
+            action = models.Action.objects.get(id=action.id)
+            self.assertEqual([contact], list(action.contacts.all()))
+            self.assertEqual('test', action.subject)
+            self.assertEqual(action_type, action.type)
+            self.assertEqual('', action.uuid)
+
+    def test_per_contact_fields(self):
+        """some fields are different for each contact"""
+        contacts = self._make_contacts(2)
+        action_type = mommy.make(models.ActionType)
+
+        actions = create_actions_for_contacts(
+            contacts, per_contact_fields=[{'subject': 'first', 'detail': 'A'}, {'subject': 'second'}],
+            type=action_type, subject='test', detail='B'
+        )
+
+        self.assertEqual(
+            [('first', 'A'), ('second', 'B')],
+            [models.Action.objects.filter(id=action.id).values_list('subject', 'detail')[0] for action in actions]
+        )
+        for action, contact in zip(actions, contacts):
+            self.assertEqual([contact], list(models.Action.objects.get(id=action.id).contacts.all()))
+
+    def test_constant_number_of_queries(self):
+        """the number of queries doesn't depend on the number of contacts"""
+        action_type = mommy.make(models.ActionType)
+        contacts = self._make_contacts(3)
+        with self.assertNumQueries(8):
+            create_actions_for_contacts(contacts, type=action_type, subject='test')
+        contacts = self._make_contacts(20)
+        with self.assertNumQueries(8):
+            create_actions_for_contacts(contacts, type=action_type, subject='test')
+        self.assertEqual(23, models.Action.objects.count())
+
+    def test_numbers_reserved_for_type(self):
+        """the numbers are reserved by block for the type"""
+        contacts = self._make_contacts(3)
+        action_type = mommy.make(models.ActionType, number_auto_generated=True, last_number=10)
+
+        actions = create_actions_for_contacts(contacts, type=action_type)
+
+        self.assertEqual([11, 12, 13], [action.number for action in actions])
+        self.assertEqual(
+            [11, 12, 13], sorted(models.Action.objects.values_list('number', flat=True))
+        )
+        self.assertEqual(13, models.ActionType.objects.get(id=action_type.id).last_number)
+
+        action = mommy.make(models.Action, type=models.ActionType.objects.get(id=action_type.id))
+        self.assertEqual(14, action.number)
+
+    def test_numbers_reserved_for_generator(self):
+        """the numbers are reserved by block for the number generator"""
+        contacts = self._make_contacts(2)
+        generator = mommy.make(models.ActionNumberGenerator, number=5)
+        action_type = mommy.make(models.ActionType, number_auto_generated=True, number_generator=generator)
+
+        actions = create_actions_for_contacts(contacts, type=action_type)
+
+        self.assertEqual([6, 7], [action.number for action in actions])
+        self.assertEqual(7, models.ActionNumberGenerator.objects.get(id=generator.id).number)
+
+    def test_status_tracked(self):
+        """default status is set and tracked"""
+        contacts = self._make_contacts(2)
+        action_status = mommy.make(models.ActionStatus, is_final=True)
+        action_type = mommy.make(models.ActionType, track_status=True, default_status=action_status)
+        action_type.allowed_status.add(action_status)
+
+        actions = create_actions_for_contacts(contacts, type=action_type)
+
+        for action in actions:
+            action = models.Action.objects.get(id=action.id)
+            self.assertEqual(action_status, action.status)
+            self.assertEqual(action_status, action.previous_status)
+            self.assertEqual(True, action.done)
+            self.assertNotEqual(None, action.done_date)
+            self.assertEqual(1, models.ActionStatusTrack.objects.filter(action=action, status=action_status).count())
+
+    def test_generate_uuid(self):
+        """uuid are generated as by Action.save"""
+        contacts = self._make_contacts(2)
+        action_type = mommy.make(models.ActionType, generate_uuid=True)
+
+        actions = create_actions_for_contacts(contacts, type=action_type)
+
+        for action in actions:
+            action = models.Action.objects.get(id=action.id)
+            self.assertEqual('{0}'.format(action.build_uuid()), action.uuid)
+        self.assertNotEqual(actions[0].uuid, actions[1].uuid)
+
+    def test_no_contacts(self):
+        """nothing is created"""
+        self.assertEqual([], create_actions_for_contacts([], subject='test'))
+        self.assertEqual(0, models.Action.objects.count())
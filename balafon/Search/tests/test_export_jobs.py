@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""export of the search results in background"""
+
+import csv
+import json
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.urls import reverse
+
+from model_mommy import mommy
+import xlrd
+
+from balafon.Crm import models
+from balafon.Search.models import ExportJob
+from balafon.Search.tests import BaseTestCase
+
+
+class ExportJobTest(BaseTestCase):
+    """export jobs"""
+
+    def _make_entities(self):
+        """entities of the search results"""
+        entity1 = mommy.make(models.Entity, name="ABCD")
+        contact1 = entity1.default_contact
+        contact1.lastname = "Doe"
+        contact1.save()
+        entity2 = mommy.make(models.Entity, name="ABEF")
+        entity3 = mommy.make(models.Entity, name="Other")
+        return entity1, entity2, entity3
+
+    def test_create_csv_job(self):
+        """the job is created by the view and the file generated by the command"""
+        entity1, entity2, entity3 = self._make_entities()
+
+        url = reverse('search_create_export_contacts_job', args=[ExportJob.TYPE_CSV])
+        response = self.client.post(url, data={"gr0-_-entity_name-_-0": "AB"})
+        self.assertRedirects(response, reverse('search_export_jobs'))
+
+        job = ExportJob.objects.get()
+        self.assertEqual(self.user, job.user)
+        self.assertEqual(ExportJob.STATUS_PENDING, job.status)
+        self.assertEqual({"gr0-_-entity_name-_-0": ["AB"]}, json.loads(job.search_data))
+
+        call_command('run_export_jobs', verbosity=0)
+
+        job = ExportJob.objects.get(id=job.id)
+        self.assertEqual(ExportJob.STATUS_DONE, job.status)
+        self.assertEqual(2, job.total)
+        self.assertEqual(2, job.progress)
+        self.assertNotEqual(None, job.started_dt)
+        self.assertNotEqual(None, job.ended_dt)
+
+        response = self.client.get(reverse('search_download_export_job', args=[job.id]))
+        self.assertEqual(200, response.status_code)
+        content = b''.join(response.streaming_content).decode('utf-8')
+        lines = list(csv.reader(content.splitlines()))
+        self.assertEqual(3, len(lines))
+        self.assertEqual(
+            [str(entity1.default_contact.id), str(entity2.default_contact.id)], [line[0] for line in lines[1:]]
+        )
+
+    def test_create_excel_job(self):
+        """excel file generated by the command"""
+        entity1, entity2, entity3 = self._make_entities()
+
+        url = reverse('search_create_export_contacts_job', args=[ExportJob.TYPE_EXCEL])
+        response = self.client.post(url, data={"gr0-_-entity_name-_-0": "AB"})
+        self.assertRedirects(response, reverse('search_export_jobs'))
+
+        call_command('run_export_jobs', verbosity=0)
+
+        job = ExportJob.objects.get()
+        self.assertEqual(ExportJob.STATUS_DONE, job.status)
+
+        workbook = xlrd.open_workbook(file_contents=job.result.read())
+        worksheet = workbook.sheet_by_index(0)
+        self.assertEqual(3, worksheet.nrows)
+        self.assertEqual(["Doe", ""], [worksheet.cell(row, 2).value for row in (1, 2)])
+
+    def test_view_export_jobs(self):
+        """only the jobs of the user are displayed"""
+        job1 = mommy.make(ExportJob, user=self.user, export_type=ExportJob.TYPE_CSV, status=ExportJob.STATUS_DONE)
+        other_user = mommy.make(User)
+        job2 = mommy.make(ExportJob, user=other_user, export_type=ExportJob.TYPE_CSV)
+
+        response = self.client.get(reverse('search_export_jobs'))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([job1], response.context['jobs'])
+        self.assertContains(response, reverse('search_download_export_job', args=[job1.id]))
+        self.assertNotContains(response, reverse('search_download_export_job', args=[job2.id]))
+
+    def test_download_other_user(self):
+        """the file of a job can not be downloaded by another user"""
+        other_user = mommy.make(User)
+        job = mommy.make(ExportJob, user=other_user, export_type=ExportJob.TYPE_CSV, status=ExportJob.STATUS_DONE)
+        response = self.client.get(reverse('search_download_export_job', args=[job.id]))
+        self.assertEqual(403, response.status_code)
+
+    def test_download_not_done(self):
+        """no file before the end of the job"""
+        job = mommy.make(ExportJob, user=self.user, export_type=ExportJob.TYPE_CSV, status=ExportJob.STATUS_RUNNING)
+        response = self.client.get(reverse('search_download_export_job', args=[job.id]))
+        self.assertEqual(404, response.status_code)
+
+    def test_invalid_search(self):
+        """the job fails if the search is not valid"""
+        job = mommy.make(
+            ExportJob, user=self.user, export_type=ExportJob.TYPE_CSV,
+            search_data=json.dumps({"gr0-_-entity_name-_-0": []})
+        )
+        call_command('run_export_jobs', verbosity=0)
+        job = ExportJob.objects.get(id=job.id)
+        self.assertEqual(ExportJob.STATUS_FAILED, job.status)
+        self.assertNotEqual('', job.error)
+
+    def test_running_jobs_not_taken(self):
+        """a job taken by a worker is not run again"""
+        job = mommy.make(
+            ExportJob, user=self.user, export_type=ExportJob.TYPE_CSV, status=ExportJob.STATUS_RUNNING,
+            search_data=json.dumps({"gr0-_-entity_name-_-0": ["AB"]})
+        )
+        call_command('run_export_jobs', verbosity=0)
+        job = ExportJob.objects.get(id=job.id)
+        self.assertEqual(ExportJob.STATUS_RUNNING, job.status)
+        self.assertEqual('', job.result.name)
+
+    def test_pdf_in_background(self):
+        """the pdf form creates a job when in_background is checked"""
+        entity1, entity2, entity3 = self._make_entities()
+        data = {
+            'contacts': ';'.join(['{0}'.format(entity1.default_contact.id)]),
+            'search_dict': json.dumps({}),
+            'template': 'pdf/labels_24.html',
+            'in_background': 'on',
+        }
+        response = self.client.post(reverse('search_export_to_pdf'), data=data)
+        self.assertEqual(200, response.status_code)
+        self.assertContains(response, reverse('search_export_jobs'))
+
+        job = ExportJob.objects.get()
+        self.assertEqual(ExportJob.TYPE_PDF, job.export_type)
+        self.assertEqual(ExportJob.STATUS_PENDING, job.status)
+        self.assertEqual(['pdf/labels_24.html'], json.loads(job.options)['template'])
@@ -111,6 +111,27 @@ class CreateEmailingTest(BaseTestCase):
         self.assertTrue(contact2 in emailing.send_to.all())
         self.assertFalse(contact3 in emailing.send_to.all())
 
+    def test_create_emailing_expired_selection(self):
+        """no emailing is created if the selection of contacts doesn't exist anymore"""
+        newsletter = mommy.make(Newsletter)
+        subscription_type = mommy.make(models.SubscriptionType)
+
+        data = {
+            'create_emailing': True,
+            'subject': "",
+            'subscription_type': subscription_type.id,
+            'newsletter': newsletter.id,
+            'contacts': '0123456789abcdef0123456789abcdef',
+            'lang': '',
+            'from_email': '',
+        }
+
+        url = reverse('search_emailing')
+        response = self.client.post(url, data=data)
+        self.assertEqual(200, response.status_code)
+        self.assertContains(response, "The selection of contacts has expired")
+        self.assertEqual(0, Emailing.objects.count())
+
     def test_create_emailing_anonymous(self):
         """test create an emailing: anonymous user"""
         contact1 = mommy.make(models.Contact, lastname="ABCD", main_contact=True, has_left=False)
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 """test quick search"""
 
+from django.test.utils import override_settings
 from django.urls import reverse
 
 from model_mommy import mommy
 
 from balafon.Crm import models
+from balafon.Search.quick_search import search_cities
 
 from balafon.Search.tests import BaseTestCase
 
@@ -365,3 +367,60 @@ class QuickSearchTest(BaseTestCase):
         self.assertContains(response, luke.firstname)
         self.assertNotContains(response, doe.firstname)
         self.assertNotContains(response, sidious.firstname)
+
+    @override_settings(BALAFON_QUICK_SEARCH_LIMIT=2)
+    def test_contacts_limited(self):
+        """quick search by name: only the first hits are displayed with the number of results"""
+        for firstname in ("Anakin", "Luke", "Leia"):
+            mommy.make(models.Contact, firstname=firstname, lastname="Skywalker")
+
+        response = self.client.get(reverse("quick_search"), data={"text": "Skywalker"})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, len(response.context['contacts']))
+        self.assertEqual(3, response.context['contacts_count'])
+        self.assertContains(response, "2 first of 3 results")
+
+    def test_contacts_ranked(self):
+        """quick search by name: exact match first, then the names starting with the text"""
+        anakin = mommy.make(models.Contact, firstname="Anakin", lastname="Skywalkers")
+        luke = mommy.make(models.Contact, firstname="Luke", lastname="The Skywalker")
+        entity = mommy.make(models.Entity, name="Skywalker", is_single_contact=False)
+
+        response = self.client.get(reverse("quick_search"), data={"text": "skywalker"})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([entity, anakin, luke], response.context['contacts'])
+        self.assertEqual(3, response.context['contacts_count'])
+        self.assertNotContains(response, "first of")
+
+    def test_contact_by_phone_format(self):
+        """quick search by phone: the numbers are found whatever their format"""
+        anakin = mommy.make(models.Contact, firstname="Anakin", lastname="Skywalker", phone="04 99 99 99 99")
+        obi = mommy.make(models.Contact, firstname="Obi-Wan", lastname="Kenobi", mobile="0499000000")
+        doe = mommy.make(models.Contact, firstname="Doe", lastname="John", phone="03.33.33.33.33")
+
+        response = self.client.get(reverse("quick_search"), data={"text": "04.99"})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([obi, anakin], response.context['contacts_by_phone'])
+        self.assertEqual(2, response.context['phones_count'])
+
+    def test_quick_search_city_counts(self):
+        """quick search on city: the numbers of entities and contacts are computed by a single query"""
+        city1 = mommy.make(models.City, name="ZooPark")
+        city2 = mommy.make(models.City, name="VodooPark")
+        mommy.make(models.City, name="Zoo without contacts")
+
+        entity1 = mommy.make(models.Entity, city=city1)
+        mommy.make(models.Contact, entity=entity1, city=city1)
+        mommy.make(models.Contact, entity=entity1, city=city1)
+        mommy.make(models.Entity, city=city2)
+
+        with self.assertNumQueries(1):
+            cities = search_cities("oo", 10)
+        self.assertEqual([(city2, 1, 0), (city1, 1, 2)], cities)
+
+    def test_quick_search_city_limit(self):
+        """quick search on city: only the first cities are returned"""
+        for name in ("Zoo1", "Zoo2", "Zoo3"):
+            mommy.make(models.Entity, city=mommy.make(models.City, name=name))
+        cities = search_cities("zoo", 2)
+        self.assertEqual(["Zoo1", "Zoo2"], [city.name for city, entities_count, contacts_count in cities])
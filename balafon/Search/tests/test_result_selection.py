@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""contacts of search results stored on the server"""
+
+from datetime import datetime, timedelta
+
+from django.urls import reverse
+
+from model_mommy import mommy
+
+from balafon.Crm import models
+from balafon.Search.models import ResultSelection
+from balafon.Search.tests import BaseTestCase
+
+
+class ResultSelectionTest(BaseTestCase):
+    """selection of contacts"""
+
+    def test_contacts_order(self):
+        """the contacts are returned in the order of the selection"""
+        contacts = [mommy.make(models.Contact) for index in range(3)]
+        contacts.reverse()
+        selection = ResultSelection.create_for_contacts(contacts)
+        self.assertEqual(32, len(selection.token))
+        self.assertEqual([contact.id for contact in contacts], selection.get_contact_ids())
+        self.assertEqual(contacts, ResultSelection.get_contacts(selection.token))
+
+    def test_ids_list(self):
+        """a list of ids is still accepted"""
+        contacts = [mommy.make(models.Contact) for index in range(2)]
+        value = ";".join(['{0}'.format(contact.id) for contact in contacts])
+        self.assertEqual(contacts, ResultSelection.get_contacts(value))
+
+    def test_is_valid_value(self):
+        """a token must exist: a list of ids is still accepted"""
+        selection = ResultSelection.create_for_contacts([mommy.make(models.Contact)])
+        self.assertTrue(ResultSelection.is_valid_value(selection.token))
+        self.assertTrue(ResultSelection.is_valid_value('1;2;'))
+        self.assertFalse(ResultSelection.is_valid_value('0123456789abcdef0123456789abcdef'))
+        self.assertFalse(ResultSelection.is_valid_value(';'))
+
+    def test_post_expired_token(self):
+        """the action is refused if the selection doesn't exist anymore"""
+        contact = mommy.make(models.Contact)
+        group = mommy.make(models.Group, name="my group")
+        selection = ResultSelection.create_for_contacts([contact])
+        selection.delete()
+        data = {
+            'add_to_group': 'add_to_group',
+            'groups': [group.id],
+            'on_contact': True,
+            'contacts': selection.token,
+        }
+        response = self.client.post(reverse('search_add_contacts_to_group'), data=data)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(0, group.contacts.count())
+        self.assertContains(response, "The selection of contacts has expired")
+
+    def test_old_selections_deleted(self):
+        """the old selections are deleted when a new one is created"""
+        contact = mommy.make(models.Contact)
+        selection = ResultSelection.create_for_contacts([contact])
+        ResultSelection.objects.filter(id=selection.id).update(
+            created=datetime.now() - timedelta(days=ResultSelection.LIFETIME + 1)
+        )
+        ResultSelection.create_for_contacts([contact])
+        self.assertEqual(0, ResultSelection.objects.filter(id=selection.id).count())
+        self.assertEqual(1, ResultSelection.objects.count())
+
+    def test_post_token(self):
+        """the forms of the actions on the results post the token"""
+        entity1 = mommy.make(models.Entity, name="My tiny corp")
+        entity2 = mommy.make(models.Entity, name="Other corp")
+        group = mommy.make(models.Group, name="my group")
+        group.entities.add(entity1, entity2)
+
+        response = self.client.post(reverse('search_add_contacts_to_group'), data={"gr0-_-group-_-0": group.id})
+        self.assertEqual(200, response.status_code)
+        selection = ResultSelection.objects.get()
+        self.assertContains(response, selection.token)
+
+        group2 = mommy.make(models.Group, name="other group")
+        data = {
+            'add_to_group': 'add_to_group',
+            'groups': [group2.id],
+            'on_contact': True,
+            'contacts': selection.token,
+        }
+        response = self.client.post(reverse('search_add_contacts_to_group'), data=data)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            sorted([entity1.default_contact.id, entity2.default_contact.id]),
+            sorted(group2.contacts.values_list('id', flat=True))
+        )
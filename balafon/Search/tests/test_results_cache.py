@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""cache of the search results"""
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test.utils import override_settings
+
+from model_mommy import mommy
+
+from balafon.Crm import models
+from balafon.Emailing.models import Emailing
+from balafon.Search.forms import SearchForm
+from balafon.Search.results_cache import VERSION_KEY
+from balafon.Search.tests import BaseTestCase
+
+
+@override_settings(BALAFON_SEARCH_CACHE_TIMEOUT=600)
+class ResultsCacheTest(BaseTestCase):
+    """the results of a search are kept in cache"""
+
+    def _get_contacts(self, data):
+        """returns the contacts of a valid search form"""
+        search_form = SearchForm(data)
+        self.assertTrue(search_form.is_valid())
+        return search_form.get_contacts()
+
+    def _make_contacts(self):
+        """contacts with a sort which can not be compiled in the database"""
+        entity1 = mommy.make(models.Entity, name="Abc", zip_code="42000")
+        entity2 = mommy.make(models.Entity, name="Abd", zip_code="01000")
+        return entity1.default_contact, entity2.default_contact
+
+    def test_cached_results(self):
+        """the second search doesn't run the search queries"""
+        contact1, contact2 = self._make_contacts()
+        data = {"gr0-_-entity_name-_-0": 'Ab', "gr0-_-sort-_-1": 'zipcode'}
+
+        self.assertEqual([contact2, contact1], self._get_contacts(data))
+
+        search_form = SearchForm(data)
+        self.assertTrue(search_form.is_valid())
+        with self.assertNumQueries(1):
+            contacts = search_form.get_contacts()
+        self.assertEqual([contact2, contact1], contacts)
+        self.assertEqual(contact2.entity.name, contacts[0].entity.name)
+
+    def test_excluded_not_in_key(self):
+        """the excluded contacts are removed from the cached results"""
+        contact1, contact2 = self._make_contacts()
+        data = {"gr0-_-entity_name-_-0": 'Ab'}
+        self.assertEqual([contact1, contact2], self._get_contacts(data))
+
+        data["excluded"] = "#{0}#".format(contact1.id)
+        self.assertEqual([contact2], self._get_contacts(data))
+
+    def test_invalidated_on_contact_change(self):
+        """results are computed again if a contact is modified"""
+        contact1, contact2 = self._make_contacts()
+        data = {"gr0-_-contact_name-_-0": 'Doe'}
+        self.assertEqual([], self._get_contacts(data))
+
+        contact1.lastname = "Doe"
+        contact1.save()
+        self.assertEqual([contact1], self._get_contacts(data))
+
+    def test_invalidated_on_group_change(self):
+        """results are computed again if the members of a group change"""
+        contact1, contact2 = self._make_contacts()
+        group = mommy.make(models.Group)
+        data = {"gr0-_-group-_-0": group.id}
+        self.assertEqual([], self._get_contacts(data))
+
+        group.entities.add(contact2.entity)
+        self.assertEqual([contact2], self._get_contacts(data))
+
+    def test_invalidated_on_emailing_sent(self):
+        """results are computed again if an emailing is sent to a contact"""
+        contact1, contact2 = self._make_contacts()
+        emailing = mommy.make(Emailing, status=Emailing.STATUS_SENDING)
+        data = {"gr0-_-emailing_sent-_-0": emailing.id}
+        self.assertEqual([], self._get_contacts(data))
+
+        emailing.sent_to.add(contact1)
+        self.assertEqual([contact1], self._get_contacts(data))
+
+    def test_invalidated_on_custom_field_value(self):
+        """results are computed again if a custom field value is set"""
+        contact1, contact2 = self._make_contacts()
+        custom_field = mommy.make(models.CustomField, name='level', model=models.CustomField.MODEL_CONTACT)
+        data = {"gr0-_-contact_with_custom_field-_-0": custom_field.id}
+        self.assertEqual([], self._get_contacts(data))
+
+        mommy.make(models.ContactCustomFieldValue, contact=contact2, custom_field=custom_field, value='high')
+        self.assertEqual([contact2], self._get_contacts(data))
+
+    def test_invalidated_on_delete(self):
+        """results are computed again if a contact is deleted"""
+        contact1, contact2 = self._make_contacts()
+        data = {"gr0-_-entity_name-_-0": 'Ab'}
+        self.assertEqual([contact1, contact2], self._get_contacts(data))
+
+        contact1.delete()
+        self.assertEqual([contact2], self._get_contacts(data))
+
+    @override_settings(BALAFON_SEARCH_CACHE_TIMEOUT=0)
+    def test_cache_disabled(self):
+        """no cache if the timeout is 0"""
+        contact1, contact2 = self._make_contacts()
+        country_type = mommy.make(models.ZoneType, type='country')
+        mommy.make(models.Zone, name=settings.BALAFON_DEFAULT_COUNTRY, parent=None, type=country_type)
+        data = {"gr0-_-entity_name-_-0": 'Ab', "gr0-_-sort-_-1": 'zipcode'}
+        self._get_contacts(data)
+
+        search_form = SearchForm(data)
+        self.assertTrue(search_form.is_valid())
+        with self.assertNumQueries(2):
+            search_form.get_contacts()
+
+    @override_settings(BALAFON_SEARCH_CACHE_TIMEOUT=0)
+    def test_not_invalidated_if_disabled(self):
+        """the version is not changed in the cache if the timeout is 0"""
+        mommy.make(models.Contact, lastname="Abc")
+        self.assertEqual(None, caches['default'].get(VERSION_KEY))
@@ -3,6 +3,8 @@
 
 import json
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from coop_cms.tests import BeautifulSoup
@@ -11,7 +13,8 @@ from model_mommy import mommy
 from balafon.Crm import models
 
 from balafon.Search.tests import BaseTestCase
-from balafon.Search.models import Search, SearchField, SearchGroup
+from balafon.Search.models import Search
+from balafon.Users.models import Favorite
 
 
 class SearchSaveTest(BaseTestCase):
@@ -77,16 +80,7 @@ class SearchSaveTest(BaseTestCase):
         )
 
         self.assertEqual(search_1.name, data["name"])
-        self.assertEqual(search_1.searchgroup_set.count(), 1)
-
-        search_group = search_1.searchgroup_set.all()[0]
-        self.assertEqual(search_group.name, "gr0")
-
-        self.assertEqual(search_group.searchfield_set.count(), 1)
-        search_field = search_group.searchfield_set.all()[0]
-        self.assertEqual(search_field.field, "group")
-        self.assertEqual(search_field.value, "{0}".format(group1.id))
-        self.assertEqual(search_field.is_list, False)
+        self.assertEqual(search_1.get_definition(), {"gr0": [{"field": "group", "count": 0, "value": group1.id}]})
 
     def test_open_search(self):
         """test open an existing search"""
@@ -94,10 +88,8 @@ class SearchSaveTest(BaseTestCase):
         group1 = mommy.make(models.Group)
 
         search = mommy.make(Search)
-        search_group = mommy.make(SearchGroup, name="gr0", search=search)
-        mommy.make(
-            SearchField, field='group', value='{0}'.format(group1.id), is_list=False, search_group=search_group
-        )
+        search.set_definition({"gr0": [{"field": "group", "count": 0, "value": '{0}'.format(group1.id)}]})
+        search.save()
 
         url = reverse("search", args=[search.id])
 
@@ -116,11 +108,9 @@ class SearchSaveTest(BaseTestCase):
         group3 = mommy.make(models.Group, name="ABB")
 
         search = mommy.make(Search)
-        search_group = mommy.make(SearchGroup, name="gr0", search=search)
-        value = "['{0}', '{1}']".format(group1.id, group2.id)
-        mommy.make(
-            SearchField, field='all_groups', value=value, is_list=True, search_group=search_group
-        )
+        value = ['{0}'.format(group1.id), '{0}'.format(group2.id)]
+        search.set_definition({"gr0": [{"field": "all_groups", "count": 0, "value": value}]})
+        search.save()
 
         url = reverse("search", args=[search.id])
 
@@ -143,10 +133,8 @@ class SearchSaveTest(BaseTestCase):
         group3 = mommy.make(models.Group, name="ABB")
 
         search = mommy.make(Search)
-        search_group = mommy.make(SearchGroup, name="gr0", search=search)
-        value = "['{0}']".format(group1.id)
-        mommy.make(
-            SearchField, field='all_groups', value=value, is_list=True, search_group=search_group)
+        search.set_definition({"gr0": [{"field": "all_groups", "count": 0, "value": ['{0}'.format(group1.id)]}]})
+        search.save()
 
         url = reverse("search", args=[search.id])
 
@@ -169,10 +157,8 @@ class SearchSaveTest(BaseTestCase):
         group3 = mommy.make(models.Group, name="ABB")
 
         search = mommy.make(Search)
-        search_group = mommy.make(SearchGroup, name="gr0", search=search)
-        value = "[]"
-        mommy.make(
-            SearchField, field='all_groups', value=value, is_list=True, search_group=search_group)
+        search.set_definition({"gr0": [{"field": "all_groups", "count": 0, "value": []}]})
+        search.save()
 
         url = reverse("search", args=[search.id])
 
@@ -217,16 +203,9 @@ class SearchSaveTest(BaseTestCase):
         )
 
         self.assertEqual(search_1.name, data["name"])
-        self.assertEqual(search_1.searchgroup_set.count(), 1)
-
-        search_group = search_1.searchgroup_set.all()[0]
-        self.assertEqual(search_group.name, "gr0")
-
-        self.assertEqual(search_group.searchfield_set.count(), 1)
-        search_field = search_group.searchfield_set.all()[0]
-        self.assertEqual(search_field.field, "all_groups")
-        self.assertEqual(search_field.value, "['{0}', '{1}']".format(*groups))
-        self.assertEqual(search_field.is_list, True)
+        self.assertEqual(
+            search_1.get_definition(), {"gr0": [{"field": "all_groups", "count": 0, "value": ['{0}'.format(x) for x in groups]}]}
+        )
 
     def test_save_search_multi_values_only_1(self):
         """save a search with multiple values fields: only 1 group is set"""
@@ -258,16 +237,9 @@ class SearchSaveTest(BaseTestCase):
         )
 
         self.assertEqual(search_1.name, data["name"])
-        self.assertEqual(search_1.searchgroup_set.count(), 1)
-
-        search_group = search_1.searchgroup_set.all()[0]
-        self.assertEqual(search_group.name, "gr0")
-
-        self.assertEqual(search_group.searchfield_set.count(), 1)
-        search_field = search_group.searchfield_set.all()[0]
-        self.assertEqual(search_field.field, "all_groups")
-        self.assertEqual(search_field.value, "['{0}']".format(group1.id))
-        self.assertEqual(search_field.is_list, True)
+        self.assertEqual(
+            search_1.get_definition(), {"gr0": [{"field": "all_groups", "count": 0, "value": ['{0}'.format(group1.id)]}]}
+        )
 
     def test_save_search_multi_values_none(self):
         """save a search with multiple values fields: empty"""
@@ -320,29 +292,16 @@ class SearchSaveTest(BaseTestCase):
         )
 
         self.assertEqual(search_1.name, data["name"])
-        self.assertEqual(search_1.searchgroup_set.count(), 2)
-
-        search_group = search_1.searchgroup_set.filter(name="gr0")[0]
-        self.assertEqual(search_group.name, "gr0")
-        self.assertEqual(search_group.searchfield_set.count(), 2)
-
-        search_fields = search_group.searchfield_set.all().order_by("value")
-        search_field = search_fields[0]
-        self.assertEqual(search_field.field, "group")
-        self.assertEqual(search_field.value, "{0}".format(group1.id))
-        self.assertEqual(search_field.count, 0)
-        search_field = search_fields[1]
-        self.assertEqual(search_field.field, "group")
-        self.assertEqual(search_field.value, "{0}".format(group2.id))
-        self.assertEqual(search_field.count, 1)
-
-        search_group = search_1.searchgroup_set.filter(name="gr1")[0]
-        self.assertEqual(search_group.name, "gr1")
-        self.assertEqual(search_group.searchfield_set.count(), 1)
-        search_field = search_group.searchfield_set.all()[0]
-        self.assertEqual(search_field.field, "group")
-        self.assertEqual(search_field.value, "{0}".format(group3.id))
-        self.assertEqual(search_field.count, 0)
+        self.assertEqual(
+            search_1.get_definition(),
+            {
+                "gr0": [
+                    {"field": "group", "count": 0, "value": group1.id},
+                    {"field": "group", "count": 1, "value": group2.id},
+                ],
+                "gr1": [{"field": "group", "count": 0, "value": group3.id}],
+            }
+        )
 
     def test_no_name(self):
         """save search without name"""
@@ -388,7 +347,7 @@ class SearchSaveTest(BaseTestCase):
         self.assertEqual(Search.objects.count(), 1)
         search_1 = Search.objects.all()[0]
         self.assertEqual(search_1.name, data["name"])
-        self.assertEqual(search_1.searchgroup_set.count(), 0)
+        self.assertEqual(search_1.get_definition(), {})
 
         soup = BeautifulSoup(response.content)
         self.assertEqual(len(soup.select(".field-error")), 1)
@@ -422,15 +381,7 @@ class SearchSaveTest(BaseTestCase):
         )
 
         self.assertEqual(search_1.name, data["name"])
-        self.assertEqual(search_1.searchgroup_set.count(), 1)
-
-        search_group = search_1.searchgroup_set.all()[0]
-        self.assertEqual(search_group.name, "gr0")
-
-        self.assertEqual(search_group.searchfield_set.count(), 1)
-        search_field = search_group.searchfield_set.all()[0]
-        self.assertEqual(search_field.field, "group")
-        self.assertEqual(search_field.value, "{0}".format(group1.id))
+        self.assertEqual(search_1.get_definition(), {"gr0": [{"field": "group", "count": 0, "value": group1.id}]})
 
     def test_save_search_anonymous(self):
         """save search as anonymous user"""
@@ -472,3 +423,55 @@ class SearchSaveTest(BaseTestCase):
 
         response = self.client.post(url, data=data)
         self.assertEqual(response.status_code, 302)
+
+
+class SearchDefinitionTest(BaseTestCase):
+    """the fields of a search are saved as json"""
+
+    def test_round_trip(self):
+        """the values are loaded as they were saved"""
+        search = mommy.make(Search)
+        definition = {
+            "gr0": [
+                {"field": "all_groups", "count": 0, "value": ["1", "2, 3", "it's"]},
+                {"field": "contact_name", "count": 1, "value": "D'Artagnan"},
+            ],
+            "gr1": [{"field": "all_groups", "count": 0, "value": []}],
+        }
+        search.set_definition(definition)
+        search.save()
+
+        search = Search.objects.get(id=search.id)
+        self.assertEqual(search.get_definition(), definition)
+        self.assertEqual(
+            search.get_search_data(),
+            {
+                "gr0-_-all_groups-_-0": ["1", "2, 3", "it's"],
+                "gr0-_-contact_name-_-1": "D'Artagnan",
+                "gr1-_-all_groups-_-0": [],
+            }
+        )
+
+    def test_search_list(self):
+        """the number of queries doesn't depend on the number of searches"""
+        searches = [mommy.make(Search, name="Search{0}".format(index)) for index in range(3)]
+        Favorite.objects.create(user=self.user, content_object=searches[1])
+
+        url = reverse("search_list")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        soup = BeautifulSoup(response.content)
+        self.assertEqual(len(soup.select(".favorite-icon")), 3)
+        self.assertEqual(len(soup.select(".favorite-icon.in-fav")), 1)
+
+        queries_count = self._count_queries(url)
+        for index in range(3, 10):
+            mommy.make(Search, name="Search{0}".format(index))
+        self.assertEqual(queries_count, self._count_queries(url))
+
+    def _count_queries(self, url):
+        """number of queries for getting the url"""
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
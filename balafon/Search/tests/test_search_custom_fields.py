@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 """miscellaneous searches"""
 
+import csv
+
+import xlrd
+
 from django.urls import reverse
 
 from model_mommy import mommy
@@ -84,4 +88,78 @@ class SearchEntityCustomFieldsTest(BaseTestCase):
         self.assertNotContains(response, contact3.lastname)
         self.assertNotContains(response, contact4.lastname)
         self.assertContains(response, contact5.lastname)
-        self.assertNotContains(response, contact6.lastname)
\ No newline at end of file
+        self.assertNotContains(response, contact6.lastname)
+
+class ExportCustomFieldsTest(BaseTestCase):
+    """export the custom fields of the search results"""
+
+    def test_export_custom_fields(self):
+        """the values of the custom fields are exported"""
+        contact_field = models.CustomField.objects.create(
+            model=models.CustomField.MODEL_CONTACT, name="ut_contact", label="UT contact", export_order=1
+        )
+        entity_field = models.CustomField.objects.create(
+            model=models.CustomField.MODEL_ENTITY, name="ut_entity", label="UT entity", export_order=2
+        )
+
+        entity1 = mommy.make(models.Entity, name="ABCD")
+        entity1.set_custom_field(entity_field.name, "E1")
+        contact1 = entity1.default_contact
+        contact1.set_custom_field(contact_field.name, "C1")
+        entity2 = mommy.make(models.Entity, name="ABEF")
+        contact2 = entity2.default_contact
+
+        url = reverse('search_export_contacts_as_excel')
+        response = self.client.post(url, data={"gr0-_-entity_name-_-0": "AB"})
+        self.assertEqual(200, response.status_code)
+
+        workbook = xlrd.open_workbook(file_contents=response.content)
+        sheet = workbook.sheet_by_index(0)
+        header = sheet.row_values(0)
+        contact_column, entity_column = header.index("UT contact"), header.index("UT entity")
+        values = {}
+        for row in range(1, sheet.nrows):
+            contact_id = int(sheet.cell_value(row, 0))
+            values[contact_id] = (sheet.cell_value(row, contact_column), sheet.cell_value(row, entity_column))
+        self.assertEqual({contact1.id: ("C1", "E1"), contact2.id: ("", "")}, values)
+
+    def test_export_csv(self):
+        """the search results are streamed as csv"""
+        contact_field = models.CustomField.objects.create(
+            model=models.CustomField.MODEL_CONTACT, name="ut_contact", label="UT contact", export_order=1
+        )
+        role = mommy.make(models.EntityRole, name="Boss")
+
+        entity1 = mommy.make(models.Entity, name="ABCD", email="abcd@abcd.fr")
+        contact1 = entity1.default_contact
+        contact1.lastname = "Doe"
+        contact1.role.add(role)
+        contact1.save()
+        contact1.set_custom_field(contact_field.name, "C1")
+        entity2 = mommy.make(models.Entity, name="ABEF")
+        contact2 = entity2.default_contact
+        entity3 = mommy.make(models.Entity, name="ABGH")
+
+        url = reverse('search_export_contacts_as_csv')
+        data = {
+            "gr0-_-entity_name-_-0": "AB",
+            "excluded": "#{0}#".format(entity3.default_contact.id),
+        }
+        response = self.client.post(url, data=data)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.streaming)
+        self.assertEqual('text/csv; charset=utf-8', response['Content-Type'])
+
+        content = b''.join(response.streaming_content).decode('utf-8')
+        lines = list(csv.reader(content.splitlines()))
+        self.assertEqual(3, len(lines))
+        header = lines[0]
+        self.assertIn("UT contact", header)
+        self.assertEqual(
+            [str(contact1.id), str(contact2.id)], [line[0] for line in lines[1:]]
+        )
+        line1 = dict(zip(header, lines[1]))
+        self.assertEqual("Doe", line1["Last name"])
+        self.assertEqual("abcd@abcd.fr", line1["Email"])
+        self.assertEqual("Boss", line1["role"])
+        self.assertEqual("C1", line1["UT contact"])
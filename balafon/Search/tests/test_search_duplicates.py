@@ -6,6 +6,7 @@ from django.urls import reverse
 from model_mommy import mommy
 
 from balafon.Crm import models
+from balafon.Search.forms import SearchForm
 from balafon.Search.tests import BaseTestCase
 
 
@@ -465,3 +466,80 @@ class SameAsNameTest(BaseTestCase):
         self.assertNotContains(response, contact1.email)
         self.assertNotContains(response, contact2.email)
 
+
+
+class CompiledDuplicatesTest(BaseTestCase):
+    """duplicates filters are applied in the database"""
+
+    def _make_contact(self, **kwargs):
+        kwargs.setdefault('has_left', False)
+        kwargs.setdefault('main_contact', True)
+        entity = mommy.make(models.Entity)
+        contact = mommy.make(models.Contact, entity=entity, **kwargs)
+        contact.entity.default_contact.delete()
+        contact.entity.save()
+        return contact
+
+    def _get_queryset(self, data):
+        """returns the compiled queryset of the search"""
+        search_form = SearchForm(data)
+        self.assertTrue(search_form.is_valid())
+        queryset = search_form.get_queryset()
+        self.assertNotEqual(None, queryset)
+        self.assertEqual(sorted(search_form.get_contacts(), key=lambda c: c.id), sorted(queryset, key=lambda c: c.id))
+        return queryset
+
+    def test_no_same_as(self):
+        """keep the best priority of each same-as"""
+        group = mommy.make(models.Group, name="GROUP1")
+        same_as = models.SameAs.objects.create()
+        contacts = [
+            self._make_contact(lastname="ABCD", same_as=same_as, same_as_priority=priority)
+            for priority in (3, 1, 2)
+        ]
+        contact4 = self._make_contact(lastname="EFGH")
+        for contact in contacts + [contact4]:
+            group.contacts.add(contact)
+
+        queryset = self._get_queryset({"gr0-_-group-_-0": group.id, "gr0-_-no_same_as-_-1": '0'})
+        self.assertEqual({contacts[1], contact4}, set(queryset))
+
+        queryset = self._get_queryset({"gr0-_-group-_-0": group.id, "gr0-_-no_same_as-_-1": '1'})
+        self.assertEqual(set(contacts + [contact4]), set(queryset))
+
+    def test_no_same_email(self):
+        """the email of the entity is used if the contact has no email"""
+        group = mommy.make(models.Group, name="GROUP1")
+        contact1 = self._make_contact(lastname="A", email="a@me.fr")
+        contact2 = self._make_contact(lastname="B", email="a@me.fr")
+        contact3 = self._make_contact(lastname="C", email="")
+        contact3.entity.email = "a@me.fr"
+        contact3.entity.save()
+        contact4 = self._make_contact(lastname="D", email="d@me.fr")
+        contact5 = self._make_contact(lastname="E", email="")
+        for contact in (contact1, contact2, contact3, contact4, contact5):
+            group.contacts.add(contact)
+
+        queryset = self._get_queryset({"gr0-_-group-_-0": group.id, "gr0-_-no_same_email-_-1": '0'})
+        self.assertEqual({contact1, contact4}, set(queryset))
+
+        queryset = self._get_queryset({"gr0-_-group-_-0": group.id, "gr0-_-no_same_email-_-1": '1'})
+        self.assertEqual({contact2, contact3}, set(queryset))
+
+    def test_duplicated_contacts_gender(self):
+        """the title is part of the fullname"""
+        contact1 = self._make_contact(firstname="Pierre", lastname="Dupond", gender=models.Contact.GENDER_MALE)
+        contact2 = self._make_contact(firstname="Pierre", lastname="Dupond", gender=models.Contact.GENDER_MALE)
+        contact3 = self._make_contact(firstname="Pierre", lastname="Dupond", gender=models.Contact.GENDER_FEMALE)
+        contact4 = self._make_contact(firstname="", lastname="Dupond", gender=models.Contact.GENDER_FEMALE)
+        contact5 = self._make_contact(
+            firstname="", lastname="Dupond", gender=models.Contact.GENDER_FEMALE, gender_title="Dr"
+        )
+        contact6 = self._make_contact(
+            firstname="", lastname="Dupond", gender=models.Contact.GENDER_MALE, gender_title="Dr"
+        )
+
+        queryset = self._get_queryset({"gr0-_-duplicated_contacts-_-1": '1'})
+        self.assertEqual({contact1, contact2, contact5, contact6}, set(queryset))
+        self.assertNotIn(contact3, queryset)
+        self.assertNotIn(contact4, queryset)
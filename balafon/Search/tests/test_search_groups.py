@@ -7,6 +7,7 @@ from coop_cms.tests import BeautifulSoup
 from model_mommy import mommy
 
 from balafon.Crm import models
+from balafon.Search.forms import SearchForm
 from balafon.Search.tests import BaseTestCase
 
 
@@ -946,3 +947,57 @@ class ContactWithEmailInGroupSearchForm(BaseTestCase):
         self.assertNotContains(response, entity2.name)
         self.assertNotContains(response, contact2a.lastname)
         self.assertNotContains(response, contact2b.lastname)
+
+    def _get_search_form(self, data):
+        """returns a valid search form"""
+        search_form = SearchForm(data)
+        self.assertTrue(search_form.is_valid())
+        return search_form
+
+    def test_search_entity_email(self):
+        """the email of the entity is used if the contact has no email"""
+        entity1 = mommy.make(models.Entity, name=u"#Tiny corp", email="test1@abcd.fr")
+        contact1a = mommy.make(models.Contact, entity=entity1, lastname=u"ABCD", main_contact=True, email="")
+        contact1b = mommy.make(
+            models.Contact, entity=entity1, lastname=u"IJKL", main_contact=True, email="test2@abcd.fr"
+        )
+        entity2 = mommy.make(models.Entity, name=u"#Other corp", email="test2@abcd.fr")
+        contact2a = mommy.make(models.Contact, entity=entity2, lastname=u"UVWX", main_contact=True, email="")
+        contact2b = mommy.make(
+            models.Contact, entity=entity2, lastname=u"YZAB", main_contact=True, email="test1@abcd.fr"
+        )
+        contact3 = mommy.make(models.Contact, lastname=u"EFGH", main_contact=True, email="")
+
+        group1 = mommy.make(models.Group, name=u"#group1")
+        group1.entities.add(entity1)
+        group1.contacts.add(contact3)
+        group2 = mommy.make(models.Group, name=u"#group2")
+        group2.contacts.add(contact2a)
+        group2.contacts.add(contact2b)
+
+        search_form = self._get_search_form(
+            {'gr0-_-group-_-0': group1.id, "gr0-_-email_in_group-_-1": group2.id}
+        )
+        queryset = search_form.get_queryset()
+        self.assertEqual({entity1.default_contact, contact1a, contact1b}, set(queryset))
+        self.assertEqual(set(search_form.get_contacts()), set(queryset))
+
+    def test_search_single_query(self):
+        """the filter is part of the main query"""
+        entity1 = mommy.make(models.Entity, name=u"#Tiny corp")
+        group1 = mommy.make(models.Group, name=u"#group1")
+        group1.entities.add(entity1)
+        group2 = mommy.make(models.Group, name=u"#group2")
+        for index in range(10):
+            contact = mommy.make(
+                models.Contact, entity=entity1, main_contact=True, email="test{0}@abcd.fr".format(index % 5)
+            )
+            if index < 5:
+                group2.contacts.add(contact)
+
+        search_form = self._get_search_form(
+            {'gr0-_-group-_-0': group1.id, "gr0-_-email_in_group-_-1": group2.id, "gr0-_-no_same_email-_-2": 0}
+        )
+        with self.assertNumQueries(1):
+            contacts = list(search_form.get_queryset())
+        self.assertEqual(5, len(contacts))
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""profiling of the searches"""
+
+import logging
+
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from coop_cms.tests import BeautifulSoup
+from model_mommy import mommy
+
+from balafon.Crm import models
+from balafon.Search.forms import SearchForm
+from balafon.Search.profiler import SearchProfiler
+from balafon.Search.tests import BaseTestCase
+
+
+class SearchProfilerTest(BaseTestCase):
+    """the steps of the search are measured"""
+
+    def _make_contacts(self):
+        """contacts in a group: one of them in the other group"""
+        group1 = mommy.make(models.Group, name="group1")
+        group2 = mommy.make(models.Group, name="group2")
+        contacts = [mommy.make(models.Contact, lastname="Contact{0}".format(index)) for index in range(3)]
+        group1.contacts.add(*contacts)
+        group2.contacts.add(contacts[0])
+        return group1, group2
+
+    def test_profile_entries(self):
+        """an entry for the block and each of its filters"""
+        group1, group2 = self._make_contacts()
+        profiler = SearchProfiler()
+        search_form = SearchForm(
+            {'gr0-_-group-_-0': group1.id, 'gr0-_-group-_-1': group2.id}, profiler=profiler
+        )
+        self.assertTrue(search_form.is_valid())
+        self.assertEqual(1, len(search_form.get_contacts()))
+
+        self.assertEqual(
+            [('gr0', '', 'block', 1), ('gr0', 'group', 'get_queryset', 3), ('gr0', 'group', 'get_queryset', 1)],
+            [(entry['block'], entry['filter'], entry['step'], entry['rows']) for entry in profiler.entries]
+        )
+        for entry in profiler.entries:
+            self.assertEqual(entry['queries'], len(entry['sql']))
+            self.assertTrue(entry['time_ms'] >= 0)
+            self.assertEqual(1, len(entry['count_sql']))
+            self.assertTrue('COUNT' in entry['count_sql'][0])
+            self.assertFalse('%s' in entry['count_sql'][0])
+
+    def test_global_post_process(self):
+        """the global filters are measured"""
+        group1 = self._make_contacts()[0]
+        profiler = SearchProfiler()
+        search_form = SearchForm({'gr0-_-group-_-0': group1.id, 'gr0-_-sort-_-1': 'contact'}, profiler=profiler)
+        self.assertTrue(search_form.is_valid())
+        self.assertEqual(3, len(search_form.get_contacts()))
+        self.assertEqual(
+            [3], [entry['rows'] for entry in profiler.entries if entry['filter'] == 'sort' and entry['block'] == '']
+        )
+
+    def test_view_profile(self):
+        """the profile is displayed if requested"""
+        group1 = self._make_contacts()[0]
+        url = reverse('search') + '?profile=1'
+        response = self.client.post(url, data={'gr0-_-group-_-0': group1.id})
+        self.assertEqual(200, response.status_code)
+        soup = BeautifulSoup(response.content)
+        self.assertEqual(2, len(soup.select('.search-profile-entry')))
+        self.assertEqual(1, len(soup.select('input[name=profile]')))
+
+    def test_view_no_profile(self):
+        """the profile is not displayed by default"""
+        group1 = self._make_contacts()[0]
+        response = self.client.post(reverse('search'), data={'gr0-_-group-_-0': group1.id})
+        self.assertEqual(200, response.status_code)
+        soup = BeautifulSoup(response.content)
+        self.assertEqual(0, len(soup.select('.search-profile')))
+
+    @override_settings(BALAFON_SEARCH_PROFILING=True)
+    def test_view_profile_setting(self):
+        """the profile is displayed if enabled by the settings"""
+        group1 = self._make_contacts()[0]
+        # the logs are disabled by the base test case
+        logging.disable(logging.NOTSET)
+        with self.assertLogs('balafon_crm', level='INFO') as logs:
+            response = self.client.post(reverse('search'), data={'gr0-_-group-_-0': group1.id})
+        self.assertEqual(200, response.status_code)
+        soup = BeautifulSoup(response.content)
+        self.assertTrue(len(soup.select('.search-profile-entry')) > 0)
+        self.assertTrue(any('search profile' in line for line in logs.output))
@@ -8,6 +8,7 @@ from django.urls import reverse
 from model_mommy import mommy
 
 from balafon.Crm import models
+from balafon.Crm.search_forms import ContactsRelationshipByType
 from balafon.Search.tests import BaseTestCase
 
 
@@ -122,3 +123,41 @@ class RelationshipSearchTest(BaseTestCase):
         self.assertNotContains(response, john.lastname)
         self.assertNotContains(response, ringo.lastname)
         self.assertNotContains(response, doe.lastname)
+
+    def test_relationship_date_several(self):
+        """contacts by relationship date: the contacts of every relationship"""
+        john = mommy.make(models.Contact, firstname="John", lastname="Lennon")
+        ringo = mommy.make(models.Contact, firstname="Georges", lastname="Harrison")
+        paul = mommy.make(models.Contact, firstname="Paul", lastname="McCartney")
+        doe = mommy.make(models.Contact, firstname="Jack", lastname="Doedoedoe")
+
+        friends = mommy.make(models.RelationshipType, name="Fiends")
+
+        models.Relationship.objects.create(contact1=john, contact2=ringo, relationship_type=friends)
+        models.Relationship.objects.create(contact1=paul, contact2=john, relationship_type=friends)
+
+        url = reverse('search')
+
+        today = date.today()
+        data = {"gr0-_-contacts_by_relationship_dates-_-0": '{0} {0}'.format(today.strftime("%d/%m/%Y"))}
+
+        response = self.client.post(url, data=data)
+        self.assertEqual(200, response.status_code)
+
+        self.assertContains(response, john.lastname)
+        self.assertContains(response, ringo.lastname)
+        self.assertContains(response, paul.lastname)
+        self.assertNotContains(response, doe.lastname)
+
+    def test_relationship_type_queries(self):
+        """contacts by relationship type: the relationships are not loaded"""
+        friends = mommy.make(models.RelationshipType, name="Fiends")
+        for index in range(5):
+            models.Relationship.objects.create(
+                contact1=mommy.make(models.Contact), contact2=mommy.make(models.Contact), relationship_type=friends
+            )
+
+        form = ContactsRelationshipByType('gr0', 0, {'contacts_by_relationship_type': friends.id})
+        with self.assertNumQueries(2):
+            contacts = list(form.get_queryset(models.Contact.objects.all()))
+        self.assertEqual(10, len(contacts))
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 """test we can search contact by subscription type"""
 
+from django.contrib.sites.models import Site
 from django.urls import reverse
 
 from model_mommy import mommy
 
 from balafon.Crm import models
+from balafon.Search.forms import SearchForm
 from balafon.Search.tests import BaseTestCase
 
 
@@ -227,3 +229,66 @@ class SubscriptionSearchTest(BaseTestCase):
         self.assertContains(response, entity2.name)
         self.assertNotContains(response, contact2.lastname)
         self.assertContains(response, contact4.lastname)
+
+
+class ContainsRefuseNewsletterTest(BaseTestCase):
+    """warning about contacts refusing a newsletter in search results"""
+
+    def _get_refuse_newsletter(self, data):
+        """returns the refused newsletters of the search results"""
+        search_form = SearchForm(data)
+        self.assertTrue(search_form.is_valid())
+        search_form.get_contacts()
+        return search_form.contains_refuse_newsletter
+
+    def test_no_subscription_types(self):
+        """no subscription type: nothing refused"""
+        entity = mommy.make(models.Entity, name="My tiny corp")
+        self.assertEqual(set(), self._get_refuse_newsletter({"gr0-_-entity_name-_-0": entity.name}))
+
+    def test_refuse_newsletter(self):
+        """all types refused by at least one contact"""
+        site = Site.objects.get_current()
+        subscription_type1 = mommy.make(models.SubscriptionType, name="Newsletter 1", site=site)
+        subscription_type2 = mommy.make(models.SubscriptionType, name="Newsletter 2", site=site)
+        subscription_type3 = mommy.make(models.SubscriptionType, name="Newsletter 3", site=site)
+        subscription_type4 = mommy.make(models.SubscriptionType, name="Other site", site=None)
+
+        entity = mommy.make(models.Entity, name="My tiny corp")
+        contact0 = entity.default_contact
+        contact1 = mommy.make(models.Contact, entity=entity, main_contact=True, has_left=False)
+        contact2 = mommy.make(models.Contact, entity=entity, main_contact=True, has_left=False)
+        for contact in (contact0, contact1, contact2):
+            mommy.make(
+                models.Subscription, contact=contact, subscription_type=subscription_type1, accept_subscription=True
+            )
+        mommy.make(
+            models.Subscription, contact=contact1, subscription_type=subscription_type2, accept_subscription=False
+        )
+        for contact in (contact0, contact2):
+            mommy.make(
+                models.Subscription, contact=contact, subscription_type=subscription_type2, accept_subscription=True
+            )
+        for contact in (contact0, contact1):
+            mommy.make(
+                models.Subscription, contact=contact, subscription_type=subscription_type3, accept_subscription=True
+            )
+
+        refuse_newsletter = self._get_refuse_newsletter({"gr0-_-entity_name-_-0": entity.name})
+        self.assertEqual({subscription_type2.name, subscription_type3.name}, refuse_newsletter)
+        self.assertNotIn(subscription_type4.name, refuse_newsletter)
+
+    def test_refuse_newsletter_query_count(self):
+        """the refused newsletters are computed in constant number of queries"""
+        site = Site.objects.get_current()
+        mommy.make(models.SubscriptionType, name="Newsletter 1", site=site)
+        mommy.make(models.SubscriptionType, name="Newsletter 2", site=site)
+        entity = mommy.make(models.Entity, name="My tiny corp")
+        for index in range(10):
+            mommy.make(models.Contact, entity=entity, main_contact=True, has_left=False)
+
+        search_form = SearchForm({"gr0-_-entity_name-_-0": entity.name})
+        self.assertTrue(search_form.is_valid())
+        with self.assertNumQueries(4):
+            search_form.get_contacts()
+        self.assertEqual({"Newsletter 1", "Newsletter 2"}, search_form.contains_refuse_newsletter)
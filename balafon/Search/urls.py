@@ -18,6 +18,13 @@ urlpatterns = [
     url(r'^list/$', views.view_search_list, name='search_list'),
     url(r'^emailing/$', views.create_emailing, name='search_emailing'),
     url(r'^as-excel/$', views.export_contacts_as_excel, name='search_export_contacts_as_excel'),
+    url(r'^as-csv/$', views.export_contacts_as_csv, name='search_export_contacts_as_csv'),
+    url(
+        r'^export-job/(?P<export_type>\d+)/$', views.create_export_contacts_job,
+        name='search_create_export_contacts_job'
+    ),
+    url(r'^export-jobs/$', views.view_export_jobs, name='search_export_jobs'),
+    url(r'^export-jobs/(?P<job_id>\d+)/download/$', views.download_export_job, name='search_download_export_job'),
     url(r'^create-actions/$', views.create_action_for_contacts, name='search_create_action_for_contacts'),
     url(r'^add-contacts-to-group/$', views.add_contacts_to_group, name='search_add_contacts_to_group'),
     url(r'^subscribe-contacts-admin/$', views.subscribe_contacts_admin, name='search_subscribe_contacts_admin'),
@@ -2,9 +2,25 @@
 
 from datetime import date
 
+from balafon.Crm.models import Contact
+
+
+# Number of contacts loaded by a single query
+CONTACTS_CHUNK_SIZE = 500
+
 
 def get_date_bounds(text):
     date1, date2 = text.split(' ')
     date1, date2 = [int(elt) for elt in date1.split('/')], [int(elt) for elt in date2.split('/')]
     date1.reverse(), date2.reverse()
     return date(*date1), date(*date2)
+
+
+def get_contacts_by_ids(contact_ids):
+    """returns the contacts of the ids in the same order. They are loaded by chunks: no limit of SQL params"""
+    contacts_by_id = {}
+    for index in range(0, len(contact_ids), CONTACTS_CHUNK_SIZE):
+        chunk_ids = contact_ids[index:index + CONTACTS_CHUNK_SIZE]
+        for contact in Contact.objects.filter(id__in=chunk_ids).select_related('entity'):
+            contacts_by_id[contact.id] = contact
+    return [contacts_by_id[contact_id] for contact_id in contact_ids if contact_id in contacts_by_id]
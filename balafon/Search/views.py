@@ -1,15 +1,16 @@
 # -*- coding: utf-8 -*-
 """search views and actions"""
 
+import csv
 import json
-import xlwt
 
-from django.db.models import Q
 from django.contrib import messages
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import PermissionDenied
+from django.db.models import Exists, OuterRef
 from django.contrib.auth.decorators import user_passes_test
-from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render
 from django.template import Template, Context
 from django.urls import reverse
@@ -23,70 +24,34 @@ from wkhtmltopdf.views import PDFTemplateView
 
 from balafon.permissions import can_access, is_admin
 from balafon.utils import logger, log_error, HttpResponseRedirectMailtoAllowed
-from balafon.Crm.models import Entity, Contact, Group, Action, Opportunity, City, CustomField, Subscription
-from balafon.Crm import settings as crm_settings
+from balafon.Crm.models import Group, Opportunity, City
+from balafon.Crm.utils import (
+    add_contacts_to_groups, add_entities_to_groups, create_actions_for_contacts, update_subscriptions
+)
 from balafon.Emailing.models import Emailing
 from balafon.Emailing.forms import NewEmailingForm
-from balafon.Search.models import Search
+from balafon.Search.exports import (
+    create_export_job, get_export_fields, get_export_value, get_pdf_cmd_options, get_pdf_context,
+    iter_export_contacts, write_excel
+)
+from balafon.Search.models import ExportJob, Search
+from balafon.Search.profiler import is_profiling_enabled, SearchProfiler
+from balafon.Search.quick_search import quick_search as get_quick_search_hits
+from balafon.Users.models import Favorite
 from balafon.Search.forms import (
     ActionForContactsForm, FieldChoiceForm, GroupForContactsForm, QuickSearchForm, PdfTemplateForm, SearchForm,
     SearchNameForm, get_field_form, SubscribeContactsAdminForm
 )
 
 
-def filter_icontains_unaccent(queryset, field, text):
-    if crm_settings.is_unaccent_filter_supported():
-        field += '__unaccent'
-    return list(queryset.filter(**{field + "__icontains": text}))
-
-
 @csrf_exempt
 @user_passes_test(can_access)
 def quick_search(request):
     form = QuickSearchForm(request.GET)
     if form.is_valid():
         text = form.cleaned_data["text"]
-
-        queryset = Entity.objects.filter(is_single_contact=False)
-        entities_by_name = filter_icontains_unaccent(queryset, 'name', text)
-
-        queryset = Contact.objects.all()#.filter(has_left=False)
-        contacts_by_name = filter_icontains_unaccent(queryset, 'lastname', text)
-
-        for entity in entities_by_name:
-            setattr(entity, 'is_entity', True)
-            for contact in entity.contact_set.all():
-                try:
-                    # avoid duplicates
-                    contacts_by_name.remove(contact)
-                except ValueError:
-                    pass
-        contacts = entities_by_name + contacts_by_name
-        contacts.sort(key=lambda x: getattr(x, 'name', getattr(x, 'lastname', '')))
-
-        queryset = Group.objects.all()
-        groups_by_name = filter_icontains_unaccent(queryset, 'name', text)
-
-        contacts_by_email = Contact.objects.filter(
-            Q(email__icontains=text) | (Q(email="") & Q(entity__email__icontains=text)))
-
-        cities_by_name = []
-        for city in City.objects.filter(name__icontains=text):
-            entities_count, contacts_count = city.contact_set.count(), city.entity_set.count()
-            if entities_count + contacts_count:
-                cities_by_name.append((city, entities_count, contacts_count))
-
-        contacts_by_phone = list(Contact.objects.filter(Q(mobile__icontains=text) | Q(phone__icontains=text)))
-        contacts_by_phone += list(Entity.objects.filter(phone__icontains=text))
-
-        context_dict = {
-            'contacts_by_phone': contacts_by_phone,
-            'cities_by_name': cities_by_name,
-            'text': text,
-            'contacts_by_email': contacts_by_email,
-            'contacts': contacts,
-            'groups_by_name': groups_by_name,
-        }
+        context_dict = get_quick_search_hits(text)
+        context_dict['text'] = text
     else:
         context_dict = {
             'text': request.GET.get('text', '') or '',
@@ -107,10 +72,11 @@ def search(request, search_id=0, group_id=0, opportunity_id=0, city_id=0):
     field_choice_form = FieldChoiceForm()
     contains_refuse_newsletter = []
     data = None
-    contacts_count = 0
+    contacts_count = entities_count = 0
     has_empty_entities = False
     group = opportunity = city = None
     contacts_display = False
+    profiler = SearchProfiler() if is_profiling_enabled(request) else None
 
     if request.method == "POST":
         data = request.POST
@@ -125,25 +91,45 @@ def search(request, search_id=0, group_id=0, opportunity_id=0, city_id=0):
         data = {"gr0-_-city-_-0": city_id}
             
     if data:
-        search_form = SearchForm(data)
+        search_form = SearchForm(data, profiler=profiler)
         if search_form.is_valid():
             contacts_display = search_form.contacts_display
             
             if not contacts_display:
-                results, contacts_count, has_empty_entities = search_form.get_contacts_by_entity()
-                contains_refuse_newsletter = list(search_form.contains_refuse_newsletter)
+                entities_by_queryset = search_form.get_entities_queryset()
+                if entities_by_queryset is not None:
+                    # entities and their contacts are loaded only for the current page
+                    results, contacts_count, has_empty_entities = entities_by_queryset
+                    entities_count = results.count()
+                    contains_refuse_newsletter = list(
+                        search_form.get_refuse_newsletter(search_form.get_queryset())
+                    )
+                else:
+                    results, contacts_count, has_empty_entities = search_form.get_contacts_by_entity()
+                    entities_count = len(results)
+                    contains_refuse_newsletter = list(search_form.contains_refuse_newsletter)
+                has_results = entities_count > 0
             else:
-                results = search_form.get_contacts()
-                contacts_count, has_empty_entities = len(results), False
-                contains_refuse_newsletter = list(search_form.contains_refuse_newsletter)
-            
-            if not results:
+                queryset = search_form.get_queryset()
+                if queryset is not None:
+                    results = queryset
+                    contacts_count = results.count()
+                    contains_refuse_newsletter = list(search_form.get_refuse_newsletter(results))
+                else:
+                    results = search_form.get_contacts()
+                    contacts_count = len(results)
+                    contains_refuse_newsletter = list(search_form.contains_refuse_newsletter)
+                has_empty_entities = False
+                has_results = contacts_count > 0
+
+            if not has_results:
                 message = _('Sorry, no results found')
+
+            if profiler:
+                profiler.log(search_form.serialize())
     else:
         search_obj = get_object_or_404(Search, id=search_id) if search_id else None
         search_form = SearchForm(instance=search_obj)
-    
-    entities_count = 0 if contacts_display else len(results)
 
     page_obj = paginate(request, results, getattr(settings, 'BALAFON_SEARCH_NB_IN_PAGE', None) or 50)
 
@@ -164,6 +150,7 @@ def search(request, search_id=0, group_id=0, opportunity_id=0, city_id=0):
             'group': group,
             'opportunity': opportunity,
             'city': city,
+            'search_profiler': profiler,
             'contacts_display': contacts_display,
         }
     )
@@ -268,7 +255,14 @@ def mailto_contacts(request, bcc):
 
 @user_passes_test(can_access)
 def view_search_list(request):
-    searches = Search.objects.all()
+    # The definitions are not displayed and the favorite status is loaded with the searches
+    searches = Search.objects.defer('definition').annotate(
+        is_in_favorite=Exists(
+            Favorite.objects.filter(
+                user=request.user, content_type=ContentType.objects.get_for_model(Search), object_id=OuterRef('id')
+            )
+        )
+    )
     page_obj = paginate(request, searches, 50)
 
     return render(
@@ -342,69 +336,86 @@ def export_contacts_as_excel(request):
     if request.method == "POST":
         search_form = SearchForm(request.POST)
         if search_form.is_valid():
-            contacts = search_form.get_contacts()
-            if not search_form.contacts_display:
-                # if the form already has a sort criteria: don't sort again
-                contacts.sort(key=lambda x: "{0}-{1}-{2}".format(x.entity, x.lastname, x.firstname))
-            
-            # create the excel document
-            workbook = xlwt.Workbook()
-            worksheet = workbook.add_sheet('balafon')
-
-            fields = [
-                'id', 'get_gender_text', 'lastname', 'firstname', 'title', 'get_entity_name', 'job', 'role',
-                'get_address', 'get_address2', 'get_address3', 'get_zip_code', 'get_cedex', 'get_city',
-                'get_foreign_country', 'mobile', 'get_phone', 'get_email', 'birth_date', 'favorite_language'
-            ]
-            
-            # header
-            header_style = xlwt.easyxf('font: bold 1; pattern: pattern solid, fore-colour gray25;')
-            # create a map of verbose name for each field
-            field_dict = dict([(field.name, _(field.verbose_name).capitalize()) for field in Contact._meta.fields])
-            field_dict['foreign_country'] = _("Country")
-            field_dict['entity_name'] = _("Entity")
-            
-            # Add custom fields
-            for cf in CustomField.objects.filter(export_order__gt=0).order_by('export_order'):
-                if cf.model == CustomField.MODEL_CONTACT:
-                    fields.append('custom_field_'+cf.name)
-                    field_dict['custom_field_'+cf.name] = cf.label
-                elif cf.model == CustomField.MODEL_ENTITY:
-                    fields.append('entity_custom_field_'+cf.name)
-                    field_dict['entity_custom_field_'+cf.name] = cf.label
-            
-            for index, field in enumerate(fields):
-                if field[:4] == 'get_':
-                    field = field[4:]
-                    if field[-8:] == '_display':
-                        field = field[:-8]
-                # print the verbose name if exists, the field name if not
-                value = field_dict.get(field, field)
-                worksheet.write(0, index, value, header_style)
-            
-            style = xlwt.Style.default_style
-            for index, contact in enumerate(contacts):
-                for index2, field_name in enumerate(fields):
-                    field = getattr(contact, field_name)
+            response = HttpResponse(content_type='application/vnd.ms-excel')
+            response['Content-Disposition'] = 'attachment; filename={0}.xls'.format('balafon')
+            write_excel(search_form, response)
+            return response
+        else:
+            logger.error('{0}'.format(search_form.errors))
+    raise Http404
 
-                    if field_name == 'role':
-                        field = ", ".join([r.name for r in field.all()])
 
-                    elif callable(field):
-                        field = field()
+class _Echo(object):
+    """file-like object for the csv writer: returns the line rather than writing it"""
 
-                    if field:
-                        worksheet.write(index+1, index2, '{0}'.format(field), style)
+    def write(self, value):
+        return value
 
-            response = HttpResponse(content_type='application/vnd.ms-excel')
-            response['Content-Disposition'] = 'attachment; filename={0}.xls'.format('balafon')
-            workbook.save(response)
+
+@user_passes_test(can_access)
+def export_contacts_as_csv(request):
+    """export the search results as a csv file. The file is streamed: no limit of lines and low memory"""
+    if request.method == "POST":
+        search_form = SearchForm(request.POST)
+        if search_form.is_valid():
+            fields, header, custom_field_names = get_export_fields()
+            writer = csv.writer(_Echo())
+
+            def get_lines():
+                yield writer.writerow(header)
+                for contact in iter_export_contacts(search_form, custom_field_names):
+                    yield writer.writerow([get_export_value(contact, field_name) for field_name in fields])
+
+            response = StreamingHttpResponse(get_lines(), content_type='text/csv; charset=utf-8')
+            response['Content-Disposition'] = 'attachment; filename={0}.csv'.format('balafon')
             return response
         else:
             logger.error('{0}'.format(search_form.errors))
     raise Http404
 
 
+@user_passes_test(can_access)
+def create_export_contacts_job(request, export_type):
+    """export the search results in background: the file is generated by the run_export_jobs command"""
+    export_type = int(export_type)
+    if request.method == "POST" and export_type in (ExportJob.TYPE_EXCEL, ExportJob.TYPE_CSV):
+        search_form = SearchForm(request.POST)
+        if search_form.is_valid():
+            create_export_job(request.user, export_type, search_data=request.POST)
+            messages.add_message(
+                request, messages.SUCCESS, _('The export is in progress. The file will be available here.')
+            )
+            return HttpResponseRedirect(reverse('search_export_jobs'))
+        else:
+            logger.error('{0}'.format(search_form.errors))
+    raise Http404
+
+
+@user_passes_test(can_access)
+def view_export_jobs(request):
+    """the export jobs of the current user"""
+    jobs = ExportJob.objects.filter(user=request.user)
+    page_obj = paginate(request, jobs, 50)
+
+    return render(
+        request,
+        'Search/export_jobs.html',
+        {
+            'jobs': list(page_obj),
+            'page_obj': page_obj,
+        }
+    )
+
+
+@user_passes_test(can_access)
+def download_export_job(request, job_id):
+    """download the file of an export job"""
+    job = get_object_or_404(ExportJob, id=job_id, status=ExportJob.STATUS_DONE)
+    if job.user != request.user and not is_admin(request.user):
+        raise PermissionDenied
+    return FileResponse(job.result.open('rb'), as_attachment=True, filename=job.get_filename())
+
+
 @user_passes_test(can_access)
 @popup_redirect
 def create_action_for_contacts(request):
@@ -413,16 +424,11 @@ def create_action_for_contacts(request):
             form = ActionForContactsForm(request.POST)
             if form.is_valid():
                 contacts = form.get_contacts()
-                for contact in contacts:
-                    # create actions for each contact
-                    kwargs = dict(form.cleaned_data)
-                    for key in ('date', 'time', 'contacts'):
-                        del kwargs[key]
-                    action = Action.objects.create(**kwargs)
-                    if action.type and action.type.default_status:
-                        action.status = action.type.default_status
-                    action.contacts.add(contact)
-                    action.save()
+                kwargs = dict(form.cleaned_data)
+                for key in ('date', 'time', 'contacts'):
+                    del kwargs[key]
+                # create actions for each contact
+                create_actions_for_contacts(contacts, **kwargs)
                 messages.add_message(
                     request,
                     messages.SUCCESS,
@@ -470,18 +476,16 @@ def add_contacts_to_group(request):
                     groups = form.cleaned_data['groups']
                     
                     if form.cleaned_data["on_contact"]:
+                        add_contacts_to_groups(groups, contacts)
                         for g in groups:
-                            for c in contacts:
-                                g.contacts.add(c)
                             g.save()
                         messages.add_message(
                             request, messages.SUCCESS, _("{0} contacts have been added to groups".format(len(contacts)))
                         )
                     else:
-                        entities = set([c.entity for c in contacts])
+                        entities = set([c.entity_id for c in contacts])
+                        add_entities_to_groups(groups, entities)
                         for g in groups:
-                            for entity in entities:
-                                g.entities.add(entity)
                             g.save()
                         messages.add_message(
                             request, messages.SUCCESS, _("{0} entities have been added to groups".format(len(entities)))
@@ -531,30 +535,11 @@ def subscribe_contacts_admin(request):
             if "subscribe_contacts_admin" in request.POST:
                 form = SubscribeContactsAdminForm(request.POST)
                 if form.is_valid():
-                    nb_contacts = 0
                     contacts = form.get_contacts()
                     subscription_type = form.cleaned_data['subscription_type']
                     subscribe = form.cleaned_data['subscribe']
 
-                    for contact in contacts:
-
-                        if subscribe:
-                            subscription, created = Subscription.objects.get_or_create(
-                                contact=contact, subscription_type=subscription_type
-                            )
-                        else:
-                            created = False
-                            try:
-                                subscription = Subscription.objects.get(
-                                    contact=contact, subscription_type=subscription_type
-                                )
-                            except Subscription.DoesNotExist:
-                                subscription = None
-
-                        if created or (subscription and subscribe != subscription.accept_subscription):
-                            subscription.accept_subscription = subscribe
-                            subscription.save()
-                            nb_contacts += 1
+                    nb_contacts = update_subscriptions(contacts, subscription_type, subscribe)
 
                     if subscribe:
                         messages.add_message(
@@ -608,24 +593,22 @@ def subscribe_contacts_admin(request):
 def export_to_pdf(request):
     try:
         if request.method == "POST":
-            if "export_to_pdf" in request.POST:
+            if "export_to_pdf" in request.POST or "in_background" in request.POST:
                 #called by the colorbox
                 form = PdfTemplateForm(request.POST)
                 if form.is_valid():
+                    if form.cleaned_data['in_background']:
+                        # the pdf is generated by the run_export_jobs command
+                        create_export_job(request.user, ExportJob.TYPE_PDF, options=request.POST)
+                        messages.add_message(
+                            request, messages.SUCCESS,
+                            _('The export is in progress. The file will be available here.')
+                        )
+                        return HttpResponseRedirect(reverse('search_export_jobs'))
+
                     template_name = form.cleaned_data['template']
-                    contacts = form.get_contacts()
-                    context = {
-                        "contacts": contacts,
-                        "search_dict": json.loads(form.cleaned_data['search_dict']),
-                    }
-                    
-                    context = form.patch_context(context)
-                    
-                    pdf_options = getattr(settings, 'BALAFON_PDF_OPTIONS', None)
-                    if pdf_options is None:
-                        cmd_options = {'margin-top': 0, 'margin-bottom': 0, 'margin-right': 0, 'margin-left': 0, }
-                    else:
-                        cmd_options = pdf_options.get(template_name, {})
+                    context = get_pdf_context(form)
+                    cmd_options = get_pdf_cmd_options(template_name)
                     
                     pdf_view = PDFTemplateView(
                         filename='balafon.pdf',
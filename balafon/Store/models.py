@@ -19,7 +19,7 @@ from django.utils.translation import ugettext_lazy as _, ugettext
 from sorl.thumbnail import default as sorl_thumbnail
 
 from balafon.Crm.models import Action, ActionMenu, ActionStatus, ActionType, Group
-from balafon.Crm.signals import action_cloned
+from balafon.Crm.signals import action_cloned, actions_bulk_created
 from balafon.Store.settings import get_thumbnail_crop, get_thumbnail_size, get_image_crop, get_image_size
 from balafon.Store.utils import round_currency
 
@@ -1322,3 +1322,18 @@ def freeze_readonly_action(sender, instance, created, **kwargs):
 
 post_save.connect(freeze_readonly_action, sender=Action)
 
+
+def on_actions_bulk_created(sender, actions, **kwargs):
+    """create sales and freeze the actions created in bulk: same as post_save for the actions of store types"""
+    type_ids = set(action.type_id for action in actions if action.type_id)
+    store_type_ids = set(
+        StoreManagementActionType.objects.filter(action_type__in=type_ids).values_list('action_type', flat=True)
+    )
+    for action in actions:
+        if action.type_id in store_type_ids:
+            create_action_sale(sender, action, True)
+            freeze_readonly_action(sender, action, True)
+
+
+actions_bulk_created.connect(on_actions_bulk_created, sender=Action)
+
@@ -11,6 +11,7 @@ from model_mommy import mommy
 
 from balafon.unit_tests import TestCase
 from balafon.Crm.models import Action, ActionMenu, ActionType, Contact, ActionStatus, MailtoSettings
+from balafon.Crm.utils import create_actions_for_contacts
 from balafon.Store import models
 
 
@@ -94,6 +95,16 @@ class StoreManagementActionTypeTest(TestCase):
         store_action_type.save()
         self.assertEqual(1, ActionMenu.objects.count())
 
+    def test_actions_created_in_bulk(self):
+        """It should create the sales of the actions created in bulk"""
+        action_type = mommy.make(ActionType)
+        mommy.make(models.StoreManagementActionType, action_type=action_type)
+        contacts = [mommy.make(Contact), mommy.make(Contact)]
+
+        actions = create_actions_for_contacts(contacts, type=action_type)
+
+        self.assertEqual(2, models.Sale.objects.filter(action__in=actions).count())
+
 
 class UpdateActionItemTest(TestCase):
     """It should keep Action amount up-to-date"""
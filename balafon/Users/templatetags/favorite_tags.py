@@ -14,7 +14,10 @@ register = template.Library()
 def favorite_item(context, object):
     content_type = ContentType.objects.get_for_model(object.__class__)
     user = context['request'].user
-    if user and user.is_authenticated:
+    if hasattr(object, 'is_in_favorite'):
+        # the status has been annotated on the queryset: no query for each object
+        is_in_favorite = int(object.is_in_favorite)
+    elif user and user.is_authenticated:
         is_in_favorite = Favorite.objects.filter(
             user=context['request'].user,
             content_type=content_type,
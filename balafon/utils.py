@@ -4,6 +4,7 @@
 from bs4 import BeautifulSoup
 from datetime import datetime
 import logging
+import re
 from urllib.parse import urlparse
 from importlib import import_module
 
@@ -89,6 +90,16 @@ def validate_rgb(value):
     return False
 
 
+def get_phone_digits(value):
+    """the digits of a phone number: '06 12.34.56-78' and '0612345678' have the same digits"""
+    return re.sub(r'\D', '', value or '')
+
+
+def is_phone_number(text):
+    """returns True if a searched text looks like a (part of) phone number"""
+    return bool(re.match(r'^\+?[\d\s./()-]+$', text or '')) and len(get_phone_digits(text)) >= 2
+
+
 class Utf8JSONRenderer(JSONRenderer):
     """Utf-8 support"""
     def render(self, *args, **kwargs):